@@ -19,23 +19,112 @@
 # Riyaad: I have now implemented the above and left notes describing what we trying to achieve.
 
 import json
+import os
+import time
+import hashlib
 import boto3
-from datetime import datetime
+from botocore.exceptions import ClientError
+from datetime import datetime, timezone
 import uuid
-import re
+from pipeline_event_parser import parse_pipeline_event, TABLE_PROCESSED
 import logging
-import urllib3
+from teams_notification_queue import LAMBDA_FAILURES_WEBHOOK, enqueue_notification
+from pipeline_metrics import PipelineMetrics
+import glue_admission_control
 
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-http = urllib3.PoolManager()
+metrics = PipelineMetrics('active_table_start')
+
+# SNS delivers at least once, so the same "table processed" message can arrive more than once. Every start is
+# named after the message identity (the job run id, else the SNS MessageId) so a redelivery maps to the same
+# execution, which Step Functions refuses to start twice (ExecutionAlreadyExists). Successful starts are also
+# remembered in a warm in-memory cache and, when EXECUTION_DEDUPE_TABLE is set, in DynamoDB, so redeliveries
+# are skipped without a start_execution call. Concurrent deliveries that both pass that check are stopped by
+# the execution name, or when admission control queues the launch, by its QUEUED marker (see _enqueue there).
+# Leave EXECUTION_DEDUPE_TABLE empty to rely on the execution names only.
+EXECUTION_DEDUPE_TABLE = os.environ.get('EXECUTION_DEDUPE_TABLE', '')
+DEDUPE_TTL_SECONDS = int(os.environ.get('EXECUTION_DEDUPE_TTL_SECONDS', str(24 * 60 * 60)))
+WARM_CACHE_SECONDS = 15 * 60
+WARM_CACHE_MAX_ENTRIES = 10000
+
+# dedupe_key -> time.monotonic() at which the entry expires, kept across warm invocations
+_recent_starts = {}
+_dynamodb_client = None
+
+def get_dynamodb_client():
+    global _dynamodb_client
+    if _dynamodb_client is None:
+        _dynamodb_client = boto3.client('dynamodb')
+    return _dynamodb_client
+
+def execution_identity(event, pipeline_event):
+    """
+    The identity of the message a start is made for: the ingestion job run id when the message carries one
+    (stable even if the job publishes twice), otherwise the SNS MessageId. None if neither is available.
+    """
+    if pipeline_event.job_run_id:
+        return pipeline_event.job_run_id
+    return event['Records'][0]['Sns'].get('MessageId')
+
+def deterministic_execution_name(table_name, state_machine_arn, identity):
+    """
+    Execution names are at most 80 characters of [A-Za-z0-9-_], so the identity is hashed.
+    """
+    digest = hashlib.sha256(f"{state_machine_arn}|{table_name}|{identity}".encode('utf-8')).hexdigest()[:24]
+    return f"{table_name[:55]}_{digest}"
+
+def _remember_start(dedupe_key):
+    now = time.monotonic()
+    if len(_recent_starts) >= WARM_CACHE_MAX_ENTRIES:
+        for key in [key for key, expires in _recent_starts.items() if expires <= now]:
+            del _recent_starts[key]
+        if len(_recent_starts) >= WARM_CACHE_MAX_ENTRIES:
+            _recent_starts.clear()
+    _recent_starts[dedupe_key] = now + WARM_CACHE_SECONDS
+
+def _seen_recently(dedupe_key):
+    expires = _recent_starts.get(dedupe_key)
+    return expires is not None and expires > time.monotonic()
+
+def already_started(dedupe_key):
+    """
+    Whether an earlier delivery of this message recorded a successful start.
+    """
+    if not EXECUTION_DEDUPE_TABLE:
+        return False
+    item = get_dynamodb_client().get_item(
+        TableName=EXECUTION_DEDUPE_TABLE, Key={'dedupe_key': {'S': dedupe_key}}, ConsistentRead=True
+    ).get('Item')
+    return item is not None
+
+def record_start(dedupe_key, execution_name, state_machine_arn):
+    """
+    Record a start once it has succeeded (or was queued by admission control). Writing it any earlier would
+    make every redelivery skip a start that never happened if the Lambda died in between.
+    """
+    if not EXECUTION_DEDUPE_TABLE:
+        return
+    try:
+        get_dynamodb_client().put_item(
+            TableName=EXECUTION_DEDUPE_TABLE,
+            Item={
+                'dedupe_key': {'S': dedupe_key},
+                'execution_name': {'S': execution_name},
+                'state_machine_arn': {'S': state_machine_arn},
+                'created_at': {'S': datetime.now(timezone.utc).isoformat()},
+                'expires_at': {'N': str(int(time.time()) + DEDUPE_TTL_SECONDS)}
+            }
+        )
+    except Exception as record_error:
+        # The execution name still makes a redelivered start fail with ExecutionAlreadyExists
+        print(f"Failed to record the start of {execution_name}: {record_error}")
 
 def send_lambda_failure_notification(function_name, error_message):
     try:
         print('In failure notification definition using webhook...')
-        webhook_url = "https://libertyholdings.webhook.office.com/webhookb2/84ae269b-3328-4244-9c58-87c0541029c0@66b8ffa6-81c0-4ea6-93fb-06f390dc67f6/IncomingWebhook/1c7314d5bffd4561aa4d694641deb2f3/540ec8e7-b8ad-4612-9c4a-140cef8ece9c/V2D2XxrsBWC76nparKmE63SCKVqIts7TmneUOC8PDMJOk1"
         payload = {
             "title": f"Lambda Failure Notification : {function_name}",
             "text": (
@@ -45,20 +134,16 @@ def send_lambda_failure_notification(function_name, error_message):
                 f"Please investigate the issue and check CloudWatch logs for more details."
             )
         }
-        encoded_payload = json.dumps(payload).encode('utf-8')
-        # Send POST request to the Webhook URL
-        
-        response = http.request('POST', webhook_url, body=encoded_payload, headers={'Content-Type': 'application/json'})
-
-        # Log success or failure
-        if response.status == 200:
-            print(f"Webhook notification sent successfully for Lambda function: {function_name}")
+        # Queue the notification, the teams_notification_sender Lambda posts it to the Webhook URL
+        if enqueue_notification(LAMBDA_FAILURES_WEBHOOK, payload, function_name):
+            print(f"Webhook notification queued for Lambda function: {function_name}")
         else:
-            print(f"Failed to send Webhook notification. Response: {response.status}, {response.text}")
+            print(f"Failed to queue Webhook notification for Lambda function: {function_name}")
 
     except Exception as webhook_error:
-        print(f"Failed to send failure notification via Webhook: {webhook_error}")
+        print(f"Failed to queue failure notification for the Webhook: {webhook_error}")
 
+@metrics.timed('handler')
 def lambda_handler(event, context):
     function_name = context.function_name
     try:
@@ -81,11 +166,12 @@ def lambda_handler(event, context):
         # target_table name in the active table config, it would need to be a_table_name. So we basically matching
         # the source system name to the first instance of the table name and stripping it from the table name
         # then replacing that with a a_ to generate the input table name. 
-        match = re.match(r'^(.*?) table processed: (.*?) in (.*?)$', sns_message)
-        if match:
-            source_system_name = match.group(1).strip()
-            original_table_name = match.group(2).strip()
-            env = match.group(3).strip()
+        with metrics.stage('parse_event'):
+            pipeline_event = parse_pipeline_event(sns_message)
+        if pipeline_event.kind == TABLE_PROCESSED:
+            source_system_name = pipeline_event.source_system_name
+            original_table_name = pipeline_event.table_name
+            env = pipeline_event.env
             print(f"This is the source_system_name received by sns --> {source_system_name}")
             print(f"This is the table name received by sns --> {original_table_name}")
             print(f"This is the environment received by sns --> {env}")
@@ -106,9 +192,8 @@ def lambda_handler(event, context):
                 'body': json.dumps(f"The source system name '{source_system_name}' doesn't match what's found in the table name: {original_table_name}.")
             }
     
-        match_table = re.search(fr'{source_system_name}_(\w+)', original_table_name)
-        if match_table:
-            extracted_table_name = match_table.group(1)
+        extracted_table_name = pipeline_event.extracted_table_name
+        if extracted_table_name:
             print("Extracted table_name:", extracted_table_name)
             a_add_table = f'a_{extracted_table_name}'
             print("Correct table_name:", a_add_table)
@@ -154,17 +239,58 @@ def lambda_handler(event, context):
         
         stepfunctions_client = boto3.client('stepfunctions')
 
-        unique_id = str(uuid.uuid4().hex)[:10]
-        date_suffix = datetime.now().strftime("%Y%m%d%H")
-        table_name = a_add_table[:60]
-        execution_name = f"{table_name}_{date_suffix}_{unique_id}"
+        identity = execution_identity(event, pipeline_event)
+        if identity:
+            execution_name = deterministic_execution_name(a_add_table, active_table_step_function_arn, identity)
+        else:
+            # Hand-made test events have no MessageId, keep the old unique naming for those
+            unique_id = str(uuid.uuid4().hex)[:10]
+            date_suffix = datetime.now().strftime("%Y%m%d%H")
+            table_name = a_add_table[:60]
+            execution_name = f"{table_name}_{date_suffix}_{unique_id}"
+        dedupe_key = f"{active_table_step_function_arn}#{execution_name}"
+
+        if identity and _seen_recently(dedupe_key):
+            print(f"Duplicate delivery, execution {execution_name} was already started by this container.")
+            metrics.count('DuplicateStartsSkipped')
+            return {
+                'statusCode': 200,
+                'body': json.dumps(f"Execution {execution_name} already started.")
+            }
+        if identity and already_started(dedupe_key):
+            print(f"Duplicate delivery, execution {execution_name} was already started.")
+            _remember_start(dedupe_key)
+            metrics.count('DuplicateStartsSkipped')
+            return {
+                'statusCode': 200,
+                'body': json.dumps(f"Execution {execution_name} already started.")
+            }
 
         # Pass the input payload to the second Step Function
-        response = stepfunctions_client.start_execution(
-            stateMachineArn=active_table_step_function_arn,
-            name=execution_name,
-            input=json.dumps(input_payload)
-        )
+        try:
+            with metrics.stage('start_execution', source_system_name=source_system_name, table_name=a_add_table):
+                if glue_admission_control.enabled():
+                    # Started now if the environment has the Glue DPUs for it, otherwise queued until it has
+                    outcome = glue_admission_control.launch(
+                        stepfunctions_client, active_table_step_function_arn, execution_name,
+                        input_payload, source_system_name, a_add_table
+                    )
+                    print(f"Admission control outcome for {execution_name}: {outcome}")
+                else:
+                    response = stepfunctions_client.start_execution(
+                        stateMachineArn=active_table_step_function_arn,
+                        name=execution_name,
+                        input=json.dumps(input_payload)
+                    )
+        except ClientError as error:
+            if error.response['Error']['Code'] != 'ExecutionAlreadyExists':
+                raise
+            # Another delivery got there first, the execution this message asks for exists
+            print(f"Execution {execution_name} already exists, nothing to start.")
+            metrics.count('DuplicateStartsSkipped')
+        if identity:
+            record_start(dedupe_key, execution_name, active_table_step_function_arn)
+            _remember_start(dedupe_key)
 
         
         return {
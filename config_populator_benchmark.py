@@ -0,0 +1,182 @@
+# The purpose of the following code is to benchmark config_table_populator end to end without Athena:
+# statement generation and the apply for configs of 10 to 10,000 tables, with the generated SQL run by the
+# SQLite stand-in (sqlite_query_executor) and every other AWS call answered by moto through lambda_harness.
+#
+# For every size the benchmark:
+#   1. builds a config with that many tables from config_file_sample.json,
+#   2. times build_rows + render_statements + insert_queries (best of --repeat runs, the generator's hot path),
+#   3. invokes the Lambda handler twice with the S3 event of the uploaded config and checks the control tables
+#      hold exactly one row per table after each run (the DELETEs and INSERTs really replace the rows).
+# With --baseline a previous --report-json is compared and the run fails when generation got slower than
+# --max-regression times the baseline.
+#
+# Example usage:
+#   python config_populator_benchmark.py
+#   python config_populator_benchmark.py --sizes 10 1000 10000 --report-json benchmark.json
+#   python config_populator_benchmark.py --baseline benchmark.json --max-regression 1.3
+
+import lambda_harness
+
+import argparse
+import contextlib
+import copy
+import io
+import json
+import sys
+import time
+
+import boto3
+from moto import mock_aws
+
+from sqlite_query_executor import SQLiteQueryExecutor
+
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+
+
+def scaled_config(size):
+    """
+    The harness config with `size` tables per environment, made by repeating the sample tables under new names.
+    """
+    config = lambda_harness.synthetic_config()
+    for env_config in config['environments'].values():
+        templates = env_config['tables']
+        tables = []
+        for index in range(size):
+            table = copy.deepcopy(templates[index % len(templates)])
+            table['table_name'] = f"{table['table_name']}_{index}"
+            tables.append(table)
+        env_config['tables'] = tables
+    return config
+
+def time_generation(populator, config, repeat):
+    """
+    Best wall time of generating every statement of the config the way the handler does.
+    Returns:
+        tuple: (seconds, number of queries, bytes of SQL)
+    """
+    best = None
+    for _ in range(repeat):
+        env_config = copy.deepcopy(config['environments'][populator.current_env])
+        source_name = config['source_name']
+        started = time.perf_counter()
+        populator.default_global_ingest_config(env_config['global_ingestion_config'])
+        populator.default_global_active_table_config(env_config['global_active_table_config'], source_name)
+        generic_file_loads_rows, active_table_rows = populator.build_rows(
+            env_config, env_config['global_ingestion_config'], env_config['global_active_table_config'],
+            populator.current_env, source_name
+        )
+        delete_statements, generic_selects, active_selects = populator.render_statements(
+            generic_file_loads_rows, active_table_rows, True, source_name
+        )
+        queries = (
+            delete_statements
+            + populator.insert_queries('data_control.edp_generic_file_loads', generic_selects)
+            + populator.insert_queries('data_control.active_table_job_config_attributes_iceberg', active_selects)
+        )
+        seconds = time.perf_counter() - started
+        best = seconds if best is None else min(best, seconds)
+    return best, len(queries), sum(len(query.encode('utf-8')) for query in queries)
+
+def run_size(populator, executor, size, repeat, verbose=False):
+    config = scaled_config(size)
+    env_config = config['environments'][populator.current_env]
+    expected_generic = len(env_config['tables'])
+    expected_active = sum('active_table_config' in table for table in env_config['tables'])
+    generate_seconds, queries, sql_bytes = time_generation(populator, config, repeat)
+
+    body = json.dumps(config).encode('utf-8')
+    key = f"config/{config['source_name']}/benchmark_{size}.json"
+    boto3.client('s3').put_object(Bucket=lambda_harness.CONFIG_BUCKET, Key=key, Body=body)
+    event = lambda_harness.s3_put_event(lambda_harness.CONFIG_BUCKET, key, len(body))
+
+    handler_seconds = []
+    problems = []
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    for attempt in range(2):
+        executor.seconds.clear()
+        started = time.perf_counter()
+        with output:
+            response = populator.lambda_handler(event, lambda_harness.LambdaContext('config_table_populator'))
+        handler_seconds.append(time.perf_counter() - started)
+        if response['statusCode'] != 200:
+            problems.append(f"run {attempt + 1} returned {response}")
+        generic = executor.count('edp_generic_file_loads', source_system_name=config['source_name'])
+        active = executor.count('active_table_job_config_attributes_iceberg', src_system_name=config['source_name'])
+        if (generic, active) != (expected_generic, expected_active):
+            problems.append(f"run {attempt + 1}: {generic}/{active} rows, expected {expected_generic}/{expected_active}")
+    return {
+        'tables': size,
+        'generate_ms': round(generate_seconds * 1000, 2),
+        'generate_tables_per_second': round(size / generate_seconds) if generate_seconds else None,
+        'queries': queries,
+        'sql_kb': round(sql_bytes / 1024, 1),
+        'apply_ms': round(sum(executor.seconds.values()) * 1000, 2),
+        'handler_ms': round(min(handler_seconds) * 1000, 2),
+        'problems': problems
+    }
+
+def print_report(results):
+    header = f"{'tables':>8}{'generate ms':>14}{'tables/s':>12}{'queries':>9}{'SQL KB':>10}{'apply ms':>11}{'handler ms':>12}  check"
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        check = 'ok' if not result['problems'] else '; '.join(result['problems'])
+        print(
+            f"{result['tables']:>8}{result['generate_ms']:>14.2f}{result['generate_tables_per_second'] or 0:>12}"
+            f"{result['queries']:>9}{result['sql_kb']:>10.1f}{result['apply_ms']:>11.2f}{result['handler_ms']:>12.2f}  {check}"
+        )
+
+def regressions(results, baseline, max_regression):
+    """
+    Sizes whose generation time grew by more than max_regression times the baseline.
+    """
+    previous = {result['tables']: result for result in baseline['results']}
+    found = []
+    for result in results:
+        before = previous.get(result['tables'])
+        if before and result['generate_ms'] > before['generate_ms'] * max_regression:
+            found.append(f"{result['tables']} tables: {before['generate_ms']} ms -> {result['generate_ms']} ms")
+    return found
+
+def run_benchmark(sizes, repeat=3, verbose=False):
+    with mock_aws():
+        lambda_harness.create_resources()
+        counter = lambda_harness.ApiCallCounter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            populator, _ = lambda_harness.import_handler('config_table_populator', counter)
+        executor = SQLiteQueryExecutor(populator.CONTROL_TABLE_COLUMNS)
+        populator.set_query_executor(executor)
+        try:
+            return [run_size(populator, executor, size, repeat, verbose) for size in sizes]
+        finally:
+            populator.set_query_executor(None)
+            executor.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark config_table_populator offline with SQLite standing in for Athena.')
+    parser.add_argument('--sizes', nargs='+', type=int, default=DEFAULT_SIZES, help='Numbers of tables per config.')
+    parser.add_argument('--repeat', type=int, default=3, help='Generation runs per size, the best one is reported.')
+    parser.add_argument('--report-json', help='Write the results to this file.')
+    parser.add_argument('--baseline', help='Results of an earlier run to compare the generation times with.')
+    parser.add_argument('--max-regression', type=float, default=1.25, help='Allowed slowdown against the baseline.')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of the handler.')
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args.sizes, args.repeat, args.verbose)
+    print_report(results)
+    if args.report_json:
+        with open(args.report_json, 'w') as report_file:
+            json.dump({'results': results}, report_file, indent=2)
+
+    failed = any(result['problems'] for result in results)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            slower = regressions(results, json.load(baseline_file), args.max_regression)
+        for regression in slower:
+            print(f"Regression: {regression}")
+        failed = failed or bool(slower)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
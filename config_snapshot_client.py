@@ -0,0 +1,151 @@
+# The purpose of the following code is to give Lambdas and Step Function tasks a fast way to read the
+# control table configuration (data_control.edp_generic_file_loads and
+# data_control.active_table_job_config_attributes_iceberg) without running an Athena query.
+#
+# After every successful apply config_table_populator publishes a compact JSON snapshot of the rows it
+# wrote for the source system, then moves the source's pointer to it:
+#   s3://<bucket>/config-snapshots/<env>/<source_system_name>/<version>.json   -> immutable snapshot
+#   s3://<bucket>/config-snapshots/<env>/<source_system_name>/current.json     -> {"version": ..., "key": ...}
+# A snapshot holds the rows of both tables keyed by table:
+#   {"version": ..., "source_system_name": ..., "environment": ..., "published_at": ...,
+#    "edp_generic_file_loads": {"<source_file_name_pk>": {...row...}},
+#    "active_table_job_config_attributes_iceberg": {"<tgt_table_name>": {...row...}}}
+#
+# ConfigSnapshotClient keeps the snapshots in memory across warm invocations. At most every
+# max_age_seconds it checks the pointer with a conditional GET (If-None-Match on the ETag it holds), which is
+# answered with 304 Not Modified until the populator publishes again, and only then downloads the new snapshot.
+#
+# Example usage:
+#   client = get_client()
+#   row = client.active_table_config('grandcentral', 'a_account')
+#   worker_type, worker_num = row['worker_type'], row['worker_num']
+
+import json
+import os
+import threading
+import time
+
+import boto3
+from botocore.exceptions import ClientError
+
+SNAPSHOT_BUCKET = os.environ.get('CONFIG_SNAPSHOT_BUCKET', '')
+SNAPSHOT_ENV = os.environ.get('CONFIG_SNAPSHOT_ENV', '')
+SNAPSHOT_PREFIX = 'config-snapshots'
+MAX_AGE_SECONDS = float(os.environ.get('CONFIG_SNAPSHOT_MAX_AGE_SECONDS', '60'))
+
+GENERIC_FILE_LOADS = 'edp_generic_file_loads'
+ACTIVE_TABLE_CONFIG = 'active_table_job_config_attributes_iceberg'
+
+_client = None
+
+
+def source_prefix(environment, source_system_name):
+    return f"{SNAPSHOT_PREFIX}/{environment}/{source_system_name}/"
+
+def pointer_key(environment, source_system_name):
+    return f"{source_prefix(environment, source_system_name)}current.json"
+
+def snapshot_key(environment, source_system_name, version):
+    return f"{source_prefix(environment, source_system_name)}{version}.json"
+
+def build_snapshot(version, environment, source_system_name, generic_file_loads_rows, active_table_rows, published_at):
+    """
+    Build the snapshot document from the rows written to the control tables.
+    Returns:
+        dict: The snapshot.
+    """
+    return {
+        'version': version,
+        'source_system_name': source_system_name,
+        'environment': environment,
+        'published_at': published_at,
+        GENERIC_FILE_LOADS: {row['source_file_name_pk']: row for row in generic_file_loads_rows},
+        ACTIVE_TABLE_CONFIG: {row['tgt_table_name']: row for row in active_table_rows}
+    }
+
+
+class ConfigSnapshotClient:
+    """
+    In-memory cache of the published config snapshots, refreshed only when a source's pointer changes.
+    """
+
+    def __init__(self, bucket, environment, s3_client=None, max_age_seconds=MAX_AGE_SECONDS):
+        self.bucket = bucket
+        self.environment = environment
+        self.s3_client = s3_client or boto3.client('s3')
+        self.max_age_seconds = max_age_seconds
+        # source_system_name -> {'pointer_etag': ..., 'checked_at': ..., 'snapshot': ...}
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _refresh(self, source_system_name, cached):
+        request = {'Bucket': self.bucket, 'Key': pointer_key(self.environment, source_system_name)}
+        if cached:
+            request['IfNoneMatch'] = cached['pointer_etag']
+        try:
+            response = self.s3_client.get_object(**request)
+        except ClientError as error:
+            code = error.response['Error']['Code']
+            if cached and code in ('304', 'NotModified'):
+                cached['checked_at'] = time.monotonic()
+                return cached
+            if code in ('NoSuchKey', '404'):
+                return None
+            raise
+
+        pointer = json.loads(response['Body'].read())
+        if cached and cached['snapshot']['version'] == pointer['version']:
+            snapshot = cached['snapshot']
+        else:
+            snapshot = json.loads(self.s3_client.get_object(Bucket=self.bucket, Key=pointer['key'])['Body'].read())
+            print(f"Loaded config snapshot {pointer['version']} for {source_system_name}")
+        return {'pointer_etag': response['ETag'], 'checked_at': time.monotonic(), 'snapshot': snapshot}
+
+    def snapshot(self, source_system_name):
+        """
+        The current snapshot of a source system, None if none has been published.
+        """
+        with self._lock:
+            cached = self._cache.get(source_system_name)
+            if cached and time.monotonic() - cached['checked_at'] < self.max_age_seconds:
+                return cached['snapshot']
+            entry = self._refresh(source_system_name, cached)
+            if entry is None:
+                self._cache.pop(source_system_name, None)
+                return None
+            self._cache[source_system_name] = entry
+            return entry['snapshot']
+
+    def table_config(self, source_system_name, table_name):
+        """
+        The edp_generic_file_loads row of a table (source_file_name_pk), None if it isn't configured.
+        """
+        snapshot = self.snapshot(source_system_name)
+        return snapshot[GENERIC_FILE_LOADS].get(table_name) if snapshot else None
+
+    def active_table_config(self, source_system_name, tgt_table_name):
+        """
+        The active_table_job_config_attributes_iceberg row of an active table (e.g. a_account), None if it isn't configured.
+        """
+        snapshot = self.snapshot(source_system_name)
+        return snapshot[ACTIVE_TABLE_CONFIG].get(tgt_table_name) if snapshot else None
+
+    def invalidate(self, source_system_name=None):
+        with self._lock:
+            if source_system_name is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(source_system_name, None)
+
+
+def get_client():
+    """
+    The client for CONFIG_SNAPSHOT_BUCKET / CONFIG_SNAPSHOT_ENV, created once per container so the cache
+    survives warm invocations.
+    """
+    global _client
+    if _client is None:
+        if not SNAPSHOT_BUCKET or not SNAPSHOT_ENV:
+            raise ValueError("CONFIG_SNAPSHOT_BUCKET and CONFIG_SNAPSHOT_ENV must be set to read the config snapshots.")
+        _client = ConfigSnapshotClient(SNAPSHOT_BUCKET, SNAPSHOT_ENV)
+    return _client
@@ -1,22 +1,30 @@
 import json
 import boto3
 import time
+import hashlib
+import os
 from datetime import datetime
 import dateutil.tz
 import logging
-import urllib3
+from teams_notification_queue import LAMBDA_FAILURES_WEBHOOK, enqueue_notification
+from pipeline_metrics import PipelineMetrics
+from config_snapshot_client import build_snapshot, pointer_key, snapshot_key
 MAX_RETRIES = 3
 WAIT_TIME_SECONDS = 10
+# The SELECTs of a table are combined into INSERT ... UNION ALL queries of at most this many bytes, Athena
+# rejects query strings over 256 KB
+MAX_INSERT_QUERY_BYTES = 255 * 1024
+# Bucket the config snapshots are published to, defaults to the bucket the config file arrived in
+CONFIG_SNAPSHOT_BUCKET = os.environ.get('CONFIG_SNAPSHOT_BUCKET', '')
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-http = urllib3.PoolManager()
+metrics = PipelineMetrics('config_table_populator')
 
 def send_lambda_failure_notification(function_name, error_message):
     try:
         print('In failure notification definition using webhook...')
-        webhook_url = "https://libertyholdings.webhook.office.com/webhookb2/84ae269b-3328-4244-9c58-87c0541029c0@66b8ffa6-81c0-4ea6-93fb-06f390dc67f6/IncomingWebhook/1c7314d5bffd4561aa4d694641deb2f3/540ec8e7-b8ad-4612-9c4a-140cef8ece9c/V2D2XxrsBWC76nparKmE63SCKVqIts7TmneUOC8PDMJOk1"
         payload = {
             "title": f"Lambda Failure Notification : {function_name}",
             "text": (
@@ -26,19 +34,14 @@ def send_lambda_failure_notification(function_name, error_message):
                 f"Please investigate the issue and check CloudWatch logs for more details."
             )
         }
-        encoded_payload = json.dumps(payload).encode('utf-8')
-        # Send POST request to the Webhook URL
-        
-        response = http.request('POST', webhook_url, body=encoded_payload, headers={'Content-Type': 'application/json'})
-
-        # Log success or failure
-        if response.status == 200:
-            print(f"Webhook notification sent successfully for Lambda function: {function_name}")
+        # Queue the notification, the teams_notification_sender Lambda posts it to the Webhook URL
+        if enqueue_notification(LAMBDA_FAILURES_WEBHOOK, payload, function_name):
+            print(f"Webhook notification queued for Lambda function: {function_name}")
         else:
-            print(f"Failed to send Webhook notification. Response: {response.status}, {response.text}")
+            print(f"Failed to queue Webhook notification for Lambda function: {function_name}")
 
     except Exception as webhook_error:
-        print(f"Failed to send failure notification via Webhook: {webhook_error}")
+        print(f"Failed to queue failure notification for the Webhook: {webhook_error}")
 
 def get_account_id():
     """
@@ -114,9 +117,32 @@ def default_table_config(table):
     table['ingestion_config'].setdefault('source_file_header_file_exist', 'N')
     table['ingestion_config'].setdefault('enabled_flag', 'Y')
 
-def generate_statements(env_config, global_ingest_config, global_active_table_config, env_name, source_name):
+# Column layout of the two control tables. 'text' values are quoted, 'number' values are written as they
+# are and 'optional' values are NULL when missing, otherwise written with repr().
+GENERIC_FILE_LOADS_COLUMNS = [
+    ('source_file_name_pk', 'text'), ('source_system_name', 'text'), ('source_file_type', 'text'),
+    ('source_file_location', 'text'), ('source_file_name_wild_card', 'text'), ('source_file_date_format', 'text'),
+    ('source_file_extension', 'text'), ('source_file_delimiter', 'text'), ('source_file_header_row_exist', 'text'),
+    ('source_file_header_file_exist', 'text'), ('source_file_column_names', 'text'), ('source_file_unique_key_cols', 'text'),
+    ('load_frequency', 'text'), ('target_database', 'text'), ('target_table_name', 'text'), ('target_s3_location', 'text'),
+    ('truncate_table_flag', 'text'), ('drop_table_flag', 'text'), ('enabled_flag', 'text'), ('partition_columns', 'text'),
+    ('job_template_name', 'text'), ('soft_rule_template_name', 'text'), ('source_file_control_footer_exist', 'text'),
+    ('environment', 'text'), ('control_file_ind', 'text'), ('insert_datetime', 'text'), ('worker_type', 'text'),
+    ('worker_num', 'number'), ('control_file_header_row_exist', 'optional'), ('control_file_columns_names', 'optional')
+]
+
+ACTIVE_TABLE_COLUMNS = [
+    ('src_system_name', 'text'), ('tgt_table_name', 'text'), ('tgt_database_name', 'text'), ('tgt_location', 'text'),
+    ('soft_rule_template_name', 'text'), ('src_database_name', 'text'), ('src_table_name', 'text'), ('key_cols', 'text'),
+    ('order_cols', 'text'), ('filter_condition', 'text'), ('sort_order', 'text'), ('job_template_name', 'text'),
+    ('group_number', 'text'), ('change_audit_flag', 'text'), ('ignore_column', 'text'), ('enabled_flag', 'text'),
+    ('contract_sync_flag', 'text'), ('incremental_column_name', 'text'), ('order_cols_1', 'text'), ('order_cols_2', 'text'),
+    ('worker_type', 'text'), ('worker_num', 'number')
+]
+
+def build_rows(env_config, global_ingest_config, global_active_table_config, env_name, source_name):
     """
-    Generate DELETE and INSERT statements for tables based on environment configuration.
+    Build the control table rows for every table of the environment configuration.
     Args:
         env_config (dict): Environment configuration.
         global_ingest_config (dict): Global ingestion configuration.
@@ -124,20 +150,11 @@ def generate_statements(env_config, global_ingest_config, global_active_table_co
         env_name (str): Name of the environment.
         source_name (str): Name of the data source.
     Returns:
-        tuple: A tuple containing the delete and insert statements.
+        tuple: (edp_generic_file_loads rows, active_table_job_config_attributes_iceberg rows), each a list of
+        dictionaries of column name -> value in the column order of the table.
     """
-    delete_statements = []
-    generic_file_loads_insert_statements = []
-    active_table_insert_statements = []
-
-    delete_edp_query = f"DELETE FROM data_control.edp_generic_file_loads WHERE source_system_name = '{source_name}';"
-    delete_statements.append(delete_edp_query)
-    
-    active_table_config_present = 'global_active_table_config' in env_config and any('active_table_config' in table for table in env_config['tables'])
-    
-    if active_table_config_present:
-        delete_active_table_query = f"DELETE FROM data_control.active_table_job_config_attributes_iceberg WHERE src_system_name = '{source_name}';"
-        delete_statements.append(delete_active_table_query)
+    generic_file_loads_rows = []
+    active_table_rows = []
 
     for table in env_config['tables']:
         default_table_config(table)
@@ -175,76 +192,158 @@ def generate_statements(env_config, global_ingest_config, global_active_table_co
         else:
             target_s3_location = f"s3://ct-ire-edp-{changeaudit_env}-datastaging-op/changeaudit/{source_name}/{table_name}"
         
-        # New optional fields
-        control_file_header_row_exist = ingest_config.get('control_file_header_row_exist', None)
-        control_file_columns_names = ingest_config.get('control_file_columns_names', None)
-        generic_file_loads_insert = (
-            f"SELECT "
-            f"'{table['table_name']}' AS source_file_name_pk, "
-            f"'{source_name}' AS source_system_name, "
-            f"'{ingest_config['source_file_type']}' AS source_file_type, "
-            f"'{full_source_file_location}' AS source_file_location, "
-            f"'{ingest_config['source_file_name_wild_card']}' AS source_file_name_wild_card, "
-            f"'{ingest_config['source_file_date_format']}' AS source_file_date_format, "
-            f"'{ingest_config['source_file_extension']}' AS source_file_extension, "
-            f"'{ingest_config['source_file_delimiter']}' AS source_file_delimiter, "
-            f"'{ingest_config['source_file_header_row_exist']}' AS source_file_header_row_exist, "
-            f"'{ingest_config['source_file_header_file_exist']}' AS source_file_header_file_exist, "
-            f"'{column_names_str}' AS source_file_column_names, "
-            f"'{ingest_config['source_file_unique_key_cols']}' AS source_file_unique_key_cols, "
-            f"'{ingest_config['load_frequency']}' AS load_frequency, "
-            f"'{global_ingest_config['target_database']}' AS target_database, "
-            f"'{source_name}_{table['table_name']}' AS target_table_name, "
-            f"'{target_s3_location}' AS target_s3_location, "
-            f"'{global_ingest_config['truncate_table_flag']}' AS truncate_table_flag, "
-            f"'{global_ingest_config['drop_table_flag']}' AS drop_table_flag, "
-            f"'{ingest_config['enabled_flag']}' AS enabled_flag, "
-            f"'{ingest_config['partition_columns']}' AS partition_columns, "
-            f"'{ingest_config.get('job_template_name', ' ')}' AS job_template_name, "
-            f"'{global_ingest_config['soft_rule_template_name']}' AS soft_rule_template_name, "
-            f"'{ingest_config.get('source_file_control_footer_exist', '')}' AS source_file_control_footer_exist, "
-            f"'{env_name}' AS environment, "
-            f"'{ingest_config.get('control_file_ind', 'N')}' AS control_file_ind, "
-            f"'{insert_datetime}' AS insert_datetime, "
-            f"'{ingest_config['worker_type']}' AS worker_type, "
-            f"{ingest_config['worker_num']} AS worker_num, "
-            f"{'NULL' if control_file_header_row_exist is None else repr(control_file_header_row_exist)} AS control_file_header_row_exist, "
-            f"{'NULL' if control_file_columns_names is None else repr(control_file_columns_names)} AS control_file_columns_names "
-        )
-
-        generic_file_loads_insert_statements.append(generic_file_loads_insert)
+        generic_file_loads_rows.append({
+            'source_file_name_pk': table['table_name'],
+            'source_system_name': source_name,
+            'source_file_type': ingest_config['source_file_type'],
+            'source_file_location': full_source_file_location,
+            'source_file_name_wild_card': ingest_config['source_file_name_wild_card'],
+            'source_file_date_format': ingest_config['source_file_date_format'],
+            'source_file_extension': ingest_config['source_file_extension'],
+            'source_file_delimiter': ingest_config['source_file_delimiter'],
+            'source_file_header_row_exist': ingest_config['source_file_header_row_exist'],
+            'source_file_header_file_exist': ingest_config['source_file_header_file_exist'],
+            'source_file_column_names': column_names_str,
+            'source_file_unique_key_cols': ingest_config['source_file_unique_key_cols'],
+            'load_frequency': ingest_config['load_frequency'],
+            'target_database': global_ingest_config['target_database'],
+            'target_table_name': f"{source_name}_{table['table_name']}",
+            'target_s3_location': target_s3_location,
+            'truncate_table_flag': global_ingest_config['truncate_table_flag'],
+            'drop_table_flag': global_ingest_config['drop_table_flag'],
+            'enabled_flag': ingest_config['enabled_flag'],
+            'partition_columns': ingest_config['partition_columns'],
+            'job_template_name': ingest_config.get('job_template_name', ' '),
+            'soft_rule_template_name': global_ingest_config['soft_rule_template_name'],
+            'source_file_control_footer_exist': ingest_config.get('source_file_control_footer_exist', ''),
+            'environment': env_name,
+            'control_file_ind': ingest_config.get('control_file_ind', 'N'),
+            'insert_datetime': insert_datetime,
+            'worker_type': ingest_config['worker_type'],
+            'worker_num': ingest_config['worker_num'],
+            # New optional fields
+            'control_file_header_row_exist': ingest_config.get('control_file_header_row_exist', None),
+            'control_file_columns_names': ingest_config.get('control_file_columns_names', None)
+        })
 
         if 'active_table_config' in table:
-            active_table_insert = (
-                f"SELECT "
-                f"'{global_active_table_config['src_system_name']}' AS src_system_name, "
-                f"'{table['active_table_config']['tgt_table_name']}' AS tgt_table_name, "
-                f"'{global_active_table_config['tgt_database_name']}' AS tgt_database_name, "
-                f"'{tgt_location}' AS tgt_location, "
-                f"'{table['active_table_config']['soft_rule_template_name']}' AS soft_rule_template_name, "
-                f"'{global_active_table_config['src_database_name']}' AS src_database_name, "
-                f"'{source_name}_{table['active_table_config']['src_table_name']}' AS src_table_name, "
-                f"'{table['active_table_config']['key_cols']}' AS key_cols, "
-                f"'{table['active_table_config']['order_cols']}' AS order_cols, "
-                f"'{table['active_table_config']['filter_condition']}' AS filter_condition, "
-                f"'{table['active_table_config']['sort_order']}' AS sort_order, "
-                f"'{global_active_table_config['job_template_name']}' AS job_template_name, "
-                f"'{table['active_table_config']['group_number']}' AS group_number, "
-                f"'{table['active_table_config']['change_audit_flag']}' AS change_audit_flag, "
-                f"'{', '.join(global_active_table_config['ignore_column'])}' AS ignore_column, "
-                f"'{ingest_config['enabled_flag']}' AS enabled_flag, "
-                f"'{global_active_table_config['contract_sync_flag']}' AS contract_sync_flag, "
-                f"'{table['active_table_config']['incremental_column_name']}' AS incremental_column_name, "
-                f"'{table['active_table_config']['order_cols_1']}' AS order_cols_1, "
-                f"'{table['active_table_config']['order_cols_2']}' AS order_cols_2, "
-                f"'{table['active_table_config']['worker_type']}' AS worker_type, "
-                f"{table['active_table_config']['worker_num']} AS worker_num "
-            )
+            active_table_config = table['active_table_config']
+            active_table_rows.append({
+                'src_system_name': global_active_table_config['src_system_name'],
+                'tgt_table_name': active_table_config['tgt_table_name'],
+                'tgt_database_name': global_active_table_config['tgt_database_name'],
+                'tgt_location': tgt_location,
+                'soft_rule_template_name': active_table_config['soft_rule_template_name'],
+                'src_database_name': global_active_table_config['src_database_name'],
+                'src_table_name': f"{source_name}_{active_table_config['src_table_name']}",
+                'key_cols': active_table_config['key_cols'],
+                'order_cols': active_table_config['order_cols'],
+                'filter_condition': active_table_config['filter_condition'],
+                'sort_order': active_table_config['sort_order'],
+                'job_template_name': global_active_table_config['job_template_name'],
+                'group_number': active_table_config['group_number'],
+                'change_audit_flag': active_table_config['change_audit_flag'],
+                'ignore_column': ', '.join(global_active_table_config['ignore_column']),
+                'enabled_flag': ingest_config['enabled_flag'],
+                'contract_sync_flag': global_active_table_config['contract_sync_flag'],
+                'incremental_column_name': active_table_config['incremental_column_name'],
+                'order_cols_1': active_table_config['order_cols_1'],
+                'order_cols_2': active_table_config['order_cols_2'],
+                'worker_type': active_table_config['worker_type'],
+                'worker_num': active_table_config['worker_num']
+            })
+
+    return generic_file_loads_rows, active_table_rows
+
+def render_select(row, columns):
+    """
+    Render a row as the "SELECT '<value>' AS <column>, ..." statement used in the INSERT ... UNION ALL queries.
+    Args:
+        row (dict): Column name -> value.
+        columns (list): (column name, kind) tuples in table order.
+    Returns:
+        str: The SELECT statement.
+    """
+    fragments = []
+    for column, kind in columns:
+        value = row[column]
+        if kind == 'number':
+            fragments.append(f"{value} AS {column}")
+        elif kind == 'optional':
+            fragments.append(f"{'NULL' if value is None else repr(value)} AS {column}")
+        else:
+            fragments.append(f"'{value}' AS {column}")
+    return f"SELECT {', '.join(fragments)} "
+
+CONTROL_TABLE_COLUMNS = {
+    'edp_generic_file_loads': GENERIC_FILE_LOADS_COLUMNS,
+    'active_table_job_config_attributes_iceberg': ACTIVE_TABLE_COLUMNS
+}
 
-            active_table_insert_statements.append(active_table_insert)
+def render_statements(generic_file_loads_rows, active_table_rows, active_table_config_present, source_name):
+    """
+    Render the DELETE statements and the SELECT statements of the INSERT queries from the control table rows.
+    Returns:
+        tuple: A tuple containing the delete and insert statements.
+    """
+    delete_statements = []
+
+    delete_edp_query = f"DELETE FROM data_control.edp_generic_file_loads WHERE source_system_name = '{source_name}';"
+    delete_statements.append(delete_edp_query)
+
+    if active_table_config_present:
+        delete_active_table_query = f"DELETE FROM data_control.active_table_job_config_attributes_iceberg WHERE src_system_name = '{source_name}';"
+        delete_statements.append(delete_active_table_query)
+
+    generic_file_loads_insert_statements = [render_select(row, GENERIC_FILE_LOADS_COLUMNS) for row in generic_file_loads_rows]
+    active_table_insert_statements = [render_select(row, ACTIVE_TABLE_COLUMNS) for row in active_table_rows]
 
     return delete_statements, generic_file_loads_insert_statements, active_table_insert_statements
 
+def generate_statements(env_config, global_ingest_config, global_active_table_config, env_name, source_name):
+    """
+    Generate DELETE and INSERT statements for tables based on environment configuration.
+    Args:
+        env_config (dict): Environment configuration.
+        global_ingest_config (dict): Global ingestion configuration.
+        global_active_table_config (dict): Global active table configuration.
+        env_name (str): Name of the environment.
+        source_name (str): Name of the data source.
+    Returns:
+        tuple: A tuple containing the delete and insert statements.
+    """
+    active_table_config_present = 'global_active_table_config' in env_config and any('active_table_config' in table for table in env_config['tables'])
+    generic_file_loads_rows, active_table_rows = build_rows(
+        env_config, global_ingest_config, global_active_table_config, env_name, source_name
+    )
+    return render_statements(generic_file_loads_rows, active_table_rows, active_table_config_present, source_name)
+
+def insert_queries(table, select_statements, max_bytes=MAX_INSERT_QUERY_BYTES):
+    """
+    Combine the SELECT statements of a table into as few INSERT ... UNION ALL queries as the Athena query size allows.
+    Args:
+        table (str): Fully qualified table name, e.g. data_control.edp_generic_file_loads.
+        select_statements (list): Statements rendered by render_select.
+    Returns:
+        list: The INSERT queries, a single one unless the config is large.
+    """
+    prefix = f"INSERT INTO {table} "
+    separator = ' UNION ALL '
+    queries = []
+    chunk = []
+    size = len(prefix) + 1
+    for statement in select_statements:
+        statement_size = len(statement.encode('utf-8'))
+        if chunk and size + len(separator) + statement_size > max_bytes:
+            queries.append(f"{prefix}{separator.join(chunk)};")
+            chunk = []
+            size = len(prefix) + 1
+        size += statement_size + (len(separator) if chunk else 0)
+        chunk.append(statement)
+    if chunk:
+        queries.append(f"{prefix}{separator.join(chunk)};")
+    return queries
+
 def execute_athena_query(query, database, s3_output):
     """
     Execute Athena query.
@@ -268,17 +367,24 @@ def execute_athena_query(query, database, s3_output):
     query_execution_id = response['QueryExecutionId']
     
     # Wait for query to complete
-    while True:
-        query_status = athena_client.get_query_execution(QueryExecutionId=query_execution_id)
-        query_execution_status = query_status['QueryExecution']['Status']['State']
-        
-        if query_execution_status == 'SUCCEEDED':
-            print(f"Query SUCCEEDED: {query_execution_id}")
-            break
-        elif query_execution_status in ['FAILED', 'CANCELLED']:
-            print(f"Query {query_execution_status}: {query_execution_id}")
-            break
-        time.sleep(10)
+    with metrics.stage('athena_query', statement=' '.join(query.split()[:3]), query_execution_id=query_execution_id):
+        while True:
+            query_status = athena_client.get_query_execution(QueryExecutionId=query_execution_id)
+            query_execution_status = query_status['QueryExecution']['Status']['State']
+
+            if query_execution_status == 'SUCCEEDED':
+                print(f"Query SUCCEEDED: {query_execution_id}")
+                break
+            elif query_execution_status in ['FAILED', 'CANCELLED']:
+                print(f"Query {query_execution_status}: {query_execution_id}")
+                break
+            metrics.count('PollSleepSeconds', 10, 'Seconds')
+            time.sleep(10)
+
+        # Split the time Athena spent queueing from the time it spent running the query
+        statistics = query_status['QueryExecution'].get('Statistics', {})
+        metrics.count('AthenaQueueTime', statistics.get('QueryQueueTimeInMillis', 0), 'Milliseconds')
+        metrics.count('AthenaEngineTime', statistics.get('EngineExecutionTimeInMillis', 0), 'Milliseconds')
     
     return response, query_execution_id
 
@@ -298,8 +404,59 @@ def wait_for_athena_query(query_execution_id):
             else:
                 raise Exception(f"Query {query_execution_id} failed with status: {status}")
             break
+        metrics.count('PollSleepSeconds', 10, 'Seconds')
         time.sleep(10)
 
+class AthenaQueryExecutor:
+    """
+    Runs the generated statements with Athena, one at a time, waiting for each one to finish.
+    Any object with the same execute(query) method can stand in for it, see set_query_executor().
+    """
+
+    def __init__(self, database, s3_output):
+        self.database = database
+        self.s3_output = s3_output
+
+    def execute(self, query):
+        response, query_execution_id = execute_athena_query(query, self.database, self.s3_output)
+        if not query_execution_id:
+            raise Exception(f"The statement failed: {' '.join(query.split()[:4])}")
+        wait_for_athena_query(query_execution_id)  # Wait for the query to complete
+
+_query_executor = None
+
+def set_query_executor(executor):
+    """
+    Run the statements with another executor (e.g. sqlite_query_executor.SQLiteQueryExecutor), None for Athena.
+    """
+    global _query_executor
+    _query_executor = executor
+
+def get_query_executor():
+    return _query_executor or AthenaQueryExecutor('data_control', f's3://aws-athena-query-results-{account_id}-eu-west-1/')
+
+def publish_config_snapshot(s3_client, bucket, environment, source_name, generic_file_loads_rows, active_table_rows):
+    """
+    Publish the rows written for a source as a new snapshot version and point the source's pointer at it.
+    The snapshot is written first so readers never see a pointer to a missing snapshot.
+    Returns:
+        str: The snapshot version.
+    """
+    published_at = datetime.utcnow().isoformat() + 'Z'
+    digest = hashlib.sha256(json.dumps([generic_file_loads_rows, active_table_rows], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    version = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')}-{digest[:12]}"
+    snapshot = build_snapshot(version, environment, source_name, generic_file_loads_rows, active_table_rows, published_at)
+    key = snapshot_key(environment, source_name, version)
+    s3_client.put_object(Bucket=bucket, Key=key, Body=json.dumps(snapshot, default=str).encode('utf-8'), ContentType='application/json')
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=pointer_key(environment, source_name),
+        Body=json.dumps({'version': version, 'key': key, 'published_at': published_at}).encode('utf-8'),
+        ContentType='application/json'
+    )
+    print(f"Published config snapshot {version} for {source_name}: s3://{bucket}/{key}")
+    return version
+
 def check_timeout_and_notify(context):
     """Check remaining time and send notification if Lambda is close to timeout."""
     remaining_time = context.get_remaining_time_in_millis()
@@ -311,6 +468,7 @@ def check_timeout_and_notify(context):
         )
         raise Exception("Timeout warning raised.")
 
+@metrics.timed('handler')
 def lambda_handler(event, context):
     """
     Lambda function entry point.
@@ -331,10 +489,11 @@ def lambda_handler(event, context):
             print(f"Bucket name: {bucket_name}, File key: {file_key}")
             check_timeout_and_notify(context)
             # Read the JSON file from S3
-            s3_client = boto3.client('s3')
-            response = s3_client.get_object(Bucket=bucket_name, Key=file_key)
-            file_content = response['Body'].read().decode('utf-8')
-            json_content = json.loads(file_content)
+            with metrics.stage('read_config', file_key=file_key):
+                s3_client = boto3.client('s3')
+                response = s3_client.get_object(Bucket=bucket_name, Key=file_key)
+                file_content = response['Body'].read().decode('utf-8')
+                json_content = json.loads(file_content)
 
             # Process the JSON content
             print("Processing the JSON content received.")
@@ -354,51 +513,57 @@ def lambda_handler(event, context):
                         env_config['global_active_table_config'], json_content['source_name']
                     )
 
-                delete_statements, generic_file_loads_insert_statements, active_table_insert_statements = generate_statements(
-                    env_config,
-                    env_config['global_ingestion_config'],
-                    env_config['global_active_table_config'] if active_table_config_present else {},
-                    current_env,
-                    source_name
-                )
+                with metrics.stage('generate_statements', source_name=source_name):
+                    generic_file_loads_rows, active_table_rows = build_rows(
+                        env_config,
+                        env_config['global_ingestion_config'],
+                        env_config['global_active_table_config'] if active_table_config_present else {},
+                        current_env,
+                        source_name
+                    )
+                    delete_statements, generic_file_loads_insert_statements, active_table_insert_statements = render_statements(
+                        generic_file_loads_rows, active_table_rows, active_table_config_present, source_name
+                    )
+                    metrics.count('Tables', len(env_config['tables']))
 
-            database = 'data_control'
-            s3_output = f's3://aws-athena-query-results-{account_id}-eu-west-1/'
+            query_executor = get_query_executor()
 
             # Step 1: Execute Delete Statements and Wait for Completion
             print("Executing delete statements.")
             for statement in delete_statements:
-                response, query_execution_id = execute_athena_query(statement, database, s3_output)
-                if not query_execution_id:
-                    raise Exception(f"The DELETE statement failed: {statement}")
-                wait_for_athena_query(query_execution_id)  # Wait for the query to complete
+                query_executor.execute(statement)
                 print(f"DELETE statement completed successfully: {statement}")
 
             # Step 2: Execute Insert Statements for edp_generic_file_loads
             if generic_file_loads_insert_statements:
-                generic_file_loads_insert_query = (
-                    f"INSERT INTO data_control.edp_generic_file_loads "
-                    f"{' UNION ALL '.join(generic_file_loads_insert_statements)};"
-                )
-                print("Executing combined insert statements for edp_generic_file_loads.")
-                response, query_execution_id = execute_athena_query(generic_file_loads_insert_query, database, s3_output)
-                if not query_execution_id:
-                    raise Exception("The combined INSERT statement for edp_generic_file_loads failed.")
-                wait_for_athena_query(query_execution_id)  # Wait for the query to complete
+                generic_file_loads_insert_queries = insert_queries('data_control.edp_generic_file_loads', generic_file_loads_insert_statements)
+                print(f"Executing {len(generic_file_loads_insert_queries)} combined insert statements for edp_generic_file_loads.")
+                for query in generic_file_loads_insert_queries:
+                    query_executor.execute(query)
                 print(f"INSERT statement for edp_generic_file_loads completed successfully.")
 
             # Step 3: Execute Insert Statements for active_table_job_config_attributes_iceberg
             if active_table_config_present and active_table_insert_statements:
-                active_table_insert_query = (
-                    f"INSERT INTO data_control.active_table_job_config_attributes_iceberg "
-                    f"{' UNION ALL '.join(active_table_insert_statements)};"
-                )
-                print("Executing combined insert statements for active_table_job_config_attributes_iceberg.")
-                response, query_execution_id = execute_athena_query(active_table_insert_query, database, s3_output)
-                if not query_execution_id:
-                    raise Exception("The combined INSERT statement for active_table_job_config_attributes_iceberg failed.")
-                wait_for_athena_query(query_execution_id)  # Wait for the query to complete
+                active_table_insert_queries = insert_queries('data_control.active_table_job_config_attributes_iceberg', active_table_insert_statements)
+                print(f"Executing {len(active_table_insert_queries)} combined insert statements for active_table_job_config_attributes_iceberg.")
+                for query in active_table_insert_queries:
+                    query_executor.execute(query)
                 print(f"INSERT statement for active_table_job_config_attributes_iceberg completed successfully.")
+
+            # Step 4: Publish the snapshot of what was just written. The tables are already updated, so a
+            # failure here is reported but doesn't re-run the apply.
+            try:
+                with metrics.stage('publish_snapshot', source_name=source_name):
+                    publish_config_snapshot(
+                        s3_client, CONFIG_SNAPSHOT_BUCKET or bucket_name, current_env, source_name,
+                        generic_file_loads_rows, active_table_rows if active_table_config_present else []
+                    )
+            except Exception as snapshot_error:
+                print(f"Failed to publish the config snapshot: {snapshot_error}")
+                send_lambda_failure_notification(
+                    function_name=context.function_name,
+                    error_message=f"The control tables were updated but the config snapshot for {source_name} was not published: {snapshot_error}"
+                )
 		
             return {
                 'statusCode': 200,
@@ -412,6 +577,7 @@ def lambda_handler(event, context):
             if retries < MAX_RETRIES:
                 wait_time = WAIT_TIME_SECONDS * (2 ** retries)
                 print(f"Retrying {retries}/{MAX_RETRIES} after waiting {wait_time} seconds...")
+                metrics.count('RetrySleepSeconds', wait_time, 'Seconds')
                 time.sleep(wait_time)
             else:
                 print("Max retries reached. Processing failed.")
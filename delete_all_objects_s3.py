@@ -1,40 +1,217 @@
+# The purpose of the following code is to purge every object version and delete marker from a bucket
+# (by default the S3 access logs bucket) as quickly as S3 allows.
+#
+# The listing is sharded by prefix: the bucket is walked with Delimiter='/' down to --shard-depth levels
+# and every prefix found becomes a shard which is listed by its own worker. Levels above the leaves are
+# listed with the delimiter so the objects sitting directly under them are also covered exactly once.
+# Listed versions are deleted in batches of at most 1000 keys by a bounded pool of delete workers, which
+# share an adaptive backoff so they all slow down when S3 answers with SlowDown.
+#
+# With --journal the listing position of every shard is recorded in a local journal (see progress_journal.py).
+# Re-running with the same journal skips the shards which are done and resumes the others from their last
+# checkpoint. A page returns its versions and its delete markers as two lists, so the batches of a page are
+# not in listing order; the checkpoint is therefore only moved to the end of a page (its NextKeyMarker /
+# NextVersionIdMarker) once every batch of that page and of the pages before it has been deleted.
+# In inventory mode the finished batches themselves are journaled and skipped on a re-run.
+#
+# With --inventory-manifest the keys come from an S3 Inventory report (all versions) instead of LIST calls,
+# see s3_inventory.py. Versions written after the inventory was taken are not purged in that mode.
+#
+# Example usage:
+#   python delete_all_objects_s3.py --bucket ct-ire-edp-prd-s3-logs --dry-run
+#   python delete_all_objects_s3.py --bucket ct-ire-edp-prd-s3-logs --inventory-manifest s3://inventory-bucket/.../manifest.json
+#   python delete_all_objects_s3.py --bucket ct-ire-edp-prd-s3-logs --shard-depth 2 --delete-workers 32 --journal purge.journal
+
+import argparse
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
 import boto3
 
+from progress_journal import ProgressJournal
+from s3_inventory import iter_inventory_records
+from s3_batch_ops import (
+    BULK_CLIENT_CONFIG, MAX_DELETE_BATCH, AdaptiveBackoff, ProgressCounters,
+    delete_version_batch, iter_version_pages
+)
+
 bucket_name = 'ct-ire-edp-prd-s3-logs'
-s3 = boto3.client('s3')
-
-def delete_all_objects(bucket):
-    print(f"Starting deletion from bucket: {bucket}")
-    paginator = s3.get_paginator('list_object_versions')
-    to_delete = []
-
-    for page in paginator.paginate(Bucket=bucket):
-        versions = page.get('Versions', [])
-        delete_markers = page.get('DeleteMarkers', [])
-        all_versions = versions + delete_markers
-
-        for obj in all_versions:
-            key = obj['Key']
-            version_id = obj['VersionId']
-            print(f"Deleting: {key} (version: {version_id})")
-            to_delete.append({'Key': key, 'VersionId': version_id})
-
-        if len(to_delete) >= 1000:
-            _delete_batch(bucket, to_delete)
-            to_delete = []
-
-    if to_delete:
-        _delete_batch(bucket, to_delete)
-
-    print("Deletion complete.")
-
-def _delete_batch(bucket, objects):
-    response = s3.delete_objects(
-        Bucket=bucket,
-        Delete={'Objects': objects}
-    )
-    deleted = response.get('Deleted', [])
-    for obj in deleted:
-        print(f"Confirmed deleted: {obj['Key']} (version: {obj.get('VersionId', 'N/A')})")
-
-delete_all_objects(bucket_name)
+s3 = boto3.client('s3', config=BULK_CLIENT_CONFIG)
+
+
+def discover_shards(bucket, prefix='', depth=1):
+    """
+    Walk the bucket with Delimiter='/' to split the listing into independent shards.
+    Args:
+        bucket (str): Bucket to purge.
+        prefix (str): Prefix to start from.
+        depth (int): Number of levels to split on.
+    Returns:
+        list: (prefix, delimiter) tuples. A delimiter of '/' means only the keys directly under the prefix.
+    """
+    if depth <= 0:
+        return [(prefix, None)]
+
+    shards = [(prefix, '/')]
+    child_prefixes = []
+    for _, page in iter_version_pages(s3, bucket, prefix=prefix, delimiter='/'):
+        child_prefixes.extend(common_prefix['Prefix'] for common_prefix in page.get('CommonPrefixes', []))
+
+    for child_prefix in child_prefixes:
+        shards.extend(discover_shards(bucket, child_prefix, depth - 1))
+    return shards
+
+
+class PurgeEngine:
+    """
+    Lists the shards in parallel and feeds delete_objects batches to a bounded pool of delete workers.
+    """
+
+    def __init__(self, bucket, list_workers=8, delete_workers=16, dry_run=False, journal=None):
+        self.bucket = bucket
+        self.list_workers = list_workers
+        self.delete_workers = delete_workers
+        self.dry_run = dry_run
+        self.journal = journal
+        self.counters = ProgressCounters(f"purge {bucket}")
+        self.backoff = AdaptiveBackoff()
+        # Caps the number of batches waiting for a delete worker so memory stays bounded
+        self._in_flight = threading.BoundedSemaphore(delete_workers * 2)
+        self._delete_executor = None
+
+    def _delete(self, batch, watermark, ticket, batch_id=None):
+        try:
+            errors = delete_version_batch(s3, self.bucket, batch, self.backoff, self.counters)
+            self.counters.increment('batches')
+            # Batches with failed keys are left out of the journal so a resumed run tries them again
+            if self.journal and not errors:
+                if watermark:
+                    watermark.done(ticket)
+                else:
+                    self.journal.mark_batch_completed(batch_id, len(batch))
+        except Exception as error:
+            self.counters.increment('errors', len(batch))
+            print(f"Delete batch starting at {batch[0]['Key']} failed: {error}")
+        finally:
+            self._in_flight.release()
+
+    def _submit(self, batch, watermark, batch_id=None):
+        if self.dry_run:
+            self.counters.increment('would_delete', len(batch))
+            return
+        # The checkpoint only moves at page ends, see _purge_shard
+        ticket = watermark.emit(None) if watermark else None
+        self._in_flight.acquire()
+        self._delete_executor.submit(self._delete, batch, watermark, ticket, batch_id)
+
+    def _purge_shard(self, shard):
+        prefix, delimiter = shard
+        watermark = None
+        key_marker = version_id_marker = None
+        if self.journal and not self.dry_run:
+            watermark = self.journal.watermark(f"{prefix}|{delimiter or ''}")
+            if watermark.finished:
+                self.counters.increment('shards_already_done')
+                return
+            key_marker, version_id_marker = watermark.resume_from
+
+        pages = iter_version_pages(s3, self.bucket, prefix=prefix, delimiter=delimiter,
+                                   key_marker=key_marker, version_id_marker=version_id_marker)
+        for _, page in pages:
+            # Batches never span pages, so everything listed up to the page's next marker is covered by the
+            # batches emitted before the page end ticket below
+            batch = []
+            for obj in page.get('Versions', []) + page.get('DeleteMarkers', []):
+                batch.append({'Key': obj['Key'], 'VersionId': obj['VersionId']})
+                if len(batch) == MAX_DELETE_BATCH:
+                    self._submit(batch, watermark)
+                    batch = []
+            if batch:
+                self._submit(batch, watermark)
+            self.counters.increment('listed', len(page.get('Versions', [])) + len(page.get('DeleteMarkers', [])))
+            if watermark and page.get('IsTruncated'):
+                watermark.done(watermark.emit((page.get('NextKeyMarker'), page.get('NextVersionIdMarker'))))
+        if watermark:
+            watermark.finish_listing()
+        self.counters.increment('shards_done')
+
+    def run_inventory(self, manifest_location, prefix=''):
+        """
+        Purge the versions listed in an S3 Inventory report instead of listing the bucket.
+        """
+        print(f"Starting deletion from bucket: {self.bucket} using the inventory {manifest_location}")
+        with ThreadPoolExecutor(max_workers=self.delete_workers) as delete_executor:
+            self._delete_executor = delete_executor
+            for index, records in enumerate(iter_inventory_records(manifest_location, MAX_DELETE_BATCH, prefix=prefix)):
+                self.counters.increment('listed', len(records))
+                batch_id = f"inventory:{index}"
+                if self.journal and not self.dry_run and self.journal.is_batch_completed(batch_id):
+                    self.counters.increment('batches_already_done')
+                    continue
+                self._submit([{'Key': record['Key'], 'VersionId': record['VersionId']} for record in records], None, batch_id)
+        self.counters.report(force=True)
+        if self.journal:
+            self.journal.flush()
+        print("Dry run complete." if self.dry_run else "Deletion complete.")
+        return self.counters.snapshot()
+
+    def run(self, shards):
+        print(f"Starting deletion from bucket: {self.bucket} across {len(shards)} shard(s)")
+        with ThreadPoolExecutor(max_workers=self.delete_workers) as delete_executor:
+            self._delete_executor = delete_executor
+            with ThreadPoolExecutor(max_workers=self.list_workers) as list_executor:
+                futures = [list_executor.submit(self._purge_shard, shard) for shard in shards]
+                wait(futures)
+            for shard, future in zip(shards, futures):
+                if future.exception():
+                    self.counters.increment('shard_failures')
+                    print(f"Listing the shard {shard[0] or '(root)'} failed: {future.exception()}")
+        self.counters.report(force=True)
+        if self.journal:
+            self.journal.flush()
+        failed = self.counters.get('shard_failures')
+        if failed:
+            print(f"{failed} of {len(shards)} shard(s) failed, the purge is incomplete."
+                  + (" Re-run with the same --journal to resume." if self.journal else ""))
+        else:
+            print("Dry run complete." if self.dry_run else "Deletion complete.")
+        return self.counters.snapshot()
+
+
+def delete_all_objects(bucket, prefix='', shard_depth=1, list_workers=8, delete_workers=16, dry_run=False, journal_path=None,
+                       inventory_manifest=None):
+    source = f"inventory={inventory_manifest}" if inventory_manifest else f"depth={shard_depth}"
+    journal = ProgressJournal(journal_path, f"purge:{bucket}/{prefix}:{source}") if journal_path else None
+    if journal:
+        print(f"Using progress journal {journal_path}: {journal.summary()}")
+    try:
+        engine = PurgeEngine(bucket, list_workers, delete_workers, dry_run, journal)
+        if inventory_manifest:
+            return engine.run_inventory(inventory_manifest, prefix)
+        return engine.run(discover_shards(bucket, prefix, shard_depth))
+    finally:
+        if journal:
+            journal.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Delete every object version and delete marker in a bucket.')
+    parser.add_argument('--bucket', default=bucket_name)
+    parser.add_argument('--prefix', default='', help='Only purge keys under this prefix.')
+    parser.add_argument('--shard-depth', type=int, default=1, help='Number of "/" levels to shard the listing on.')
+    parser.add_argument('--list-workers', type=int, default=8)
+    parser.add_argument('--delete-workers', type=int, default=16)
+    parser.add_argument('--dry-run', action='store_true', help='List and count only, nothing is deleted.')
+    parser.add_argument('--journal', help='Progress journal file, re-use it to resume an interrupted purge.')
+    parser.add_argument('--inventory-manifest', help='S3 Inventory manifest.json (s3:// or local path) to take the versions from.')
+    args = parser.parse_args(argv)
+    counts = delete_all_objects(args.bucket, args.prefix, args.shard_depth, args.list_workers, args.delete_workers,
+                                args.dry_run, args.journal, args.inventory_manifest)
+    # A partial purge must not look like a successful one to whatever runs this script
+    if counts.get('shard_failures') or counts.get('errors'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
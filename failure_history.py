@@ -0,0 +1,266 @@
+# The purpose of the following code is to answer questions about pipeline failures from the DynamoDB table
+# which ms_teams_failure_notifications writes to, without scanning the whole table.
+#
+# Table layout (access pattern -> key used):
+#   failures for a Glue job run              -> table key:   job_run_id (HASH), table_name (RANGE)
+#   failures for a source on a day / range   -> GSI SOURCE_DATE_INDEX: source_system_name (HASH), date_inserted (RANGE)
+#   failure history of a single table        -> GSI TABLE_RUN_INDEX:   table_name (HASH), pipeline_run_date (RANGE)
+# Items carry an expires_at epoch attribute which DynamoDB TTL uses to drop old failures.
+# A failure without a JobRunID or Table is written with 'N/A#<SNS MessageId>' as that key value, so two of
+# them can't overwrite each other; the queries below report those as 'N/A'.
+# date_inserted is the Africa/Johannesburg date the failure was recorded on, the default date ranges use the same.
+#
+# Example usage:
+#   python failure_history.py --table non-prod-failures setup
+#   python failure_history.py --table non-prod-failures top-tables --source grandcentral --start 2024-01-01 --end 2024-01-31
+#   python failure_history.py --table non-prod-failures repeat-offenders --source grandcentral --start 2024-01-01 --min-days 3
+#   python failure_history.py --table non-prod-failures repeat-offenders --source grandcentral
+#   python failure_history.py --table non-prod-failures run jr_0a1b2c3d4e5f
+#   python failure_history.py --table non-prod-failures table grandcentral_account --since 2024-01-01
+
+import argparse
+import json
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+import boto3
+import dateutil.tz
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+SOURCE_DATE_INDEX = 'source_system_name-date_inserted-index'
+TABLE_RUN_INDEX = 'table_name-pipeline_run_date-index'
+TTL_ATTRIBUTE = 'expires_at'
+FAILURE_RETENTION_DAYS = 90
+# Written in front of the SNS MessageId when a key value is missing
+MISSING_KEY_PREFIX = 'N/A#'
+# Timezone ms_teams_failure_notifications writes date_inserted in
+LOCAL_TIMEZONE = dateutil.tz.gettz('Africa/Johannesburg')
+# Days repeat-offenders looks back over when no --start is given
+REPEAT_OFFENDER_DAYS = 14
+
+# Attributes copied into the indexes so the queries never have to go back to the table
+_INDEX_PROJECTION = {
+    'ProjectionType': 'INCLUDE',
+    'NonKeyAttributes': ['job_run_id', 'environment', 'error_message', 'glue_job_name']
+}
+
+_ATTRIBUTE_DEFINITIONS = [
+    {'AttributeName': 'job_run_id', 'AttributeType': 'S'},
+    {'AttributeName': 'table_name', 'AttributeType': 'S'},
+    {'AttributeName': 'source_system_name', 'AttributeType': 'S'},
+    {'AttributeName': 'date_inserted', 'AttributeType': 'S'},
+    {'AttributeName': 'pipeline_run_date', 'AttributeType': 'S'}
+]
+
+_GLOBAL_SECONDARY_INDEXES = [
+    {
+        'IndexName': SOURCE_DATE_INDEX,
+        'KeySchema': [
+            {'AttributeName': 'source_system_name', 'KeyType': 'HASH'},
+            {'AttributeName': 'date_inserted', 'KeyType': 'RANGE'}
+        ],
+        'Projection': _INDEX_PROJECTION
+    },
+    {
+        'IndexName': TABLE_RUN_INDEX,
+        'KeySchema': [
+            {'AttributeName': 'table_name', 'KeyType': 'HASH'},
+            {'AttributeName': 'pipeline_run_date', 'KeyType': 'RANGE'}
+        ],
+        'Projection': _INDEX_PROJECTION
+    }
+]
+
+def expires_at(now=None):
+    """
+    Epoch seconds after which DynamoDB TTL may delete a failure item.
+    """
+    return int(now if now is not None else time.time()) + FAILURE_RETENTION_DAYS * 24 * 60 * 60
+
+def local_date(days_ago=0):
+    """
+    The date_inserted (YYYY-MM-DD) of today, or of days_ago days before it.
+    """
+    return (datetime.now(tz=LOCAL_TIMEZONE) - timedelta(days=days_ago)).strftime('%Y-%m-%d')
+
+def key_value(value, message_id):
+    """
+    The value to write for a job_run_id or table_name key, unique per message when the value is missing.
+    """
+    return value if value else f"{MISSING_KEY_PREFIX}{message_id}"
+
+def display_key(value):
+    return 'N/A' if value.startswith(MISSING_KEY_PREFIX) else value
+
+def table_definition(table_name):
+    """
+    Build the create_table arguments for the failures table.
+    Args:
+        table_name (str): Name of the DynamoDB table.
+    Returns:
+        dict: Keyword arguments for DynamoDB.Client.create_table.
+    """
+    return {
+        'TableName': table_name,
+        'KeySchema': [
+            {'AttributeName': 'job_run_id', 'KeyType': 'HASH'},
+            {'AttributeName': 'table_name', 'KeyType': 'RANGE'}
+        ],
+        'AttributeDefinitions': _ATTRIBUTE_DEFINITIONS,
+        'GlobalSecondaryIndexes': _GLOBAL_SECONDARY_INDEXES,
+        'BillingMode': 'PAY_PER_REQUEST'
+    }
+
+def ensure_table_layout(table_name, dynamodb_client=None):
+    """
+    Create the failures table, or add the missing GSIs to an existing one, and enable TTL.
+    DynamoDB only allows one GSI to be created per update, so re-run this until it reports nothing to add.
+    Args:
+        table_name (str): Name of the DynamoDB table.
+        dynamodb_client: Optional DynamoDB client.
+    """
+    dynamodb_client = dynamodb_client or boto3.client('dynamodb')
+    try:
+        description = dynamodb_client.describe_table(TableName=table_name)['Table']
+    except ClientError as error:
+        if error.response['Error']['Code'] != 'ResourceNotFoundException':
+            raise
+        print(f"Creating table {table_name}.")
+        dynamodb_client.create_table(**table_definition(table_name))
+        dynamodb_client.get_waiter('table_exists').wait(TableName=table_name)
+    else:
+        existing = {index['IndexName'] for index in description.get('GlobalSecondaryIndexes', [])}
+        missing = [index for index in _GLOBAL_SECONDARY_INDEXES if index['IndexName'] not in existing]
+        if missing:
+            index = missing[0]
+            print(f"Adding index {index['IndexName']} to {table_name}.")
+            dynamodb_client.update_table(
+                TableName=table_name,
+                AttributeDefinitions=_ATTRIBUTE_DEFINITIONS,
+                GlobalSecondaryIndexUpdates=[{'Create': index}]
+            )
+        else:
+            print(f"All indexes already exist on {table_name}.")
+
+    ttl = dynamodb_client.describe_time_to_live(TableName=table_name)['TimeToLiveDescription']
+    if ttl.get('TimeToLiveStatus') not in ('ENABLED', 'ENABLING'):
+        print(f"Enabling TTL on {table_name}.{TTL_ATTRIBUTE}.")
+        dynamodb_client.update_time_to_live(
+            TableName=table_name,
+            TimeToLiveSpecification={'Enabled': True, 'AttributeName': TTL_ATTRIBUTE}
+        )
+
+def _query_all(table, **kwargs):
+    """
+    Run a Query and follow LastEvaluatedKey until all matching items have been read.
+    """
+    while True:
+        response = table.query(**kwargs)
+        yield from response.get('Items', [])
+        if 'LastEvaluatedKey' not in response:
+            break
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def failures_for_source(table, source_system_name, start_date, end_date=None):
+    """
+    All failures of a source between two dates (inclusive, YYYY-MM-DD), served by SOURCE_DATE_INDEX.
+    Without an end date everything from start_date up to today is returned.
+    """
+    end_date = end_date or local_date()
+    return _query_all(
+        table,
+        IndexName=SOURCE_DATE_INDEX,
+        KeyConditionExpression=Key('source_system_name').eq(source_system_name) & Key('date_inserted').between(start_date, end_date)
+    )
+
+def top_failing_tables(table, source_system_name, start_date, end_date=None, limit=10):
+    """
+    The tables of a source with the most failures in the date range.
+    Returns:
+        list: (table_name, failure_count) tuples, most failures first.
+    """
+    counts = Counter(display_key(item['table_name']) for item in failures_for_source(table, source_system_name, start_date, end_date))
+    return counts.most_common(limit)
+
+def repeat_offenders(table, source_system_name, start_date, end_date=None, min_days=2):
+    """
+    The tables of a source which failed on at least min_days different days in the date range.
+    Returns:
+        list: (table_name, days_failed, failure_count) tuples, most days first.
+    """
+    days = defaultdict(set)
+    counts = Counter()
+    for item in failures_for_source(table, source_system_name, start_date, end_date):
+        table_name = display_key(item['table_name'])
+        days[table_name].add(item['date_inserted'])
+        counts[table_name] += 1
+    offenders = [(name, len(dates), counts[name]) for name, dates in days.items() if len(dates) >= min_days]
+    return sorted(offenders, key=lambda offender: (-offender[1], -offender[2], offender[0]))
+
+def failures_for_run(table, job_run_id):
+    """
+    All failures recorded for a single Glue job run, served by the table key.
+    """
+    return list(_query_all(table, KeyConditionExpression=Key('job_run_id').eq(job_run_id)))
+
+def table_failure_history(table, table_name, since=None):
+    """
+    Failures of a single table, newest first, optionally only from the given pipeline_run_date prefix onwards.
+    """
+    condition = Key('table_name').eq(table_name)
+    if since:
+        condition = condition & Key('pipeline_run_date').gte(since)
+    return list(_query_all(table, IndexName=TABLE_RUN_INDEX, KeyConditionExpression=condition, ScanIndexForward=False))
+
+def main(argv=None):
+    today = local_date()
+    repeat_start = local_date(REPEAT_OFFENDER_DAYS)
+    parser = argparse.ArgumentParser(description='Query the pipeline failures DynamoDB table.')
+    parser.add_argument('--table', default='non-prod-failures', help='DynamoDB table name.')
+    parser.add_argument('--region', default='eu-west-1')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('setup', help='Create the table or add the missing indexes and TTL.')
+
+    top_parser = subparsers.add_parser('top-tables', help='Tables of a source with the most failures.')
+    top_parser.add_argument('--source', required=True)
+    top_parser.add_argument('--start', default=today)
+    top_parser.add_argument('--end')
+    top_parser.add_argument('--limit', type=int, default=10)
+
+    repeat_parser = subparsers.add_parser('repeat-offenders', help='Tables of a source failing on several days.')
+    repeat_parser.add_argument('--source', required=True)
+    repeat_parser.add_argument('--start', default=repeat_start, help=f'Defaults to {REPEAT_OFFENDER_DAYS} days ago.')
+    repeat_parser.add_argument('--end', default=today)
+    repeat_parser.add_argument('--min-days', type=int, default=2)
+
+    run_parser = subparsers.add_parser('run', help='Failures recorded for a Glue job run.')
+    run_parser.add_argument('job_run_id')
+
+    history_parser = subparsers.add_parser('table', help='Failure history of a table.')
+    history_parser.add_argument('table_name')
+    history_parser.add_argument('--since')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'setup':
+        ensure_table_layout(args.table, boto3.client('dynamodb', region_name=args.region))
+        return
+
+    table = boto3.resource('dynamodb', region_name=args.region).Table(args.table)
+    if args.command == 'top-tables':
+        for table_name, count in top_failing_tables(table, args.source, args.start, args.end, args.limit):
+            print(f"{count:>6}  {table_name}")
+    elif args.command == 'repeat-offenders':
+        for table_name, days_failed, count in repeat_offenders(table, args.source, args.start, args.end, args.min_days):
+            print(f"{days_failed:>4} days {count:>6} failures  {table_name}")
+    elif args.command == 'run':
+        print(json.dumps(failures_for_run(table, args.job_run_id), indent=2, default=str))
+    elif args.command == 'table':
+        print(json.dumps(table_failure_history(table, args.table_name, args.since), indent=2, default=str))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,552 @@
+# The purpose of the following code is to keep the active table Step Functions within a Glue DPU budget.
+# During CDC peaks active_table_start used to start every sf-{env}-active-tables-* execution straight away,
+# which ran into the Glue concurrency and DPU limits and made the jobs fail or retry.
+#
+# Every launch asks for the DPUs of its table (worker_type x worker_num from the active table config
+# snapshot). When the environment has enough DPUs left the execution is started and holds a lease on them,
+# otherwise it is queued. When an execution finishes, EventBridge invokes lambda_handler below with the
+# "Step Functions Execution Status Change" event, the lease is given back and the queued launches are
+# started in group_number order (then in the order they were queued) for as long as the budget allows.
+#
+# Table layout (one DynamoDB table, pk = ENV#<environment>):
+#   sk = BUDGET                                          -> budget (N), available (N)
+#   sk = LEASE#<execution_arn>                           -> DPUs held by a running execution
+#   sk = PENDING#<group_number>#<queued_at>#<execution>  -> a queued launch with its Step Function input
+#   sk = QUEUED#<execution_arn>                          -> marks the execution as queued, so it is queued once
+# Taking DPUs, writing the lease and removing the queued item happen in one transaction, so two Lambdas
+# can never hand out the same DPUs. An execution asking for more than the whole budget is admitted when
+# nothing else is running.
+#
+# EventBridge rule for the release handler:
+#   {"source": ["aws.states"], "detail-type": ["Step Functions Execution Status Change"],
+#    "detail": {"status": ["SUCCEEDED", "FAILED", "TIMED_OUT", "ABORTED"]}}
+# A second rule invokes the same handler on a schedule (e.g. rate(15 minutes)) to reconcile every environment
+# with a budget: leases of executions that finished without an event reaching us, or that were never started
+# because the Lambda died between the admission and start_execution, are given back. A lease without an
+# execution is kept for LEASE_GRACE_SECONDS so a start that is still in flight isn't released under it.
+#
+# Example usage:
+#   python glue_admission_control.py --table non-prod-glue-admission setup
+#   python glue_admission_control.py --table non-prod-glue-admission set-budget dev 120
+#   python glue_admission_control.py --table non-prod-glue-admission status dev
+#   python glue_admission_control.py --table non-prod-glue-admission reconcile dev
+
+import argparse
+import json
+import os
+import re
+from datetime import datetime, timezone
+
+import boto3
+from botocore.exceptions import ClientError
+
+from config_snapshot_client import get_client as get_config_snapshot_client
+from glue_workers import dpus_for
+from pipeline_metrics import PipelineMetrics
+
+ADMISSION_CONTROL_TABLE = os.environ.get('ADMISSION_CONTROL_TABLE', '')
+# Budget an environment starts with, change it afterwards with set-budget
+DEFAULT_DPU_BUDGET = float(os.environ.get('GLUE_DPU_BUDGET', '100'))
+# Used when the table isn't in the config snapshot
+DEFAULT_WORKER_TYPE = 'G.1X'
+DEFAULT_WORKER_NUM = 2
+DEFAULT_GROUP_NUMBER = 99999
+# Queued launches looked at per drain
+DRAIN_BATCH_SIZE = 25
+# How long a lease may exist without its execution before reconcile gives it back
+LEASE_GRACE_SECONDS = int(os.environ.get('LEASE_GRACE_SECONDS', '300'))
+
+STARTED = 'started'
+QUEUED = 'queued'
+DUPLICATE = 'duplicate'
+
+_STATE_MACHINE_NAME = re.compile(r'^sf-(?P<environment>.+?)-active-tables-')
+_FINISHED_STATUSES = {'SUCCEEDED', 'FAILED', 'TIMED_OUT', 'ABORTED'}
+
+metrics = PipelineMetrics('glue_admission_control')
+
+_dynamodb_client = None
+_stepfunctions_client = None
+# Environments whose budget item is known to exist in this container
+_budgets_ready = set()
+
+
+def get_dynamodb_client():
+    global _dynamodb_client
+    if _dynamodb_client is None:
+        _dynamodb_client = boto3.client('dynamodb')
+    return _dynamodb_client
+
+def get_stepfunctions_client():
+    global _stepfunctions_client
+    if _stepfunctions_client is None:
+        _stepfunctions_client = boto3.client('stepfunctions')
+    return _stepfunctions_client
+
+def enabled():
+    return bool(ADMISSION_CONTROL_TABLE)
+
+def table_definition(table_name):
+    """
+    Build the create_table arguments for the admission control table.
+    Returns:
+        dict: Keyword arguments for DynamoDB.Client.create_table.
+    """
+    return {
+        'TableName': table_name,
+        'KeySchema': [
+            {'AttributeName': 'pk', 'KeyType': 'HASH'},
+            {'AttributeName': 'sk', 'KeyType': 'RANGE'}
+        ],
+        'AttributeDefinitions': [
+            {'AttributeName': 'pk', 'AttributeType': 'S'},
+            {'AttributeName': 'sk', 'AttributeType': 'S'}
+        ],
+        'BillingMode': 'PAY_PER_REQUEST'
+    }
+
+def _partition(environment):
+    return {'S': f"ENV#{environment}"}
+
+def _budget_key(environment):
+    return {'pk': _partition(environment), 'sk': {'S': 'BUDGET'}}
+
+def _lease_key(environment, execution_arn):
+    return {'pk': _partition(environment), 'sk': {'S': f"LEASE#{execution_arn}"}}
+
+def _queued_key(environment, execution_arn):
+    return {'pk': _partition(environment), 'sk': {'S': f"QUEUED#{execution_arn}"}}
+
+def _pending_sort_key(group_number, queued_at, execution_name):
+    return f"PENDING#{group_number:05d}#{queued_at}#{execution_name}"
+
+def execution_arn(state_machine_arn, execution_name):
+    return f"{state_machine_arn.replace(':stateMachine:', ':execution:')}:{execution_name}"
+
+def environment_of(arn):
+    """
+    The environment of an active table state machine or execution ARN, None for other state machines.
+    """
+    match = _STATE_MACHINE_NAME.match(arn.split(':')[6])
+    return match.group('environment') if match else None
+
+def table_requirements(source_system_name, tgt_table_name):
+    """
+    The DPUs and group_number of an active table, read from the config snapshot.
+    Returns:
+        tuple: (dpus, group_number)
+    """
+    try:
+        row = get_config_snapshot_client().active_table_config(source_system_name, tgt_table_name)
+    except Exception as snapshot_error:
+        print(f"Unable to read the config snapshot for {source_system_name}: {snapshot_error}")
+        row = None
+    if row is None:
+        print(f"No active table config for {source_system_name}.{tgt_table_name}, using {DEFAULT_WORKER_NUM} x {DEFAULT_WORKER_TYPE}.")
+        return dpus_for(DEFAULT_WORKER_TYPE, DEFAULT_WORKER_NUM), DEFAULT_GROUP_NUMBER
+    group_number = str(row.get('group_number') or '')
+    return (
+        dpus_for(row.get('worker_type') or DEFAULT_WORKER_TYPE, row.get('worker_num') or DEFAULT_WORKER_NUM),
+        int(group_number) if group_number.isdigit() else DEFAULT_GROUP_NUMBER
+    )
+
+def ensure_budget(environment, budget=DEFAULT_DPU_BUDGET):
+    """
+    Create the budget item of an environment if it doesn't exist yet.
+    """
+    if environment in _budgets_ready:
+        return
+    try:
+        get_dynamodb_client().put_item(
+            TableName=ADMISSION_CONTROL_TABLE,
+            Item={**_budget_key(environment), 'budget': {'N': str(budget)}, 'available': {'N': str(budget)}},
+            ConditionExpression='attribute_not_exists(pk)'
+        )
+        print(f"Created the DPU budget of {environment}: {budget}")
+    except ClientError as error:
+        if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+    _budgets_ready.add(environment)
+
+def set_budget(environment, budget):
+    """
+    Change the budget of an environment. The DPUs currently leased stay taken.
+    """
+    ensure_budget(environment, budget)
+    current = get_dynamodb_client().get_item(TableName=ADMISSION_CONTROL_TABLE, Key=_budget_key(environment), ConsistentRead=True)['Item']
+    difference = budget - float(current['budget']['N'])
+    get_dynamodb_client().update_item(
+        TableName=ADMISSION_CONTROL_TABLE,
+        Key=_budget_key(environment),
+        UpdateExpression='SET budget = :budget, available = available + :difference',
+        ConditionExpression='budget = :current',
+        ExpressionAttributeValues={
+            ':budget': {'N': str(budget)},
+            ':difference': {'N': str(difference)},
+            ':current': current['budget']
+        }
+    )
+
+def _try_admit(environment, arn, dpus, pending_sort_key=None):
+    """
+    Take the DPUs and write the lease, and remove the queued item when there is one, in one transaction.
+    Returns:
+        str: 'admitted', 'no_capacity', 'leased' (the execution already holds a lease) or 'gone' (another
+        drain already took the queued item).
+    """
+    items = [
+        {'Update': {
+            'TableName': ADMISSION_CONTROL_TABLE,
+            'Key': _budget_key(environment),
+            'UpdateExpression': 'SET available = available - :dpus',
+            'ConditionExpression': 'available >= :dpus OR available = budget',
+            'ExpressionAttributeValues': {':dpus': {'N': str(dpus)}}
+        }},
+        {'Put': {
+            'TableName': ADMISSION_CONTROL_TABLE,
+            'Item': {
+                **_lease_key(environment, arn),
+                'dpus': {'N': str(dpus)},
+                'leased_at': {'S': datetime.now(timezone.utc).isoformat()}
+            },
+            'ConditionExpression': 'attribute_not_exists(pk)'
+        }}
+    ]
+    if pending_sort_key:
+        items.append({'Delete': {
+            'TableName': ADMISSION_CONTROL_TABLE,
+            'Key': {'pk': _partition(environment), 'sk': {'S': pending_sort_key}},
+            'ConditionExpression': 'attribute_exists(pk)'
+        }})
+        items.append({'Delete': {'TableName': ADMISSION_CONTROL_TABLE, 'Key': _queued_key(environment, arn)}})
+    try:
+        get_dynamodb_client().transact_write_items(TransactItems=items)
+        return 'admitted'
+    except ClientError as error:
+        if error.response['Error']['Code'] != 'TransactionCanceledException':
+            raise
+        reasons = [reason.get('Code') for reason in error.response.get('CancellationReasons', [])]
+        if len(reasons) > 2 and reasons[2] == 'ConditionalCheckFailed':
+            return 'gone'
+        if len(reasons) > 1 and reasons[1] == 'ConditionalCheckFailed':
+            return 'leased'
+        if reasons and reasons[0] == 'ConditionalCheckFailed':
+            return 'no_capacity'
+        raise
+
+def release(environment, arn):
+    """
+    Give the DPUs of a finished execution back to the budget.
+    Returns:
+        bool: True if the execution held a lease.
+    """
+    lease = get_dynamodb_client().get_item(TableName=ADMISSION_CONTROL_TABLE, Key=_lease_key(environment, arn), ConsistentRead=True).get('Item')
+    if not lease:
+        return False
+    try:
+        get_dynamodb_client().transact_write_items(TransactItems=[
+            {'Delete': {
+                'TableName': ADMISSION_CONTROL_TABLE,
+                'Key': _lease_key(environment, arn),
+                'ConditionExpression': 'attribute_exists(pk)'
+            }},
+            {'Update': {
+                'TableName': ADMISSION_CONTROL_TABLE,
+                'Key': _budget_key(environment),
+                'UpdateExpression': 'SET available = available + :dpus',
+                'ExpressionAttributeValues': {':dpus': lease['dpus']}
+            }}
+        ])
+    except ClientError as error:
+        # Released at the same time by a duplicate event
+        if error.response['Error']['Code'] == 'TransactionCanceledException':
+            return False
+        raise
+    return True
+
+def _start(stepfunctions_client, environment, state_machine_arn, execution_name, input_document):
+    """
+    Start an admitted execution. The lease is given back if it can't be started.
+    Returns:
+        str: STARTED, or DUPLICATE when the execution already existed without a lease.
+    """
+    arn = execution_arn(state_machine_arn, execution_name)
+    try:
+        stepfunctions_client.start_execution(stateMachineArn=state_machine_arn, name=execution_name, input=input_document)
+    except ClientError as error:
+        release(environment, arn)
+        if error.response['Error']['Code'] == 'ExecutionAlreadyExists':
+            return DUPLICATE
+        raise
+    except Exception:
+        release(environment, arn)
+        raise
+    return STARTED
+
+def _enqueue(environment, state_machine_arn, execution_name, input_document, dpus, group_number):
+    """
+    Queue a launch, together with its QUEUED marker so concurrent deliveries of the same message queue it once.
+    Returns:
+        bool: False if the execution was already queued.
+    """
+    queued_at = datetime.now(timezone.utc).isoformat()
+    try:
+        get_dynamodb_client().transact_write_items(TransactItems=[
+            {'Put': {
+                'TableName': ADMISSION_CONTROL_TABLE,
+                'Item': {**_queued_key(environment, execution_arn(state_machine_arn, execution_name)), 'queued_at': {'S': queued_at}},
+                'ConditionExpression': 'attribute_not_exists(pk)'
+            }},
+            {'Put': {
+                'TableName': ADMISSION_CONTROL_TABLE,
+                'Item': {
+                    'pk': _partition(environment),
+                    'sk': {'S': _pending_sort_key(group_number, queued_at, execution_name)},
+                    'state_machine_arn': {'S': state_machine_arn},
+                    'execution_name': {'S': execution_name},
+                    'input': {'S': input_document},
+                    'dpus': {'N': str(dpus)},
+                    'group_number': {'N': str(group_number)},
+                    'queued_at': {'S': queued_at}
+                }
+            }}
+        ])
+    except ClientError as error:
+        if error.response['Error']['Code'] != 'TransactionCanceledException':
+            raise
+        reasons = [reason.get('Code') for reason in error.response.get('CancellationReasons', [])]
+        if reasons and reasons[0] == 'ConditionalCheckFailed':
+            return False
+        raise
+    return True
+
+def _pending(environment, limit):
+    return get_dynamodb_client().query(
+        TableName=ADMISSION_CONTROL_TABLE,
+        KeyConditionExpression='pk = :pk AND begins_with(sk, :pending)',
+        ExpressionAttributeValues={':pk': _partition(environment), ':pending': {'S': 'PENDING#'}},
+        ConsistentRead=True,
+        Limit=limit
+    )['Items']
+
+def drain(environment, stepfunctions_client=None):
+    """
+    Start queued launches in group_number order until the budget runs out.
+    Returns:
+        int: Number of executions started.
+    """
+    stepfunctions_client = stepfunctions_client or get_stepfunctions_client()
+    started = 0
+    while True:
+        pending = _pending(environment, DRAIN_BATCH_SIZE)
+        if not pending:
+            return started
+        for item in pending:
+            state_machine_arn = item['state_machine_arn']['S']
+            execution_name = item['execution_name']['S']
+            arn = execution_arn(state_machine_arn, execution_name)
+            outcome = _try_admit(environment, arn, float(item['dpus']['N']), item['sk']['S'])
+            if outcome == 'no_capacity':
+                # Strict order, nothing behind the head of the queue may overtake it
+                return started
+            if outcome == 'leased':
+                # Already running under its own lease, the queued copy is not needed
+                get_dynamodb_client().delete_item(TableName=ADMISSION_CONTROL_TABLE, Key={'pk': item['pk'], 'sk': item['sk']})
+                get_dynamodb_client().delete_item(TableName=ADMISSION_CONTROL_TABLE, Key=_queued_key(environment, arn))
+                continue
+            if outcome == 'gone':
+                continue
+            try:
+                if _start(stepfunctions_client, environment, state_machine_arn, execution_name, item['input']['S']) == STARTED:
+                    started += 1
+                    metrics.count('QueuedLaunchesStarted')
+            except Exception as start_error:
+                # Put it back where it was, the next release tries again
+                get_dynamodb_client().put_item(
+                    TableName=ADMISSION_CONTROL_TABLE, Item={**_queued_key(environment, arn), 'queued_at': item['queued_at']}
+                )
+                get_dynamodb_client().put_item(TableName=ADMISSION_CONTROL_TABLE, Item=item)
+                print(f"Failed to start the queued execution {execution_name}: {start_error}")
+                return started
+        if len(pending) < DRAIN_BATCH_SIZE:
+            return started
+
+def launch(stepfunctions_client, state_machine_arn, execution_name, input_payload, source_system_name, tgt_table_name):
+    """
+    Start an active table execution if the environment has the DPUs for it, otherwise queue it.
+    Returns:
+        str: STARTED, QUEUED or DUPLICATE.
+    """
+    environment = environment_of(state_machine_arn)
+    dpus, group_number = table_requirements(source_system_name, tgt_table_name)
+    ensure_budget(environment)
+    input_document = json.dumps(input_payload)
+    arn = execution_arn(state_machine_arn, execution_name)
+
+    # Only go straight in when nobody is waiting, otherwise join the queue so the group order holds
+    if not _pending(environment, 1):
+        outcome = _try_admit(environment, arn, dpus)
+        if outcome == 'leased':
+            return DUPLICATE
+        if outcome == 'admitted':
+            return _start(stepfunctions_client, environment, state_machine_arn, execution_name, input_document)
+
+    if not _enqueue(environment, state_machine_arn, execution_name, input_document, dpus, group_number):
+        print(f"{execution_name} is already queued.")
+        return DUPLICATE
+    print(f"Queued {execution_name} ({dpus} DPUs, group {group_number}) until {environment} has the DPUs for it.")
+    metrics.count('LaunchesQueued')
+    # A lease may have been given back between the admission attempt and the enqueue
+    drain(environment, stepfunctions_client)
+    return QUEUED
+
+def _items(environment, prefix=None):
+    condition = 'pk = :pk'
+    values = {':pk': _partition(environment)}
+    if prefix:
+        condition += ' AND begins_with(sk, :prefix)'
+        values[':prefix'] = {'S': prefix}
+    items = []
+    paginator = get_dynamodb_client().get_paginator('query')
+    for page in paginator.paginate(
+        TableName=ADMISSION_CONTROL_TABLE,
+        KeyConditionExpression=condition,
+        ExpressionAttributeValues=values,
+        ConsistentRead=True
+    ):
+        items.extend(page['Items'])
+    return items
+
+def environments():
+    """
+    The environments that have a budget item.
+    """
+    found = []
+    paginator = get_dynamodb_client().get_paginator('scan')
+    for page in paginator.paginate(
+        TableName=ADMISSION_CONTROL_TABLE,
+        FilterExpression='sk = :budget',
+        ExpressionAttributeValues={':budget': {'S': 'BUDGET'}},
+        ProjectionExpression='pk'
+    ):
+        found.extend(item['pk']['S'][len('ENV#'):] for item in page['Items'])
+    return sorted(found)
+
+def status(environment):
+    """
+    The budget, leases and queued launches of an environment.
+    """
+    items = _items(environment)
+    budget = next((item for item in items if item['sk']['S'] == 'BUDGET'), None)
+    return {
+        'budget': float(budget['budget']['N']) if budget else None,
+        'available': float(budget['available']['N']) if budget else None,
+        'leases': {item['sk']['S'][len('LEASE#'):]: float(item['dpus']['N']) for item in items if item['sk']['S'].startswith('LEASE#')},
+        'pending': [
+            {'execution_name': item['execution_name']['S'], 'group_number': int(item['group_number']['N']), 'dpus': float(item['dpus']['N'])}
+            for item in items if item['sk']['S'].startswith('PENDING#')
+        ]
+    }
+
+def _lease_age_seconds(lease):
+    leased_at = lease.get('leased_at', {}).get('S')
+    if not leased_at:
+        return None
+    return (datetime.now(timezone.utc) - datetime.fromisoformat(leased_at)).total_seconds()
+
+def reconcile(environment, stepfunctions_client=None, grace_seconds=LEASE_GRACE_SECONDS):
+    """
+    Release the leases of executions that are no longer running, for finish events that never arrived,
+    and of executions that were never started once the lease is older than grace_seconds, then start what
+    the freed DPUs allow.
+    Returns:
+        list: Execution ARNs whose lease was released.
+    """
+    stepfunctions_client = stepfunctions_client or get_stepfunctions_client()
+    released = []
+    for lease in _items(environment, 'LEASE#'):
+        arn = lease['sk']['S'][len('LEASE#'):]
+        try:
+            running = stepfunctions_client.describe_execution(executionArn=arn)['status'] == 'RUNNING'
+        except ClientError as error:
+            if error.response['Error']['Code'] != 'ExecutionDoesNotExist':
+                raise
+            # Admitted but not started (yet), only stale once the start can't still be on its way
+            age = _lease_age_seconds(lease)
+            running = age is not None and age < grace_seconds
+        if not running and release(environment, arn):
+            released.append(arn)
+    drain(environment, stepfunctions_client)
+    return released
+
+@metrics.timed('handler')
+def lambda_handler(event, context):
+    if event.get('detail-type') == 'Scheduled Event':
+        released = {}
+        for environment in environments():
+            with metrics.stage('reconcile', environment=environment):
+                released[environment] = reconcile(environment)
+                metrics.count('StaleLeasesReleased', len(released[environment]))
+            if released[environment]:
+                print(f"Released {len(released[environment])} stale leases in {environment}: {released[environment]}")
+        return {'released': {environment: len(arns) for environment, arns in released.items()}}
+    detail = event.get('detail', {})
+    arn = detail.get('executionArn')
+    if not arn or detail.get('status') not in _FINISHED_STATUSES:
+        print(f"Ignoring event: {json.dumps(event)}")
+        return {'released': False, 'started': 0}
+    environment = environment_of(arn)
+    if environment is None:
+        print(f"{arn} is not an active table execution.")
+        return {'released': False, 'started': 0}
+
+    with metrics.stage('release', environment=environment):
+        released = release(environment, arn)
+    with metrics.stage('drain', environment=environment):
+        started = drain(environment)
+    print(f"Execution {arn} finished ({detail['status']}), lease released: {released}, queued executions started: {started}")
+    return {'released': released, 'started': started}
+
+
+def main(argv=None):
+    global ADMISSION_CONTROL_TABLE, _dynamodb_client
+    parser = argparse.ArgumentParser(description='Manage the Glue DPU budget of the active table Step Functions.')
+    parser.add_argument('--table', default=ADMISSION_CONTROL_TABLE or 'non-prod-glue-admission', help='DynamoDB table name.')
+    parser.add_argument('--region', default='eu-west-1')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('setup', help='Create the table.')
+
+    budget_parser = subparsers.add_parser('set-budget', help='Set the DPU budget of an environment.')
+    budget_parser.add_argument('environment')
+    budget_parser.add_argument('dpus', type=float)
+
+    status_parser = subparsers.add_parser('status', help='Show the budget, leases and queued launches.')
+    status_parser.add_argument('environment')
+
+    reconcile_parser = subparsers.add_parser('reconcile', help='Release the leases of executions that are no longer running.')
+    reconcile_parser.add_argument('environment')
+    reconcile_parser.add_argument('--grace-seconds', type=int, default=LEASE_GRACE_SECONDS, help='Keep leases of executions that don\'t exist yet for this long.')
+
+    args = parser.parse_args(argv)
+    ADMISSION_CONTROL_TABLE = args.table
+    _dynamodb_client = boto3.client('dynamodb', region_name=args.region)
+
+    if args.command == 'setup':
+        _dynamodb_client.create_table(**table_definition(args.table))
+        _dynamodb_client.get_waiter('table_exists').wait(TableName=args.table)
+        print(f"Created table {args.table}.")
+    elif args.command == 'set-budget':
+        set_budget(args.environment, args.dpus)
+        print(json.dumps(status(args.environment), indent=2))
+    elif args.command == 'status':
+        print(json.dumps(status(args.environment), indent=2))
+    elif args.command == 'reconcile':
+        released = reconcile(args.environment, boto3.client('stepfunctions', region_name=args.region), args.grace_seconds)
+        print(f"Released {len(released)} stale leases.")
+        for arn in released:
+            print(f"  {arn}")
+
+
+if __name__ == '__main__':
+    main()
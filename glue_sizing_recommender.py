@@ -0,0 +1,361 @@
+# The purpose of the following code is to size the Glue workers of each table from how its jobs actually
+# ran, instead of the hand-edited worker_type / worker_num in the config file (almost every table is G.1X x 2
+# whatever its size). Oversized tables waste DPUs, undersized ones stretch the critical path of the load.
+#
+# History is read from local files so the recommendation can be reviewed and re-run offline:
+#   export-glue-runs     -> the SUCCEEDED runs of a Glue job (get_job_runs), one JSON object per line, with the
+#                           table taken from one of the job run arguments
+#   export-jdbc-tracker  -> the row counts the JDBC jobs log to their DynamoDB tracker table
+#
+# Runtime model, per table:
+#   runtime = startup + work * (serial + (1 - serial) / executor_dpus)
+# where executor_dpus = (workers - 1) x DPUs per worker (one worker is the driver). The work of every past run
+# is solved from its runtime and size, the recommendation uses the 90th percentile, scaled by the growth of
+# the row counts when the tracker has them. The candidate with the fewest DPU-hours that still finishes
+# within --target-minutes wins; when none does, the smallest one within 5% of the fastest runtime.
+#
+# Tables with "worker_sizing_override": "Y" in their config section are reported but never changed.
+#
+# Example usage:
+#   python glue_sizing_recommender.py export-glue-runs --job-name non-prod-active-table-load --table-arg --execution_table_names --out runs.jsonl
+#   python glue_sizing_recommender.py export-jdbc-tracker --table non-prod-jdbc-poc-cdc-tracker --out tracker.jsonl
+#   python glue_sizing_recommender.py recommend --config config_file_sample.json --env non-prod --runs runs.jsonl --tracker tracker.jsonl
+#   python glue_sizing_recommender.py recommend --config config_file_sample.json --env non-prod --runs runs.jsonl --apply
+#   python glue_sizing_recommender.py recommend --config config_file_sample.json --env non-prod --runs runs.jsonl --apply --out config_file_sample.json
+
+import argparse
+import copy
+import difflib
+import json
+import math
+import os
+import statistics
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+import boto3
+
+from glue_workers import DPUS_PER_WORKER
+
+ACTIVE_TABLE_SECTION = 'active_table_config'
+INGESTION_SECTION = 'ingestion_config'
+OVERRIDE_KEY = 'worker_sizing_override'
+DEFAULT_STARTUP_SECONDS = 45
+DEFAULT_SERIAL_FRACTION = 0.1
+DEFAULT_TARGET_MINUTES = 15
+DEFAULT_WORKER_TYPES = ['G.1X', 'G.2X']
+DEFAULT_MAX_WORKERS = 20
+MIN_RUNS = 3
+WORK_PERCENTILE = 0.9
+# Row count growth is only trusted within these bounds
+MIN_GROWTH, MAX_GROWTH = 0.5, 4.0
+
+
+def normalize_table_name(name, source_name=''):
+    """
+    Reduce the names used by the different sources (a_account, grandcentral_account, SSR#Account) to the
+    table_name of the config file.
+    """
+    name = name.strip().lower().split('#')[-1]
+    if name.startswith('a_'):
+        name = name[2:]
+    if source_name and name.startswith(f"{source_name.lower()}_"):
+        name = name[len(source_name) + 1:]
+    return name
+
+def read_json_lines(path):
+    """
+    Read a JSON list, or one JSON object per line.
+    """
+    with open(path) as history_file:
+        text = history_file.read().strip()
+    if text.startswith('['):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+def write_json_lines(path, records):
+    with open(path, 'w') as history_file:
+        for record in records:
+            history_file.write(json.dumps(record, default=str) + '\n')
+
+def export_glue_runs(glue_client, job_name, table_arg, since=None):
+    """
+    The SUCCEEDED runs of a Glue job, reduced to what the recommender needs.
+    Returns:
+        list: {'table_name', 'job_name', 'job_run_id', 'started_on', 'execution_seconds', 'worker_type', 'worker_num'}
+    """
+    runs = []
+    paginator = glue_client.get_paginator('get_job_runs')
+    for page in paginator.paginate(JobName=job_name):
+        for run in page['JobRuns']:
+            if run.get('JobRunState') != 'SUCCEEDED' or not run.get('WorkerType'):
+                continue
+            if since and run['StartedOn'] < since:
+                continue
+            table_name = run.get('Arguments', {}).get(table_arg, '')
+            # Active table runs get a JSON list of table names
+            if table_name.startswith('['):
+                table_names = json.loads(table_name)
+                table_name = table_names[0] if len(table_names) == 1 else ''
+            if not table_name:
+                continue
+            runs.append({
+                'table_name': table_name,
+                'job_name': job_name,
+                'job_run_id': run['Id'],
+                'started_on': run['StartedOn'].isoformat(),
+                'execution_seconds': run['ExecutionTime'],
+                'worker_type': run['WorkerType'],
+                'worker_num': run['NumberOfWorkers']
+            })
+    return runs
+
+def export_jdbc_tracker(dynamodb_client, table_name):
+    """
+    The runs logged in a JDBC tracker table.
+    Returns:
+        list: {'table_name', 'last_updated', 'row_count'}
+    """
+    records = []
+    paginator = dynamodb_client.get_paginator('scan')
+    for page in paginator.paginate(TableName=table_name, ProjectionExpression='source_table, last_updated, row_count'):
+        for item in page['Items']:
+            records.append({
+                'table_name': item['source_table']['S'],
+                'last_updated': item['last_updated']['S'],
+                'row_count': int(item['row_count']['N'])
+            })
+    return records
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+def executor_dpus(worker_type, worker_num):
+    return max(1, int(worker_num) - 1) * DPUS_PER_WORKER.get(worker_type, 1)
+
+def dpu_hours(worker_type, worker_num, runtime_seconds):
+    return int(worker_num) * DPUS_PER_WORKER.get(worker_type, 1) * runtime_seconds / 3600
+
+def predict_runtime(work, worker_type, worker_num, startup_seconds, serial_fraction):
+    return startup_seconds + work * (serial_fraction + (1 - serial_fraction) / executor_dpus(worker_type, worker_num))
+
+def solve_work(run, startup_seconds, serial_fraction):
+    """
+    The work of a past run, in DPU-seconds at perfect parallelism, solved from the runtime model.
+    """
+    parallel = serial_fraction + (1 - serial_fraction) / executor_dpus(run['worker_type'], run['worker_num'])
+    return max(1.0, run['execution_seconds'] - startup_seconds) / parallel
+
+def row_growth(tracker_records):
+    """
+    The latest row count relative to the median, 1.0 when there are too few records to tell.
+    """
+    if len(tracker_records) < MIN_RUNS:
+        return 1.0
+    ordered = sorted(tracker_records, key=lambda record: record['last_updated'])
+    median = statistics.median(record['row_count'] for record in ordered)
+    if not median:
+        return 1.0
+    return min(MAX_GROWTH, max(MIN_GROWTH, ordered[-1]['row_count'] / median))
+
+def runs_per_day(runs):
+    if len(runs) < 2:
+        return 1.0
+    started = sorted(datetime.fromisoformat(run['started_on']) for run in runs)
+    days = max(1.0, (started[-1] - started[0]).total_seconds() / 86400)
+    return len(runs) / days
+
+def choose_size(work, worker_types, max_workers, target_seconds, startup_seconds, serial_fraction):
+    """
+    The cheapest worker setting that finishes within the target, or the smallest close to the fastest one.
+    Returns:
+        tuple: (worker_type, worker_num, predicted runtime in seconds)
+    """
+    candidates = []
+    for worker_type in worker_types:
+        for worker_num in range(2, max_workers + 1):
+            runtime = predict_runtime(work, worker_type, worker_num, startup_seconds, serial_fraction)
+            candidates.append((dpu_hours(worker_type, worker_num, runtime), runtime, worker_type, worker_num))
+    within_target = [candidate for candidate in candidates if candidate[1] <= target_seconds]
+    if within_target:
+        _, runtime, worker_type, worker_num = min(within_target)
+    else:
+        fastest = min(candidate[1] for candidate in candidates)
+        _, runtime, worker_type, worker_num = min(candidate for candidate in candidates if candidate[1] <= fastest * 1.05)
+    return worker_type, worker_num, runtime
+
+def recommend(env_config, source_name, runs, tracker_records=None, section=ACTIVE_TABLE_SECTION,
+              worker_types=DEFAULT_WORKER_TYPES, max_workers=DEFAULT_MAX_WORKERS, target_minutes=DEFAULT_TARGET_MINUTES,
+              startup_seconds=DEFAULT_STARTUP_SECONDS, serial_fraction=DEFAULT_SERIAL_FRACTION):
+    """
+    Recommend worker settings for every table of an environment configuration.
+    Args:
+        env_config (dict): Environment configuration (config['environments'][env]).
+        source_name (str): Name of the data source.
+        runs (list): Exported Glue runs.
+        tracker_records (list): Exported JDBC tracker records, optional.
+        section (str): 'active_table_config' or 'ingestion_config'.
+    Returns:
+        list: One dictionary per table with the current and recommended settings, runtimes and DPU-hours.
+    """
+    runs_by_table = defaultdict(list)
+    for run in runs:
+        runs_by_table[normalize_table_name(run['table_name'], source_name)].append(run)
+    tracker_by_table = defaultdict(list)
+    for record in tracker_records or []:
+        tracker_by_table[normalize_table_name(record['table_name'], source_name)].append(record)
+
+    recommendations = []
+    for table in env_config['tables']:
+        config = table.get(section)
+        if config is None or 'worker_type' not in config:
+            continue
+        table_name = table['table_name']
+        table_runs = runs_by_table.get(table_name, [])
+        result = {
+            'table_name': table_name,
+            'current_worker_type': config['worker_type'],
+            'current_worker_num': int(config['worker_num']),
+            'runs': len(table_runs),
+            'status': 'keep'
+        }
+        recommendations.append(result)
+        if str(config.get(OVERRIDE_KEY, 'N')).upper() == 'Y':
+            result['status'] = 'override'
+            continue
+        if len(table_runs) < MIN_RUNS:
+            result['status'] = 'insufficient_history'
+            continue
+
+        growth = row_growth(tracker_by_table.get(table_name, []))
+        work = percentile([solve_work(run, startup_seconds, serial_fraction) for run in table_runs], WORK_PERCENTILE) * growth
+        worker_type, worker_num, runtime = choose_size(work, worker_types, max_workers, target_minutes * 60, startup_seconds, serial_fraction)
+        current_runtime = predict_runtime(work, config['worker_type'], config['worker_num'], startup_seconds, serial_fraction)
+        daily_runs = runs_per_day(table_runs)
+        result.update({
+            'row_growth': round(growth, 2),
+            'recommended_worker_type': worker_type,
+            'recommended_worker_num': worker_num,
+            'current_runtime_minutes': round(current_runtime / 60, 1),
+            'expected_runtime_minutes': round(runtime / 60, 1),
+            'current_dpu_hours_per_run': round(dpu_hours(config['worker_type'], config['worker_num'], current_runtime), 3),
+            'expected_dpu_hours_per_run': round(dpu_hours(worker_type, worker_num, runtime), 3),
+            'runs_per_day': round(daily_runs, 2)
+        })
+        result['dpu_hours_per_day_change'] = round(
+            (result['expected_dpu_hours_per_run'] - result['current_dpu_hours_per_run']) * daily_runs, 3
+        )
+        if (worker_type, worker_num) != (config['worker_type'], int(config['worker_num'])):
+            result['status'] = 'resize'
+    return recommendations
+
+def apply_recommendations(env_config, recommendations, section=ACTIVE_TABLE_SECTION):
+    """
+    Write the recommended worker settings into the environment configuration, skipping overridden tables.
+    Returns:
+        int: Number of tables changed.
+    """
+    by_table = {result['table_name']: result for result in recommendations if result['status'] == 'resize'}
+    changed = 0
+    for table in env_config['tables']:
+        result = by_table.get(table['table_name'])
+        if result is None:
+            continue
+        table[section]['worker_type'] = result['recommended_worker_type']
+        table[section]['worker_num'] = result['recommended_worker_num']
+        changed += 1
+    return changed
+
+def print_report(recommendations):
+    header = f"{'table':<28}{'status':<22}{'current':>10}{'recommended':>13}{'runtime min':>16}{'DPU-h/run':>16}{'DPU-h/day':>11}"
+    print(header)
+    print('-' * len(header))
+    for result in recommendations:
+        current = f"{result['current_worker_num']}x{result['current_worker_type']}"
+        if 'recommended_worker_type' not in result:
+            print(f"{result['table_name']:<28}{result['status']:<22}{current:>10}")
+            continue
+        recommended = f"{result['recommended_worker_num']}x{result['recommended_worker_type']}"
+        runtime = f"{result['current_runtime_minutes']} -> {result['expected_runtime_minutes']}"
+        hours = f"{result['current_dpu_hours_per_run']} -> {result['expected_dpu_hours_per_run']}"
+        print(f"{result['table_name']:<28}{result['status']:<22}{current:>10}{recommended:>13}{runtime:>16}{hours:>16}{result['dpu_hours_per_day_change']:>+11.2f}")
+    total = sum(result.get('dpu_hours_per_day_change', 0) for result in recommendations if result['status'] == 'resize')
+    print(f"\nDPU-hours per day after resizing: {total:+.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Recommend Glue worker settings per table from the run history.')
+    parser.add_argument('--region', default='eu-west-1')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    runs_parser = subparsers.add_parser('export-glue-runs', help='Export the SUCCEEDED runs of a Glue job.')
+    runs_parser.add_argument('--job-name', required=True)
+    runs_parser.add_argument('--table-arg', default='--execution_table_names', help='Job run argument holding the table name.')
+    runs_parser.add_argument('--days', type=int, default=30, help='Only export runs started in the last N days.')
+    runs_parser.add_argument('--out', required=True)
+
+    tracker_parser = subparsers.add_parser('export-jdbc-tracker', help='Export the row counts of a JDBC tracker table.')
+    tracker_parser.add_argument('--table', default='non-prod-jdbc-poc-cdc-tracker')
+    tracker_parser.add_argument('--out', required=True)
+
+    recommend_parser = subparsers.add_parser('recommend', help='Recommend, and optionally apply, worker settings.')
+    recommend_parser.add_argument('--config', required=True, help='Config file (like config_file_sample.json).')
+    recommend_parser.add_argument('--env', required=True, help='Environment of the config file, e.g. non-prod.')
+    recommend_parser.add_argument('--runs', nargs='+', required=True, help='Files written by export-glue-runs.')
+    recommend_parser.add_argument('--tracker', nargs='*', default=[], help='Files written by export-jdbc-tracker.')
+    recommend_parser.add_argument('--section', choices=[ACTIVE_TABLE_SECTION, INGESTION_SECTION], default=ACTIVE_TABLE_SECTION)
+    recommend_parser.add_argument('--worker-types', nargs='+', default=DEFAULT_WORKER_TYPES, choices=sorted(DPUS_PER_WORKER))
+    recommend_parser.add_argument('--max-workers', type=int, default=DEFAULT_MAX_WORKERS)
+    recommend_parser.add_argument('--target-minutes', type=float, default=DEFAULT_TARGET_MINUTES)
+    recommend_parser.add_argument('--startup-seconds', type=float, default=DEFAULT_STARTUP_SECONDS)
+    recommend_parser.add_argument('--serial-fraction', type=float, default=DEFAULT_SERIAL_FRACTION)
+    recommend_parser.add_argument('--apply', action='store_true', help='Write a copy of the config with the recommended settings and show the diff.')
+    recommend_parser.add_argument('--out', help='Where --apply writes the config, <config>.recommended.json by default. Pass --config to overwrite it.')
+    recommend_parser.add_argument('--report-json', help='Also write the recommendations to this file.')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'export-glue-runs':
+        since = datetime.now(timezone.utc) - timedelta(days=args.days)
+        runs = export_glue_runs(boto3.client('glue', region_name=args.region), args.job_name, args.table_arg, since)
+        write_json_lines(args.out, runs)
+        print(f"Exported {len(runs)} runs of {args.job_name} to {args.out}")
+        return
+    if args.command == 'export-jdbc-tracker':
+        records = export_jdbc_tracker(boto3.client('dynamodb', region_name=args.region), args.table)
+        write_json_lines(args.out, records)
+        print(f"Exported {len(records)} tracker records of {args.table} to {args.out}")
+        return
+
+    with open(args.config) as config_file:
+        config = json.load(config_file)
+    env_config = config['environments'][args.env]
+    runs = [run for path in args.runs for run in read_json_lines(path)]
+    tracker_records = [record for path in args.tracker for record in read_json_lines(path)]
+    recommendations = recommend(
+        env_config, config['source_name'], runs, tracker_records, args.section, args.worker_types,
+        args.max_workers, args.target_minutes, args.startup_seconds, args.serial_fraction
+    )
+    print_report(recommendations)
+    if args.report_json:
+        with open(args.report_json, 'w') as report_file:
+            json.dump(recommendations, report_file, indent=2)
+    if args.apply:
+        out = args.out or f"{os.path.splitext(args.config)[0]}.recommended.json"
+        original = copy.deepcopy(config)
+        changed = apply_recommendations(env_config, recommendations, args.section)
+        # The file is rewritten with json.dump, so the diff compares both versions in that layout to only show the changes
+        print()
+        for line in difflib.unified_diff(
+            json.dumps(original, indent=4).splitlines(), json.dumps(config, indent=4).splitlines(),
+            fromfile=args.config, tofile=out, lineterm=''
+        ):
+            print(line)
+        with open(out, 'w') as config_file:
+            json.dump(config, config_file, indent=4)
+        print(f"Updated the worker settings of {changed} tables in {out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,12 @@
+# Glue worker sizes shared by glue_admission_control and glue_sizing_recommender. Kept in its own module so
+# the offline recommender doesn't import the admission control Lambda (its metrics and config snapshot client).
+
+# DPUs of one worker of each Glue worker type
+DPUS_PER_WORKER = {'Standard': 1, 'G.025X': 0.25, 'G.1X': 1, 'G.2X': 2, 'G.4X': 4, 'G.8X': 8, 'Z.2X': 2}
+
+
+def dpus_for(worker_type, worker_num):
+    """
+    DPUs of a job running worker_num workers of worker_type, unknown worker types count as 1 DPU a worker.
+    """
+    return DPUS_PER_WORKER.get(worker_type, 1) * int(worker_num)
@@ -0,0 +1,119 @@
+# The purpose of the following code is to let the ingestion Glue job tell move_to_processed exactly which
+# landing files it consumed, so only those are archived and the Lambda doesn't have to list the prefixes.
+#
+# The ingestion job publishes its "table processed" message as JSON instead of the plain text message:
+#   {
+#     "event_type": "table_processed",
+#     "source_system_name": "grandcentral",
+#     "table_name": "grandcentral_account",
+#     "environment": "dev",
+#     "job_run_id": "jr_...",
+#     "manifest_keys": ["landing/grandcentral/account/data/account_20240115.csv", ...]
+#   }
+# When the key list would make the message too big for SNS (256 KB) the keys are written to a manifest object
+# in the landing bucket instead and the message carries "manifest_s3_uri": "s3://<bucket>/ingestion-manifests/...".
+#
+# Example usage in the ingestion job:
+#   publish_table_processed(sns_client, s3_client, topic_arn, landing_bucket, source_system_name,
+#                           table_name, environment, consumed_keys, job_run_id)
+
+import json
+from datetime import datetime, timezone
+
+from botocore.exceptions import ClientError
+
+MANIFEST_VERSION = 1
+MANIFEST_PREFIX = 'ingestion-manifests'
+TABLE_PROCESSED_EVENT_TYPE = 'table_processed'
+# SNS messages can be up to 256 KB, leave room for the envelope
+MAX_INLINE_MESSAGE_BYTES = 200 * 1024
+
+
+def manifest_key(source_system_name, table_name, job_run_id):
+    return f"{MANIFEST_PREFIX}/{source_system_name}/{table_name}/{job_run_id}.json"
+
+def build_manifest(bucket, source_system_name, table_name, environment, keys, job_run_id):
+    """
+    Build the manifest of the landing keys consumed by one ingestion run.
+    Returns:
+        dict: The manifest document.
+    """
+    return {
+        'version': MANIFEST_VERSION,
+        'bucket': bucket,
+        'source_system_name': source_system_name,
+        'table_name': table_name,
+        'environment': environment,
+        'job_run_id': job_run_id,
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'keys': sorted(keys)
+    }
+
+def table_processed_message(source_system_name, table_name, environment, job_run_id=None, manifest_keys=None, manifest_s3_uri=None):
+    """
+    Build the JSON "table processed" SNS message.
+    Returns:
+        str: The message body.
+    """
+    message = {
+        'event_type': TABLE_PROCESSED_EVENT_TYPE,
+        'source_system_name': source_system_name,
+        'table_name': table_name,
+        'environment': environment
+    }
+    if job_run_id:
+        message['job_run_id'] = job_run_id
+    if manifest_keys is not None:
+        message['manifest_keys'] = sorted(manifest_keys)
+    if manifest_s3_uri:
+        message['manifest_s3_uri'] = manifest_s3_uri
+    return json.dumps(message)
+
+def write_manifest(s3_client, manifest):
+    """
+    Write the manifest to the landing bucket.
+    Returns:
+        str: s3:// URI of the manifest object.
+    """
+    key = manifest_key(manifest['source_system_name'], manifest['table_name'], manifest['job_run_id'])
+    s3_client.put_object(
+        Bucket=manifest['bucket'],
+        Key=key,
+        Body=json.dumps(manifest).encode('utf-8'),
+        ContentType='application/json'
+    )
+    return f"s3://{manifest['bucket']}/{key}"
+
+def publish_table_processed(sns_client, s3_client, topic_arn, bucket, source_system_name, table_name, environment, keys, job_run_id):
+    """
+    Publish the "table processed" message with the consumed keys, inline when they fit and as a manifest
+    object in the landing bucket when they don't.
+    Returns:
+        str: The message that was published.
+    """
+    message = table_processed_message(source_system_name, table_name, environment, job_run_id, manifest_keys=keys)
+    if len(message.encode('utf-8')) > MAX_INLINE_MESSAGE_BYTES:
+        manifest = build_manifest(bucket, source_system_name, table_name, environment, keys, job_run_id)
+        manifest_uri = write_manifest(s3_client, manifest)
+        print(f"{len(keys)} consumed keys written to the manifest {manifest_uri}")
+        message = table_processed_message(source_system_name, table_name, environment, job_run_id, manifest_s3_uri=manifest_uri)
+    sns_client.publish(TopicArn=topic_arn, Message=message)
+    return message
+
+def load_manifest_keys(s3_client, pipeline_event):
+    """
+    The landing keys listed by a parsed "table processed" event, read from the manifest object if needed.
+    Returns:
+        list: The keys, or None when the event has no manifest or the manifest can't be read.
+    """
+    if pipeline_event.manifest_keys is not None:
+        return list(pipeline_event.manifest_keys)
+    if not pipeline_event.manifest_uri:
+        return None
+    bucket, _, key = pipeline_event.manifest_uri[len('s3://'):].partition('/')
+    try:
+        manifest = json.loads(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read())
+    except ClientError as error:
+        print(f"Unable to read the manifest {pipeline_event.manifest_uri}: {error}")
+        return None
+    return manifest['keys']
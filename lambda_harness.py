@@ -0,0 +1,490 @@
+# The purpose of the following code is to run the pipeline Lambdas offline so they can be measured and
+# load tested without an AWS account. Every AWS service the handlers touch (S3, SNS, SQS, DynamoDB,
+# Step Functions, Athena and STS) is replaced by moto, and the Teams webhook by a local HTTP sink.
+# MOTO_ACCOUNT_ID is set to the dev/non-prod account so the module level STS lookups resolve an environment.
+#
+# For each handler the harness:
+#   1. imports the module fresh (cold start: module init, client creation and the STS lookup),
+#   2. replays synthetic or recorded events at the requested rate, one at a time like a single container,
+#   3. counts the AWS API calls made during init and during every event with a botocore before-call hook.
+# Notifications queued on the SQS stand-in are then delivered to the sink by teams_notification_sender.
+#
+# Cold start here excludes importing boto3/botocore themselves, which the harness has already loaded.
+#
+# Recorded events are JSON files (a list, or one event per line) of full Lambda events. For the SNS
+# triggered handlers an entry may also be the bare SNS message text, which is wrapped in an SNS event.
+#
+# Example usage:
+#   python lambda_harness.py
+#   python lambda_harness.py --handlers active_table_start ms_teams_failure_notifications --count 200 --rate 50
+#   python lambda_harness.py --handlers active_table_start --redeliver 0.2
+#   python lambda_harness.py --events ms_teams_failure_notifications=recorded_failures.json --report-json report.json
+
+import os
+
+# moto and the handlers read these on import
+os.environ.setdefault('MOTO_ACCOUNT_ID', '649505956583')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-1')
+os.environ.setdefault('AWS_REGION', 'eu-west-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.pop('AWS_PROFILE', None)
+
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import boto3
+from moto import mock_aws
+
+from failure_history import table_definition
+from ingestion_manifest import build_manifest, table_processed_message, write_manifest
+
+ACCOUNT_ID = os.environ['MOTO_ACCOUNT_ID']
+REGION = os.environ['AWS_DEFAULT_REGION']
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+HANDLERS = ['active_table_start', 'move_to_processed', 'config_table_populator', 'ms_teams_failure_notifications']
+
+FAILURES_TABLE = 'non-prod-failures'
+EXECUTION_DEDUPE_TABLE = 'non-prod-execution-dedupe'
+PIPELINE_TOPIC = 'edp-pipeline-events'
+NOTIFICATION_QUEUE = 'teams-notifications'
+DUMPS_BUCKET = 'ct-ire-edp-prd-dumps'
+CONFIG_BUCKET = 'ct-ire-edp-dev-config'
+ATHENA_RESULTS_BUCKET = f'aws-athena-query-results-{ACCOUNT_ID}-{REGION}'
+ENVIRONMENT = 'dev'
+
+# Source system -> tables used for the synthetic events
+SYNTHETIC_TABLES = {
+    'grandcentral': ['account', 'allocation', 'contract'],
+    'compass': ['case_bills', 'organization', 'dd_rjct_hist']
+}
+
+
+class LambdaContext:
+    """
+    Minimal stand-in for the Lambda context object.
+    """
+
+    def __init__(self, function_name, timeout_seconds=900):
+        self.function_name = function_name
+        self.aws_request_id = str(uuid.uuid4())
+        self._deadline = time.monotonic() + timeout_seconds
+
+    def get_remaining_time_in_millis(self):
+        return int(max(self._deadline - time.monotonic(), 0) * 1000)
+
+
+class ApiCallCounter:
+    """
+    Counts the AWS API calls made through boto3, attributed to whatever is being measured at the time.
+    """
+
+    def __init__(self):
+        self.calls = defaultdict(Counter)
+        self.current = None
+        self._lock = threading.Lock()
+
+    def install(self, session):
+        # Clients copy the session's handlers when they are created, so this has to run before any handler import
+        session.events.register('before-call', self._before_call)
+
+    def _before_call(self, event_name, **kwargs):
+        if self.current is None:
+            return
+        operation = event_name.split('.', 1)[1]
+        with self._lock:
+            self.calls[self.current][operation] += 1
+
+    @contextlib.contextmanager
+    def measure(self, label):
+        self.current = label
+        try:
+            yield self.calls[label]
+        finally:
+            self.current = None
+
+
+class WebhookSink:
+    """
+    Local HTTP server standing in for the Teams webhook. Records every payload it receives.
+    """
+
+    def __init__(self):
+        self.received = []
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                sink.received.append(json.loads(body or b'{}'))
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(b'1')
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self._server.server_port}/webhook"
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self._server.shutdown()
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of a list of numbers.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+def create_resources():
+    """
+    Create the moto resources the handlers expect to exist.
+    Returns:
+        dict: Names and ARNs the event builders need.
+    """
+    s3 = boto3.client('s3')
+    for bucket in (DUMPS_BUCKET, CONFIG_BUCKET, ATHENA_RESULTS_BUCKET):
+        s3.create_bucket(Bucket=bucket, CreateBucketConfiguration={'LocationConstraint': REGION})
+
+    dynamodb = boto3.client('dynamodb')
+    dynamodb.create_table(**table_definition(FAILURES_TABLE))
+    dynamodb.create_table(
+        TableName=EXECUTION_DEDUPE_TABLE,
+        AttributeDefinitions=[{'AttributeName': 'dedupe_key', 'AttributeType': 'S'}],
+        KeySchema=[{'AttributeName': 'dedupe_key', 'KeyType': 'HASH'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+
+    topic_arn = boto3.client('sns').create_topic(Name=PIPELINE_TOPIC)['TopicArn']
+    queue_url = boto3.client('sqs').create_queue(QueueName=NOTIFICATION_QUEUE)['QueueUrl']
+
+    stepfunctions = boto3.client('stepfunctions')
+    definition = json.dumps({'StartAt': 'Done', 'States': {'Done': {'Type': 'Succeed'}}})
+    for source_system_name in SYNTHETIC_TABLES:
+        stepfunctions.create_state_machine(
+            name=f"sf-{ENVIRONMENT}-active-tables-{source_system_name}",
+            definition=definition,
+            roleArn=f"arn:aws:iam::{ACCOUNT_ID}:role/harness-step-functions"
+        )
+    return {'topic_arn': topic_arn, 'queue_url': queue_url}
+
+def sns_event(topic_arn, message):
+    """
+    Publish the message to the SNS stand-in and wrap it in the event SNS would deliver to the Lambda.
+    """
+    message_id = boto3.client('sns').publish(TopicArn=topic_arn, Message=message)['MessageId']
+    return {
+        'Records': [{
+            'EventSource': 'aws:sns',
+            'EventVersion': '1.0',
+            'EventSubscriptionArn': f"{topic_arn}:{uuid.uuid4()}",
+            'Sns': {
+                'Type': 'Notification',
+                'MessageId': message_id,
+                'TopicArn': topic_arn,
+                'Subject': None,
+                'Message': message,
+                'Timestamp': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+                'MessageAttributes': {}
+            }
+        }]
+    }
+
+def s3_put_event(bucket, key, size):
+    return {
+        'Records': [{
+            'eventVersion': '2.1',
+            'eventSource': 'aws:s3',
+            'awsRegion': REGION,
+            'eventTime': datetime.now(timezone.utc).isoformat(),
+            'eventName': 'ObjectCreated:Put',
+            's3': {'bucket': {'name': bucket, 'arn': f"arn:aws:s3:::{bucket}"}, 'object': {'key': key, 'size': size}}
+        }]
+    }
+
+def _synthetic_tables(count):
+    tables = [(source, table) for source, source_tables in SYNTHETIC_TABLES.items() for table in source_tables]
+    for index in range(count):
+        yield tables[index % len(tables)]
+
+def synthetic_config():
+    """
+    config_file_sample.json with the worker settings filled in where a table leaves them out, otherwise the
+    populator fails on it and spends its time in the retry sleeps instead of being measured.
+    """
+    with open(os.path.join(REPO_DIR, 'config_file_sample.json')) as sample_file:
+        config = json.load(sample_file)
+    for env_config in config['environments'].values():
+        for table in env_config['tables']:
+            for section in ('ingestion_config', 'active_table_config'):
+                if section in table:
+                    table[section].setdefault('worker_type', 'G.1X')
+                    table[section].setdefault('worker_num', 2)
+    return config
+
+def synthetic_events(handler, count, resources, files_per_prefix=2, move_manifest='none'):
+    """
+    Build synthetic events for a handler. Anything the event refers to (landing files, config files) is
+    created just before the event is yielded, outside of the measured time.
+    """
+    s3 = boto3.client('s3')
+    if handler == 'active_table_start':
+        for source, table in _synthetic_tables(count):
+            yield sns_event(resources['topic_arn'], f"{source} table processed: {source}_{table} in {ENVIRONMENT}")
+
+    elif handler == 'move_to_processed':
+        for index, (source, table) in enumerate(_synthetic_tables(count)):
+            keys = []
+            for prefix in ('control', 'data', 'header'):
+                for file_number in range(files_per_prefix):
+                    keys.append(f"landing/{source}/{table}/{prefix}/{table}_{file_number}.csv")
+                    s3.put_object(Bucket=DUMPS_BUCKET, Key=keys[-1], Body=b'id;name\n1;a\n')
+            if move_manifest == 'inline':
+                message = table_processed_message(source, f"{source}_{table}", ENVIRONMENT, f"jr_{index}", manifest_keys=keys)
+            elif move_manifest == 's3':
+                manifest = build_manifest(DUMPS_BUCKET, source, f"{source}_{table}", ENVIRONMENT, keys, f"jr_{index}")
+                message = table_processed_message(source, f"{source}_{table}", ENVIRONMENT, f"jr_{index}", manifest_s3_uri=write_manifest(s3, manifest))
+            else:
+                message = f"{source} table processed: {source}_{table} in {ENVIRONMENT}"
+            yield sns_event(resources['topic_arn'], message)
+
+    elif handler == 'config_table_populator':
+        body = json.dumps(synthetic_config()).encode('utf-8')
+        for index in range(count):
+            key = f"config/grandcentral/config_{index}.json"
+            s3.put_object(Bucket=CONFIG_BUCKET, Key=key, Body=body)
+            yield s3_put_event(CONFIG_BUCKET, key, len(body))
+
+    elif handler == 'ms_teams_failure_notifications':
+        with open(os.path.join(REPO_DIR, 'sns_message_samples.json')) as samples_file:
+            messages = [sample['message'] for sample in json.load(samples_file) if sample['expected'].get('kind') != 'table_processed']
+        for index in range(count):
+            yield sns_event(resources['topic_arn'], messages[index % len(messages)])
+
+    else:
+        raise ValueError(f"No synthetic events for {handler}")
+
+def recorded_events(path, resources):
+    """
+    Read recorded events from a JSON list or JSON lines file. Bare strings are wrapped as SNS events.
+    """
+    with open(path) as events_file:
+        content = events_file.read().strip()
+    entries = json.loads(content) if content.startswith('[') else [json.loads(line) for line in content.splitlines() if line.strip()]
+    for entry in entries:
+        yield sns_event(resources['topic_arn'], entry) if isinstance(entry, str) else entry
+
+def import_handler(module_name, counter):
+    """
+    Import a handler module as a Lambda cold start would, after dropping every module of this repo from the cache.
+    Returns:
+        tuple: (module, import_seconds)
+    """
+    for name, module in list(sys.modules.items()):
+        module_file = getattr(module, '__file__', None) or ''
+        if name != __name__ and name != 'failure_history' and module_file.startswith(REPO_DIR):
+            del sys.modules[name]
+    with counter.measure(f"{module_name}:init"):
+        started = time.perf_counter()
+        module = importlib.import_module(module_name)
+        import_seconds = time.perf_counter() - started
+    return module, import_seconds
+
+def with_redeliveries(events, fraction):
+    """
+    Deliver a fraction of the events a second time, unchanged, like SNS does now and then.
+    """
+    owed = 0.0
+    for event in events:
+        yield event
+        owed += fraction
+        if owed >= 1:
+            owed -= 1
+            yield event
+
+def count_executions():
+    stepfunctions = boto3.client('stepfunctions')
+    executions = 0
+    for state_machine in stepfunctions.list_state_machines()['stateMachines']:
+        paginator = stepfunctions.get_paginator('list_executions')
+        for page in paginator.paginate(stateMachineArn=state_machine['stateMachineArn']):
+            executions += len(page['executions'])
+    return executions
+
+def replay(handler, events, counter, rate=0, verbose=False):
+    """
+    Import the handler and invoke it with every event, at most `rate` events per second (0 = no pacing).
+    Returns:
+        dict: Cold start, latency and API call statistics for the handler.
+    """
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        module, import_seconds = import_handler(handler, counter)
+    init_calls = dict(counter.calls[f"{handler}:init"])
+
+    latencies = []
+    outcomes = Counter()
+    per_event_calls = []
+    started = time.monotonic()
+    for index, event in enumerate(events):
+        if rate:
+            delay = started + index / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        label = f"{handler}:{index}"
+        with output, counter.measure(label) as calls:
+            invoke_started = time.perf_counter()
+            try:
+                response = module.lambda_handler(event, LambdaContext(handler))
+                status = response.get('statusCode', 200) if isinstance(response, dict) else 200
+                outcomes['ok' if isinstance(status, int) and status < 400 else f"status_{status}"] += 1
+            except Exception as error:
+                outcomes[f"raised_{type(error).__name__}"] += 1
+            latencies.append(time.perf_counter() - invoke_started)
+        per_event_calls.append(calls)
+
+    operations = Counter()
+    for calls in per_event_calls:
+        operations.update(calls)
+    events_run = len(latencies)
+    return {
+        'handler': handler,
+        'cold_start_ms': round(import_seconds * 1000, 2),
+        'init_api_calls': init_calls,
+        'events': events_run,
+        'outcomes': dict(outcomes),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        'max_ms': round(max(latencies) * 1000, 2) if latencies else None,
+        'api_calls_per_event': round(sum(operations.values()) / events_run, 2) if events_run else 0,
+        'api_calls_by_operation': {operation: round(count / events_run, 2) for operation, count in operations.most_common()},
+        'elapsed_seconds': round(time.monotonic() - started, 3)
+    }
+
+def drain_notifications(queue_url, counter, verbose=False):
+    """
+    Deliver the notifications the handlers queued on the SQS stand-in through teams_notification_sender.
+    Returns:
+        int: Number of notifications handed to the sender.
+    """
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        sender, _ = import_handler('teams_notification_sender', counter)
+    sqs = boto3.client('sqs')
+    queue_arn = sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['QueueArn'])['Attributes']['QueueArn']
+    drained = 0
+    while True:
+        messages = sqs.receive_message(
+            QueueUrl=queue_url, MaxNumberOfMessages=10, AttributeNames=['ApproximateReceiveCount']
+        ).get('Messages', [])
+        if not messages:
+            return drained
+        records = [
+            {
+                'messageId': message['MessageId'], 'receiptHandle': message['ReceiptHandle'], 'body': message['Body'],
+                'attributes': message.get('Attributes', {}), 'eventSourceARN': queue_arn
+            }
+            for message in messages
+        ]
+        with output, counter.measure('teams_notification_sender'):
+            response = sender.lambda_handler({'Records': records}, LambdaContext('teams_notification_sender'))
+        failed = {failure['itemIdentifier'] for failure in response['batchItemFailures']}
+        sqs.delete_message_batch(QueueUrl=queue_url, Entries=[
+            {'Id': str(index), 'ReceiptHandle': message['ReceiptHandle']}
+            for index, message in enumerate(messages) if message['MessageId'] not in failed
+        ])
+        drained += len(messages)
+
+def print_report(results, notifications):
+    header = f"{'handler':<34}{'cold start':>12}{'init calls':>12}{'events':>8}{'p50 ms':>10}{'p99 ms':>10}{'calls/event':>13}"
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        print(
+            f"{result['handler']:<34}{result['cold_start_ms']:>10.1f}ms{sum(result['init_api_calls'].values()):>12}"
+            f"{result['events']:>8}{result['p50_ms'] or 0:>10.2f}{result['p99_ms'] or 0:>10.2f}{result['api_calls_per_event']:>13.2f}"
+        )
+    print()
+    for result in results:
+        operations = ', '.join(f"{operation}={count}" for operation, count in result['api_calls_by_operation'].items())
+        print(f"{result['handler']}: outcomes {result['outcomes']}, calls per event: {operations or 'none'}")
+    print(f"Notifications: {notifications['queued']} queued, {notifications['delivered_to_sink']} delivered to the webhook sink")
+    print(f"Step Function executions started: {notifications['executions_started']}")
+
+def run_harness(handlers, count=50, rate=0, recorded=None, files_per_prefix=2, verbose=False, move_manifest='none', redeliver=0):
+    """
+    Set up the offline environment, replay the events for every handler and collect the results.
+    Returns:
+        dict: {'results': [...], 'notifications': {...}}
+    """
+    recorded = recorded or {}
+    counter = ApiCallCounter()
+    sink = WebhookSink()
+    with mock_aws():
+        # Set before the handler modules are imported, they read these at import time
+        resources = create_resources()
+        os.environ['NOTIFICATION_QUEUE_URL'] = resources['queue_url']
+        os.environ['TEAMS_WEBHOOK_URL_OVERRIDE'] = sink.url
+        os.environ['EXECUTION_DEDUPE_TABLE'] = EXECUTION_DEDUPE_TABLE
+        counter.install(boto3._get_default_session())
+
+        results = []
+        for handler in handlers:
+            if handler in recorded:
+                events = recorded_events(recorded[handler], resources)
+            else:
+                events = synthetic_events(handler, count, resources, files_per_prefix, move_manifest)
+            if redeliver:
+                events = with_redeliveries(events, redeliver)
+            results.append(replay(handler, events, counter, rate, verbose))
+
+        queued = drain_notifications(resources['queue_url'], counter, verbose)
+        executions_started = count_executions()
+    sink.close()
+    return {
+        'results': results,
+        'notifications': {'queued': queued, 'delivered_to_sink': len(sink.received), 'executions_started': executions_started}
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay events through the pipeline Lambdas against moto and report their cost.')
+    parser.add_argument('--handlers', nargs='+', default=HANDLERS, choices=HANDLERS)
+    parser.add_argument('--count', type=int, default=50, help='Number of synthetic events per handler.')
+    parser.add_argument('--rate', type=float, default=0, help='Events per second per handler, 0 replays as fast as possible.')
+    parser.add_argument('--events', action='append', default=[], metavar='HANDLER=PATH',
+                        help='Replay recorded events from a file instead of synthetic ones, can be repeated.')
+    parser.add_argument('--files-per-prefix', type=int, default=2, help='Landing files per control/data/header prefix for move_to_processed.')
+    parser.add_argument('--move-manifest', choices=['none', 'inline', 's3'], default='none',
+                        help='How the synthetic move_to_processed events carry the ingestion manifest.')
+    parser.add_argument('--redeliver', type=float, default=0, metavar='FRACTION',
+                        help='Fraction of the events delivered a second time, to check the handlers are idempotent.')
+    parser.add_argument('--report-json', help='Also write the results to this file.')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of the handlers.')
+    args = parser.parse_args(argv)
+
+    recorded = dict(entry.split('=', 1) for entry in args.events)
+    report = run_harness(args.handlers, args.count, args.rate, recorded, args.files_per_prefix, args.verbose, args.move_manifest, args.redeliver)
+    print_report(report['results'], report['notifications'])
+    if args.report_json:
+        with open(args.report_json, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,22 @@
 import boto3
 import json
-import re
+from botocore.exceptions import ClientError
+from pipeline_event_parser import parse_pipeline_event, TABLE_PROCESSED
 from datetime import datetime
 import logging
-import urllib3
+from teams_notification_queue import MOVE_TO_PROCESSED_WEBHOOK, enqueue_notification
+from ingestion_manifest import load_manifest_keys
+from pipeline_metrics import PipelineMetrics
 
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-http = urllib3.PoolManager()
+metrics = PipelineMetrics('move_to_processed')
 
 def send_lambda_failure_notification(function_name, error_message):
     try:
         print('In failure notification definition using webhook...')
-        webhook_url = "https://libertyholdings.webhook.office.com/webhookb2/107ab5b7-2181-48b6-a08d-867a3b9b1be6@66b8ffa6-81c0-4ea6-93fb-06f390dc67f6/IncomingWebhook/f48a60e53c244883aec8f818ec712481/540ec8e7-b8ad-4612-9c4a-140cef8ece9c/V2D48F_4WdLacduICMppdTvVOKYoYTTQHBvNM6RTzgpEY1"
         payload = {
             "title": f"Lambda Failure Notification : {function_name}",
             "text": (
@@ -24,31 +26,47 @@ def send_lambda_failure_notification(function_name, error_message):
                 f"Please investigate the issue and check CloudWatch logs for more details."
             )
         }
-        encoded_payload = json.dumps(payload).encode('utf-8')
-        # Send POST request to the Webhook URL
-        
-        response = http.request('POST', webhook_url, body=encoded_payload, headers={'Content-Type': 'application/json'})
-
-        # Log success or failure
-        if response.status == 200:
-            print(f"Webhook notification sent successfully for Lambda function: {function_name}")
+        # Queue the notification, the teams_notification_sender Lambda posts it to the Webhook URL
+        if enqueue_notification(MOVE_TO_PROCESSED_WEBHOOK, payload, function_name):
+            print(f"Webhook notification queued for Lambda function: {function_name}")
         else:
-            print(f"Failed to send Webhook notification. Response: {response.status}, {response.text}")
+            print(f"Failed to queue Webhook notification for Lambda function: {function_name}")
 
     except Exception as webhook_error:
-        print(f"Failed to send failure notification via Webhook: {webhook_error}")
+        print(f"Failed to queue failure notification for the Webhook: {webhook_error}")
 
 def get_account_id():
     client = boto3.client("sts")
     return client.get_caller_identity()["Account"]
     
-def move_files(bucket, source_prefix, destination_prefix):
+def list_landing_keys(bucket, source_prefix):
     response = s3_client.list_objects_v2(Bucket=bucket, Prefix=source_prefix)
-    for item in response.get('Contents', []):
-        copy_source = {'Bucket': bucket, 'Key': item['Key']}
-        new_key = item['Key'].replace(source_prefix, destination_prefix)
-        s3_client.copy_object(CopySource=copy_source, Bucket=bucket, Key=new_key)
-        s3_client.delete_object(Bucket=bucket, Key=item['Key'])
+    return [item['Key'] for item in response.get('Contents', [])]
+
+def move_files(bucket, source_prefix, destination_prefix, keys=None):
+    """
+    Move the keys under source_prefix to destination_prefix. Without a list of keys (no ingestion manifest)
+    everything under source_prefix is listed and moved.
+    """
+    if keys is None:
+        with metrics.stage('list_landing_keys', prefix=source_prefix):
+            keys = list_landing_keys(bucket, source_prefix)
+            metrics.count('FilesListed', len(keys))
+    with metrics.stage('copy_and_delete', prefix=source_prefix):
+        for key in keys:
+            copy_source = {'Bucket': bucket, 'Key': key}
+            new_key = key.replace(source_prefix, destination_prefix)
+            try:
+                s3_client.copy_object(CopySource=copy_source, Bucket=bucket, Key=new_key)
+            except ClientError as error:
+                # Keys from a manifest may already have been moved by an earlier delivery of the message
+                if error.response['Error']['Code'] in ('NoSuchKey', '404'):
+                    print(f"Skipping {key}, it no longer exists.")
+                    metrics.count('FilesSkipped')
+                    continue
+                raise
+            s3_client.delete_object(Bucket=bucket, Key=key)
+            metrics.count('FilesMoved')
 
 s3_client = boto3.client('s3')
 
@@ -73,6 +91,7 @@ if current_env is None:
 else:
     print(f"The current environment is: {current_env}")
 
+@metrics.timed('handler')
 def lambda_handler(event, context):
     # Parse SNS message
     function_name = context.function_name
@@ -81,11 +100,11 @@ def lambda_handler(event, context):
         print(f"This is the full SNS message received: {sns_message}")
         
         # Get the name of the table from the SNS message
-        match = re.match(r'^(.*?) table processed: (.*?) in (.*?)$', sns_message)
-        if match:
-            source_system_name = match.group(1).strip()
-            original_table_name = match.group(2).strip()
-            env = match.group(3).strip()
+        pipeline_event = parse_pipeline_event(sns_message)
+        if pipeline_event.kind == TABLE_PROCESSED:
+            source_system_name = pipeline_event.source_system_name
+            original_table_name = pipeline_event.table_name
+            env = pipeline_event.env
             print(f"This is the source_system_name received by sns --> {source_system_name}")
             print(f"This is the table name received by sns --> {original_table_name}")
             print(f"This is the environment received by sns --> {env}")
@@ -103,9 +122,8 @@ def lambda_handler(event, context):
                 'body': json.dumps(f"The source system name '{source_system_name}' doesn't match what's found in the table name: {original_table_name}.")
             }
 
-        match_table = re.search(fr'{source_system_name}_(\w+)', original_table_name)
-        if match_table:
-            extracted_table_name = match_table.group(1)
+        extracted_table_name = pipeline_event.extracted_table_name
+        if extracted_table_name:
             print("Extracted table_name to be used as the table prefix:", extracted_table_name)
         else:
             print(f"No matching table_name found for {source_system_name} in {original_table_name}.")
@@ -130,10 +148,22 @@ def lambda_handler(event, context):
         destination_base = f"{base_path}processed/{today_partition}/"
         print(f"This is the destination_base: {destination_base}")
         
+        # With a manifest from the ingestion job only the files it consumed are moved, nothing is listed
+        with metrics.stage('load_manifest'):
+            manifest_keys = load_manifest_keys(s3_client, pipeline_event)
+        if manifest_keys is None:
+            print("No ingestion manifest in the message, listing the landing prefixes.")
+        else:
+            print(f"Moving the {len(manifest_keys)} file(s) in the ingestion manifest.")
+            outside = [key for key in manifest_keys if not key.startswith(base_path)]
+            if outside:
+                print(f"Ignoring {len(outside)} manifest key(s) outside {base_path}, e.g. {outside[0]}")
+
         for prefix in ['control', 'data', 'header']:
             source_prefix = f"{base_path}{prefix}/"
             destination_prefix = f"{destination_base}{prefix}/"
-            move_files(source_bucket, source_prefix, destination_prefix)
+            keys = None if manifest_keys is None else [key for key in manifest_keys if key.startswith(source_prefix)]
+            move_files(source_bucket, source_prefix, destination_prefix, keys)
             print(f"Source Prefix in for loop: {source_prefix}")
             print(f"Destination Prefix in for loop: {destination_prefix}")
             
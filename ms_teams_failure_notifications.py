@@ -1,10 +1,15 @@
-import urllib3
 import json
 import boto3
 import time
 from datetime import datetime
 import dateutil.tz
-import re
+from pipeline_event_parser import parse_pipeline_event
+from teams_notification_queue import PIPELINE_FAILURES_WEBHOOK, enqueue_notification
+from failure_history import TTL_ATTRIBUTE, expires_at, key_value
+from pipeline_metrics import PipelineMetrics
+
+# Created before the clients so their API calls are counted
+metrics = PipelineMetrics('ms_teams_failure_notifications')
 
 # Initialize the DynamoDB resource
 dynamodb = boto3.resource('dynamodb')
@@ -12,7 +17,6 @@ dynamodb = boto3.resource('dynamodb')
 # Reference your table
 table = dynamodb.Table('non-prod-failures')
 
-http = urllib3.PoolManager()
 localtime = dateutil.tz.gettz('Africa/Johannesburg')
 time_now = datetime.now(tz=localtime).strftime('%Y-%m-%d-%H-%M')
 
@@ -45,33 +49,32 @@ if current_env is None:
 
 print(f"This Lambda is running in the {current_env} environment.")
 
+@metrics.timed('handler')
 def lambda_handler(event, context):
-    # Make sure to replace this with the correct webhook
-    url = "https://libertyholdings.webhook.office.com/webhookb2/84ae269b-3328-4244-9c58-87c0541029c0@66b8ffa6-81c0-4ea6-93fb-06f390dc67f6/IncomingWebhook/c138a082ecc74b4994660b794fa65c9e/540ec8e7-b8ad-4612-9c4a-140cef8ece9c/V2si77KzgXjjzLFo4ensxNcctUBKFqTLyxrbWaTTx0wps1"
     print(event)
     sns_message_raw = event['Records'][0]['Sns']['Message']
     print('sns_message_raw...................',sns_message_raw)
     time_now = datetime.now(tz=localtime).strftime('%Y-%m-%d-%H-%M')
     
-    try:
-        sns_message = json.loads(sns_message_raw)
-    except json.JSONDecodeError:
+    with metrics.stage('parse_event'):
+        pipeline_event = parse_pipeline_event(sns_message_raw)
+    if not pipeline_event.is_json:
         print(f"Error decoding JSON: {sns_message_raw}")
         
-        # Extract details from raw message using regex
-        source_system_match = re.search(r'Source System: ([\w_]+)', sns_message_raw)
-        table_name_match = re.search(r'Table: ([\w_]+)', sns_message_raw)
-        error_message_match = re.search(r'Error: (.+?)\. Please investigate', sns_message_raw)
-        job_name_match = re.search(r'job: ([\w-]+)', sns_message_raw)
-        job_run_id_match = re.search(r'JobRunID: ([\w_]+)', sns_message_raw)
+        # Details extracted from the raw message by the pipeline event parser
+        job_run_id = pipeline_event.job_run_id or 'N/A'
+        source_system_name = pipeline_event.source_system_name or 'N/A'
+        table_name = pipeline_event.table_name or 'N/A'
+        error_message = pipeline_event.error_message or 'N/A'
+        glue_job_name = pipeline_event.job_name or 'N/A'
         
         raw_formatted_message = (
             f"Environment: {current_env.upper()}  \n"
-            f"Source System: {source_system_match.group(1) if source_system_match else 'N/A'}  \n"
-            f"Table Name: {table_name_match.group(1) if table_name_match else 'N/A'}  \n"
-            f"Error Message: {error_message_match.group(1) if error_message_match else 'N/A'}  \n"
-            f"Job Name: {job_name_match.group(1) if job_name_match else 'N/A'}  \n"
-            f"JobRun ID: {job_run_id_match.group(1) if job_run_id_match else 'N/A'}  \n"
+            f"Source System: {source_system_name}  \n"
+            f"Table Name: {table_name}  \n"
+            f"Error Message: {error_message}  \n"
+            f"Job Name: {glue_job_name}  \n"
+            f"JobRun ID: {job_run_id}  \n"
             f"Execution Date/Time: {time_now}  \n"
             f"Note to Prod: Please investigate this and update the team on this message. Thank you.  \n"
         )
@@ -81,40 +84,33 @@ def lambda_handler(event, context):
         message = {
             "text": raw_formatted_message
         }
-        job_run_id = f"{job_run_id_match.group(1) if job_run_id_match else 'N/A'}"
-        source_system_name = f"{source_system_match.group(1) if source_system_match else 'N/A'}"
-        table_name = f"{table_name_match.group(1) if table_name_match else 'N/A'}"
-        error_message = f"{error_message_match.group(1) if error_message_match else 'N/A'}"
-        glue_job_name = f"{job_name_match.group(1) if job_name_match else 'N/A'}"
         date_inserted = datetime.now(tz=localtime).strftime("%Y-%m-%d")
         
+        # The table key is job_run_id + table_name, missing ones get a value unique to this message
+        message_id = event['Records'][0]['Sns']['MessageId']
         item = {
-            'job_run_id': job_run_id,
+            'job_run_id': key_value(pipeline_event.job_run_id, message_id),
             'environment': current_env,
             'source_system_name': source_system_name,
-            'table_name': table_name,
+            'table_name': key_value(pipeline_event.table_name, message_id),
             'error_message':error_message,
             'glue_job_name': glue_job_name,
             'pipeline_run_date': time_now,
-            'date_inserted': date_inserted
+            'date_inserted': date_inserted,
+            TTL_ATTRIBUTE: expires_at()
         }
 
         # Insert the item into DynamoDB
-        table.put_item(Item=item)
+        with metrics.stage('record_failure', source_system_name=source_system_name):
+            table.put_item(Item=item)
         
-        encoded_message = json.dumps(message).encode('utf-8')
-        try:
-            resp = http.request('POST', url, body=encoded_message, headers={'Content-Type': 'application/json'})
-            print({
-                "message": raw_formatted_message,
-                "status_code": resp.status,
-                "response": resp.data.decode('utf-8')
-            })
-        except Exception as e:
-            print(f"Error sending the HTTP request: {e}")
+        # Queue the message, the teams_notification_sender Lambda takes care of delivery and retries
+        with metrics.stage('enqueue_notification'):
+            queued = enqueue_notification(PIPELINE_FAILURES_WEBHOOK, message, context.function_name)
+        if not queued:
             return {
                 'statusCode': 500,
-                'body': json.dumps('Error sending the HTTP request')
+                'body': json.dumps('Error queueing the notification')
             }
 
         return {
@@ -122,17 +118,17 @@ def lambda_handler(event, context):
             'body': json.dumps('Message processed successfully')
         }
 
-    print(f"This is the full SNS message (JSON): {sns_message}")
+    print(f"This is the full SNS message (JSON): {sns_message_raw}")
     
     formatted_message = (
-        f"Environment: {sns_message.get('Environment', 'N/A').upper()}  \n"
-        f"Source System: {sns_message.get('Source_System', 'N/A').upper()}  \n"
-        f"Table Name: {sns_message.get('tgt_table_name', 'N/A')}  \n"
-        f"Error Message: {sns_message.get('ErrorMessage', 'N/A')}  \n"
-        f"Job Name: {sns_message.get('JobName', 'N/A')}  \n"
-        f"JobRun ID: {sns_message.get('Id', 'N/A')}  \n"
-        f"Execution Date/Time: {sns_message.get('cdc_batch_date_id', 'N/A')}  \n"
-        f"Note to Prod: {sns_message.get('Message', 'Please investigate this and update the team on this message. Thank you.')}  \n"
+        f"Environment: {(pipeline_event.env or 'N/A').upper()}  \n"
+        f"Source System: {(pipeline_event.source_system_name or 'N/A').upper()}  \n"
+        f"Table Name: {pipeline_event.table_name or 'N/A'}  \n"
+        f"Error Message: {pipeline_event.error_message or 'N/A'}  \n"
+        f"Job Name: {pipeline_event.job_name or 'N/A'}  \n"
+        f"JobRun ID: {pipeline_event.job_run_id or 'N/A'}  \n"
+        f"Execution Date/Time: {pipeline_event.batch_date or 'N/A'}  \n"
+        f"Note to Prod: {pipeline_event.note or 'Please investigate this and update the team on this message. Thank you.'}  \n"
     )
     
     print(f"Formatted message: {formatted_message}")
@@ -141,19 +137,13 @@ def lambda_handler(event, context):
         "text": formatted_message
     }
 
-    encoded_message = json.dumps(message).encode('utf-8')
-    try:
-        resp = http.request('POST', url, body=encoded_message, headers={'Content-Type': 'application/json'})
-        print({
-            "message": formatted_message,
-            "status_code": resp.status,
-            "response": resp.data.decode('utf-8')
-        })
-    except Exception as e:
-        print(f"Error sending the HTTP request: {e}")
+    # Queue the message, the teams_notification_sender Lambda takes care of delivery and retries
+    with metrics.stage('enqueue_notification'):
+        queued = enqueue_notification(PIPELINE_FAILURES_WEBHOOK, message, context.function_name)
+    if not queued:
         return {
             'statusCode': 500,
-            'body': json.dumps('Error sending the HTTP request')
+            'body': json.dumps('Error queueing the notification')
         }
 
     return {
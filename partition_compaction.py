@@ -1,5 +1,5 @@
 import sys, json, logging, boto3
-from datetime import datetime
+from datetime import datetime, timezone
 import pytz
 from awsglue.utils import getResolvedOptions
 from awsglue.context import GlueContext
@@ -7,7 +7,10 @@ from awsglue.job import Job
 from pyspark.context import SparkContext
 from pyspark.sql.functions import *
 from pyspark.sql.types import *
+from pyspark.sql.types import _parse_datatype_string
+from botocore.exceptions import ClientError
 import rdbms_based_lib 
+from pipeline_metrics import PipelineMetrics
 from awsglue.transforms import *
 
 logging.basicConfig(level=logging.INFO, format='%(levelname)s:%(message)s')
@@ -32,6 +35,16 @@ tables = json.loads(args["tables"]) # tables will typically be a JSON array
 environment = args["environment"]
 region_name = args["region_name"]
 
+# Optional arguments. The schema of every table is cached as s3://<schema_cache_uri>/<table>.json so the next
+# run can hand it to the reader instead of having Spark infer it; catalog_database is the Glue database to
+# take the schema from when a table has no cached schema yet.
+optional_args = getResolvedOptions(sys.argv, [name for name in ("schema_cache_uri", "catalog_database") if f"--{name}" in sys.argv])
+schema_cache_uri = optional_args.get("schema_cache_uri", f"s3://{s3_bucket}/_schema_cache/partition_compaction/{main_prefix}").rstrip("/")
+catalog_database = optional_args.get("catalog_database", "")
+
+# Glue doesn't turn EMF log lines into metrics, so they are sent with put_metric_data at the end of the job
+metrics = PipelineMetrics("partition_compaction", sink="cloudwatch", dimensions={"Environment": environment})
+
 sc = SparkContext()
 glueContext = GlueContext(sc)
 spark = glueContext.spark_session
@@ -62,27 +75,135 @@ logger.info(f"account_id: {account_id}")
 sns_success_topic_arn = f'arn:aws:sns:eu-west-1:{account_id}:{environment}-ingestion-success' 
 sns_failure_topic_arn = f'arn:aws:sns:eu-west-1:{account_id}:{environment}-pipeline-failures' 
 sns_client = boto3.client('sns', region_name='eu-west-1')
+s3_client = boto3.client('s3', region_name=region_name)
+glue_client = boto3.client('glue', region_name=region_name)
+
+def split_s3_uri(uri):
+    bucket, _, key = uri[len("s3://"):].partition("/")
+    return bucket, key
+
+def load_cached_schema(table):
+    """
+    The schema recorded for the table by a previous run, None if there is none.
+    """
+    bucket, key = split_s3_uri(f"{schema_cache_uri}/{table}.json")
+    try:
+        document = json.loads(s3_client.get_object(Bucket=bucket, Key=key)["Body"].read())
+    except ClientError as error:
+        if error.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+        raise
+    return StructType.fromJson(document["schema"])
+
+def load_catalog_schema(table):
+    """
+    The schema of the table in the Glue catalog (columns followed by the partition keys), None if it isn't there.
+    """
+    if not catalog_database:
+        return None
+    try:
+        catalog_table = glue_client.get_table(DatabaseName=catalog_database, Name=table)["Table"]
+    except ClientError as error:
+        if error.response["Error"]["Code"] == "EntityNotFoundException":
+            return None
+        raise
+    columns = catalog_table["StorageDescriptor"]["Columns"] + catalog_table.get("PartitionKeys", [])
+    return _parse_datatype_string("struct<" + ",".join(f"`{column['Name']}`:{column['Type']}" for column in columns) + ">")
+
+def record_schema(table, schema):
+    bucket, key = split_s3_uri(f"{schema_cache_uri}/{table}.json")
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=json.dumps({
+            "table": table,
+            "recorded_at": datetime.now(timezone.utc).isoformat(),
+            "schema": schema.jsonValue()
+        }).encode("utf-8"),
+        ContentType="application/json"
+    )
+    print(f"Recorded the schema of {table} in {schema_cache_uri}/{table}.json")
+
+def newest_data_file(base_prefix):
+    """
+    A parquet file of the newest partition (partition values sort by time), None if there are no partitions.
+    Only the partition "folders" and one partition are listed, not the whole table.
+    """
+    paginator = s3_client.get_paginator("list_objects_v2")
+    newest_partition = None
+    for page in paginator.paginate(Bucket=s3_bucket, Prefix=f"{base_prefix}/{partition_col}=", Delimiter="/"):
+        for common_prefix in page.get("CommonPrefixes", []):
+            newest_partition = max(newest_partition or "", common_prefix["Prefix"])
+    if not newest_partition:
+        return None
+    for page in paginator.paginate(Bucket=s3_bucket, Prefix=newest_partition):
+        for item in page.get("Contents", []):
+            if item["Key"].endswith(".parquet") and item["Size"] > 0:
+                return f"s3://{s3_bucket}/{item['Key']}"
+    return None
+
+def has_drifted(schema, base_prefix):
+    """
+    Compare the data columns of the stored schema with the footer of one file of the newest partition.
+    """
+    newest_file = newest_data_file(base_prefix)
+    if newest_file is None:
+        return False
+    stored = {field.name: field.dataType for field in schema.fields if field.name != partition_col}
+    current = {field.name: field.dataType for field in spark.read.parquet(newest_file).schema.fields}
+    if stored != current:
+        print(f"Schema drift in {newest_file}: added {sorted(set(current) - set(stored))}, "
+              f"removed {sorted(set(stored) - set(current))}, "
+              f"changed {sorted(name for name in set(stored) & set(current) if stored[name] != current[name])}")
+        return True
+    return False
+
+# Flushed in the finally so the metrics of a failed run reach CloudWatch too
+try:
+    for table in tables:
+        base_prefix = f"{main_prefix}{table}"
+        base = f"s3://{s3_bucket}/{base_prefix}"
+        # Listing the partitions happens here, the data itself is only read by the write. With a known schema
+        # Spark skips reading the footers and inferring the partition column type.
+        with metrics.stage("read_schema", table=table) as stage:
+            schema = load_cached_schema(table)
+            stage["schema_source"] = "cache"
+            if schema is None:
+                schema = load_catalog_schema(table)
+                stage["schema_source"] = "catalog"
+            if schema is not None and has_drifted(schema, base_prefix):
+                metrics.count("SchemaDrift")
+                schema = None
 
-for table in tables:
-    base = f"s3://{s3_bucket}/{main_prefix}{table}"
-    df = (spark.read
-            .option("basePath", base)
-            .parquet(f"{base}/{partition_col}=*"))
+            reader = spark.read.option("basePath", base)
+            if schema is not None:
+                reader = reader.schema(schema)
+                metrics.count("SchemaCacheHits")
+            else:
+                stage["schema_source"] = "inferred"
+            df = reader.parquet(f"{base}/{partition_col}=*")
+            if stage["schema_source"] != "cache":
+                record_schema(table, df.schema)
+            metrics.count("InputFiles", len(df.inputFiles()))
 
-    print(f"Table: {table}")
-    df.printSchema()
-    print()
+        print(f"Table: {table}")
+        df.printSchema()
+        print()
 
-    reducer = df.coalesce(1)
+        reducer = df.coalesce(1)
 
-    output = f"{dest_root}{table}/"
-    (reducer.write
-            .mode("overwrite")
-            .partitionBy(partition_col)
-            .parquet(output))
+        output = f"{dest_root}{table}/"
+        with metrics.stage("compact_write", table=table):
+            (reducer.write
+                    .mode("overwrite")
+                    .partitionBy(partition_col)
+                    .parquet(output))
+            metrics.count("TablesCompacted")
 
-    print(f"Wrote (partitioned by {partition_col}) for {table} -> {output}")
+        print(f"Wrote (partitioned by {partition_col}) for {table} -> {output}")
 
-run_end_dt = datetime.now(sa_tz).strftime("%Y-%m-%d %H:%M:%S")
-logger.info(f"Done. Start={run_start_dt} End={run_end_dt}")
-job.commit()
+    run_end_dt = datetime.now(sa_tz).strftime("%Y-%m-%d %H:%M:%S")
+    logger.info(f"Done. Start={run_start_dt} End={run_end_dt}")
+    job.commit()
+finally:
+    metrics.flush()
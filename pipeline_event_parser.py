@@ -0,0 +1,221 @@
+# The purpose of the following code is to give every SNS-consuming Lambda one parser for the pipeline
+# messages we publish. Two message families come through the topics:
+#   1. "table processed" messages from the ingestion Glue job, used by active_table_start and move_to_processed:
+#        "<source_system_name> table processed: <table_name> in <environment>"
+#        {"event_type": "table_processed", ..., "manifest_keys": [...]}  (see ingestion_manifest.py)
+#   2. Failure messages, used by ms_teams_failure_notifications. Newer jobs publish JSON, older jobs publish text:
+#        {"Environment": "...", "Source_System": "...", "tgt_table_name": "...", "ErrorMessage": "...", ...}
+#        "... job: <job_name> ... Source System: <source> Table: <table> JobRunID: <id> Error: <msg>. Please investigate ..."
+#
+# All patterns are compiled once at import time. Each field of the legacy failure text has its own pattern
+# and is searched for separately, so a field inside the error message (e.g. "Error: ... Table: x. Please
+# investigate") is found exactly where the previous per-field re.search calls found it.
+#
+# Run this file directly to check the parser against sns_message_samples.json and time it against the
+# previous per-field regex approach:
+#   python pipeline_event_parser.py
+
+import json
+import re
+
+TABLE_PROCESSED = 'table_processed'
+FAILURE = 'failure'
+UNKNOWN = 'unknown'
+
+_TABLE_PROCESSED_PATTERN = re.compile(r'^(.*?) table processed: (.*?) in (.*?)$')
+_WORD_PATTERN = re.compile(r'\w+')
+# Event attribute -> pattern of the legacy failure text, group 1 is the value
+_FAILURE_FIELD_PATTERNS = {
+    'source_system_name': re.compile(r'Source System: ([\w_]+)'),
+    'table_name': re.compile(r'Table: ([\w_]+)'),
+    'error_message': re.compile(r'Error: (.+?)\. Please investigate'),
+    'job_name': re.compile(r'job: ([\w-]+)'),
+    'job_run_id': re.compile(r'JobRunID: ([\w_]+)')
+}
+
+# Mapping of the JSON table processed message keys to the event attributes.
+_JSON_TABLE_PROCESSED_FIELDS = {
+    'source_system_name': 'source_system_name',
+    'table_name': 'table_name',
+    'environment': 'env',
+    'job_run_id': 'job_run_id',
+    'manifest_keys': 'manifest_keys',
+    'manifest_s3_uri': 'manifest_uri'
+}
+
+# Mapping of the JSON failure message keys to the event attributes.
+_JSON_FAILURE_FIELDS = {
+    'Environment': 'env',
+    'Source_System': 'source_system_name',
+    'tgt_table_name': 'table_name',
+    'ErrorMessage': 'error_message',
+    'JobName': 'job_name',
+    'Id': 'job_run_id',
+    'cdc_batch_date_id': 'batch_date',
+    'Message': 'note'
+}
+
+
+class PipelineEvent:
+    """
+    A parsed pipeline SNS message. Attributes which are not present in the message are None.
+    """
+    __slots__ = (
+        'kind', 'source_system_name', 'table_name', 'env', 'error_message', 'job_name',
+        'job_run_id', 'batch_date', 'note', 'manifest_keys', 'manifest_uri', 'is_json', 'raw'
+    )
+
+    def __init__(self, kind, raw, is_json=False):
+        self.kind = kind
+        self.raw = raw
+        self.is_json = is_json
+        self.source_system_name = None
+        self.table_name = None
+        self.env = None
+        self.error_message = None
+        self.job_name = None
+        self.job_run_id = None
+        self.batch_date = None
+        self.note = None
+        self.manifest_keys = None
+        self.manifest_uri = None
+
+    @property
+    def extracted_table_name(self):
+        """
+        The table name with the '<source_system_name>_' prefix stripped off, the same as the previous
+        re.search(fr'{source_system_name}_(\\w+)', table_name) lookup. None if it can't be found.
+        """
+        if not self.source_system_name or not self.table_name:
+            return None
+        prefix = f"{self.source_system_name}_"
+        index = self.table_name.find(prefix)
+        if index == -1:
+            return None
+        match = _WORD_PATTERN.match(self.table_name, index + len(prefix))
+        return match.group(0) if match else None
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__ if name != 'raw'}
+
+    def __repr__(self):
+        return f"PipelineEvent({self.as_dict()})"
+
+
+def _parse_json_table_processed(raw, payload):
+    event = PipelineEvent(TABLE_PROCESSED, raw, is_json=True)
+    for key, attribute in _JSON_TABLE_PROCESSED_FIELDS.items():
+        value = payload.get(key)
+        if value is not None:
+            setattr(event, attribute, value)
+    return event
+
+def _parse_json_failure(raw, payload):
+    event = PipelineEvent(FAILURE, raw, is_json=True)
+    for key, attribute in _JSON_FAILURE_FIELDS.items():
+        value = payload.get(key)
+        if value is not None:
+            setattr(event, attribute, value)
+    return event
+
+def _parse_text_failure(raw):
+    event = PipelineEvent(FAILURE, raw)
+    for attribute, pattern in _FAILURE_FIELD_PATTERNS.items():
+        match = pattern.search(raw)
+        if match:
+            setattr(event, attribute, match.group(1))
+    return event
+
+def parse_pipeline_event(message):
+    """
+    Parse a pipeline SNS message into a PipelineEvent.
+    Args:
+        message (str): The SNS message body.
+    Returns:
+        PipelineEvent: The parsed event. kind is UNKNOWN if the message is not in a format we know.
+    """
+    stripped = message.lstrip()
+    if stripped.startswith('{'):
+        try:
+            payload = json.loads(message)
+        except json.JSONDecodeError:
+            payload = None
+        if isinstance(payload, dict):
+            if payload.get('event_type') == TABLE_PROCESSED:
+                return _parse_json_table_processed(message, payload)
+            return _parse_json_failure(message, payload)
+
+    match = _TABLE_PROCESSED_PATTERN.match(message)
+    if match:
+        event = PipelineEvent(TABLE_PROCESSED, message)
+        event.source_system_name = match.group(1).strip()
+        event.table_name = match.group(2).strip()
+        event.env = match.group(3).strip()
+        return event
+
+    event = _parse_text_failure(message)
+    if event.source_system_name is None and event.table_name is None and event.job_run_id is None:
+        event.kind = UNKNOWN
+    return event
+
+def parse_sns_record(record):
+    """
+    Parse the SNS message of a Lambda event record.
+    Args:
+        record (dict): A single entry of event['Records'].
+    Returns:
+        PipelineEvent: The parsed event.
+    """
+    return parse_pipeline_event(record['Sns']['Message'])
+
+
+def _legacy_parse(message):
+    """The per-field parsing the Lambdas used before this module, kept for the benchmark only."""
+    try:
+        return json.loads(message)
+    except json.JSONDecodeError:
+        pass
+    match = re.match(r'^(.*?) table processed: (.*?) in (.*?)$', message)
+    if match:
+        source_system_name = match.group(1).strip()
+        table = re.search(fr'{source_system_name}_(\w+)', match.group(2).strip())
+        return source_system_name, table.group(1) if table else None
+    return (
+        re.search(r'Source System: ([\w_]+)', message),
+        re.search(r'Table: ([\w_]+)', message),
+        re.search(r'Error: (.+?)\. Please investigate', message),
+        re.search(r'job: ([\w-]+)', message),
+        re.search(r'JobRunID: ([\w_]+)', message)
+    )
+
+def _run_samples(path):
+    with open(path) as samples_file:
+        samples = json.load(samples_file)
+    for sample in samples:
+        event = parse_pipeline_event(sample['message'])
+        for attribute, expected in sample['expected'].items():
+            actual = getattr(event, attribute)
+            if actual != expected:
+                raise AssertionError(f"{sample['name']}: {attribute} is {actual!r}, expected {expected!r}")
+        if event.kind == FAILURE and not event.is_json:
+            # The legacy text has to give the same fields as the per-field regexes it replaced
+            legacy = tuple(match.group(1) if match else None for match in _legacy_parse(sample['message']))
+            parsed = tuple(getattr(event, attribute) for attribute in _FAILURE_FIELD_PATTERNS)
+            if parsed != legacy:
+                raise AssertionError(f"{sample['name']}: parsed {parsed}, the previous parser gave {legacy}")
+    print(f"All {len(samples)} sample messages parsed as expected.")
+    return [sample['message'] for sample in samples]
+
+def _benchmark(messages, number=20000):
+    import timeit
+    new_time = timeit.timeit(lambda: [parse_pipeline_event(m).extracted_table_name for m in messages], number=number)
+    old_time = timeit.timeit(lambda: [_legacy_parse(m) for m in messages], number=number)
+    per_message = 1e6 / (number * len(messages))
+    print(f"parse_pipeline_event : {new_time * per_message:.2f} us/message")
+    print(f"previous regex parse : {old_time * per_message:.2f} us/message")
+
+
+if __name__ == '__main__':
+    import os
+    sample_messages = _run_samples(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sns_message_samples.json'))
+    _benchmark(sample_messages)
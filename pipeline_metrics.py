@@ -0,0 +1,212 @@
+# Lightweight timing and metrics for the pipeline Lambdas and Glue jobs.
+#
+# Code is split into named stages with PipelineMetrics.stage() (a context manager) or PipelineMetrics.timed()
+# (a decorator). When a stage ends one JSON line in CloudWatch Embedded Metric Format (EMF) is written with:
+#   Duration       -> wall time of the stage in milliseconds
+#   ApiCalls       -> AWS API calls made while the stage ran
+#   Retries        -> retries botocore made for those calls (ResponseMetadata.RetryAttempts)
+#   BytesSent / BytesReceived -> request and response body sizes of those calls
+#   Errors         -> 1 when the stage raised
+# plus any counters added with count() during the stage. CloudWatch turns the EMF lines Lambda writes to its
+# log into metrics (namespace EDP/Pipeline, dimensions Service and Stage) without any log parsing.
+#
+# Glue does not extract EMF from its logs, so the Glue jobs use sink='cloudwatch': the same values are
+# buffered and sent with put_metric_data when flush() is called at the end of the job.
+#
+# The API call counters come from botocore event hooks on the default boto3 session, which only reach
+# clients created after instrument_boto3() ran, so create the PipelineMetrics object before any client.
+# Counters are process wide: stages running at the same time in different threads see each other's calls.
+#
+# Set PIPELINE_METRICS=off to switch the output off.
+#
+# Example usage:
+#   metrics = PipelineMetrics('move_to_processed')
+#
+#   @metrics.timed('handler')
+#   def lambda_handler(event, context):
+#       with metrics.stage('list_landing_keys', prefix=source_prefix):
+#           ...
+#       metrics.count('FilesMoved', len(keys))
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+
+import boto3
+
+NAMESPACE = os.environ.get('PIPELINE_METRICS_NAMESPACE', 'EDP/Pipeline')
+ENABLED = os.environ.get('PIPELINE_METRICS', 'on').lower() not in ('off', 'false', '0')
+# put_metric_data takes at most 1000 values per call
+MAX_METRIC_DATA = 1000
+
+_counters = Counter()
+_units = {'ApiCalls': 'Count', 'Retries': 'Count', 'BytesSent': 'Bytes', 'BytesReceived': 'Bytes'}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def _add(name, value, unit=None):
+    with _lock:
+        _counters[name] += value
+        if unit:
+            _units[name] = unit
+
+def _snapshot():
+    with _lock:
+        return Counter(_counters)
+
+def _body_size(body):
+    if isinstance(body, (bytes, bytearray, str)):
+        return len(body)
+    if isinstance(body, dict):
+        # Query protocol services (SNS, SQS, STS, CloudWatch) send the parameters form encoded
+        return len(urlencode(body, doseq=True))
+    if hasattr(body, '__len__'):
+        return len(body)
+    return 0
+
+def _before_call(params, **kwargs):
+    if getattr(_local, 'suppressed', False):
+        return
+    _add('ApiCalls', 1)
+    _add('BytesSent', _body_size(params.get('body')))
+
+def _after_call(http_response, parsed, **kwargs):
+    if getattr(_local, 'suppressed', False):
+        return
+    retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    if retries:
+        _add('Retries', retries)
+    length = http_response.headers.get('content-length')
+    if length and length.isdigit():
+        _add('BytesReceived', int(length))
+
+def instrument_boto3(session=None):
+    """
+    Hook the API call, retry and byte counters into the boto3 session (the default one if none is given).
+    Safe to call more than once, the hooks are only registered once per session.
+    """
+    events = (session or boto3._get_default_session()).events
+    # before-call and after-call fire once per API call, whatever number of attempts botocore makes
+    events.unregister('before-call', unique_id='pipeline-metrics-before-call')
+    events.unregister('after-call', unique_id='pipeline-metrics-after-call')
+    events.register('before-call', _before_call, unique_id='pipeline-metrics-before-call')
+    events.register('after-call', _after_call, unique_id='pipeline-metrics-after-call')
+
+
+class PipelineMetrics:
+    """
+    Stage timings and counters for one Lambda or Glue job, written as EMF lines or sent to CloudWatch.
+    """
+
+    def __init__(self, service, namespace=NAMESPACE, sink='stdout', dimensions=None):
+        self.service = service
+        self.namespace = namespace
+        self.sink = sink
+        self.dimensions = dict(dimensions or {})
+        self._buffer = []
+        instrument_boto3()
+
+    def count(self, name, value=1, unit='Count'):
+        """
+        Add to a counter. The amount added while a stage runs is reported with that stage.
+        """
+        _add(name, value, unit)
+
+    @contextlib.contextmanager
+    def stage(self, name, **properties):
+        """
+        Time a block of code and report it, with the counters it moved, as the stage `name`.
+        Extra keyword arguments are written as properties of the EMF line (searchable, not metrics).
+        """
+        before = _snapshot()
+        started = time.perf_counter()
+        failed = False
+        try:
+            yield properties
+        except BaseException as error:
+            failed = True
+            properties.setdefault('error', type(error).__name__)
+            raise
+        finally:
+            values = {'Duration': (time.perf_counter() - started) * 1000}
+            delta = _snapshot()
+            delta.subtract(before)
+            values.update((counter, amount) for counter, amount in delta.items() if amount)
+            values['Errors'] = int(failed)
+            self._emit(name, values, properties)
+
+    def timed(self, name):
+        """
+        Decorator form of stage().
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _unit(self, metric):
+        if metric == 'Duration':
+            return 'Milliseconds'
+        return _units.get(metric, 'Count')
+
+    def _emit(self, stage, values, properties):
+        if not ENABLED:
+            return
+        dimensions = {'Service': self.service, 'Stage': stage, **self.dimensions}
+        if self.sink == 'cloudwatch':
+            timestamp = datetime.now(timezone.utc)
+            self._buffer.extend(
+                {
+                    'MetricName': metric,
+                    'Dimensions': [{'Name': key, 'Value': str(value)} for key, value in dimensions.items()],
+                    'Timestamp': timestamp,
+                    'Value': value,
+                    'Unit': self._unit(metric)
+                }
+                for metric, value in values.items()
+            )
+            print(f"[metrics] {self.service}.{stage}: " + ', '.join(f"{metric}={value:.0f}" for metric, value in values.items()))
+            return
+
+        line = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [list(dimensions)],
+                    'Metrics': [{'Name': metric, 'Unit': self._unit(metric)} for metric in values]
+                }]
+            },
+            **properties,
+            **dimensions,
+            **{metric: round(value, 3) for metric, value in values.items()}
+        }
+        print(json.dumps(line, default=str))
+
+    def flush(self):
+        """
+        Send the buffered values when the sink is 'cloudwatch'. Failures are printed, never raised, so
+        metrics can't fail the job they measure.
+        """
+        if not self._buffer:
+            return
+        _local.suppressed = True
+        try:
+            cloudwatch = boto3.client('cloudwatch')
+            for start in range(0, len(self._buffer), MAX_METRIC_DATA):
+                cloudwatch.put_metric_data(Namespace=self.namespace, MetricData=self._buffer[start:start + MAX_METRIC_DATA])
+            self._buffer = []
+        except Exception as metrics_error:
+            print(f"Failed to send metrics to CloudWatch: {metrics_error}")
+        finally:
+            _local.suppressed = False
@@ -0,0 +1,217 @@
+# Local progress journal for the long running S3 restore and purge scripts, so a run that dies or loses
+# its session can be restarted without re-listing and redoing everything.
+#
+# The journal is a SQLite file which is only appended to, apart from the listing checkpoint rows:
+#   completed_items   -> keys (or other work item ids) which have been finished
+#   completed_batches -> delete batches which have been finished
+#   listing_state     -> per listing shard, the KeyMarker/VersionIdMarker to resume the listing from
+#
+# Work finishes out of order across the worker threads, so the listing checkpoint can't simply be the
+# last page requested. ListingWatermark tracks the work handed out in listing order and only moves the
+# checkpoint past an item once it and everything listed before it has finished.
+#
+# Example usage:
+#   journal = ProgressJournal('restore.journal', 'restore:my-bucket/changeaudit')
+#   watermark = journal.watermark('changeaudit')
+#   key_marker, version_id_marker = watermark.resume_from
+#   ...
+#   ticket = watermark.emit((key, None))
+#   ...
+#   watermark.done(ticket)
+#   journal.mark_completed(key)
+#   ...
+#   watermark.finish_listing()
+#   journal.close()
+
+import sqlite3
+import threading
+import time
+from collections import deque
+
+# Commit at least this often so a crash loses little progress, without a commit per item
+COMMIT_EVERY_WRITES = 1000
+COMMIT_EVERY_SECONDS = 2.0
+
+
+class ProgressJournal:
+    """
+    SQLite backed record of finished work and listing checkpoints for one job.
+    """
+
+    def __init__(self, path, job_id):
+        self.path = path
+        self.job_id = job_id
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS completed_items (
+                job_id TEXT NOT NULL,
+                item TEXT NOT NULL,
+                completed_at REAL NOT NULL,
+                PRIMARY KEY (job_id, item)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS completed_batches (
+                job_id TEXT NOT NULL,
+                batch_id TEXT NOT NULL,
+                item_count INTEGER NOT NULL,
+                completed_at REAL NOT NULL,
+                PRIMARY KEY (job_id, batch_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS listing_state (
+                job_id TEXT NOT NULL,
+                shard TEXT NOT NULL,
+                key_marker TEXT,
+                version_id_marker TEXT,
+                finished INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (job_id, shard)
+            ) WITHOUT ROWID;
+        ''')
+        self._connection.commit()
+        self._pending_writes = 0
+        self._last_commit = time.monotonic()
+
+    def _write(self, statement, parameters):
+        with self._lock:
+            self._connection.execute(statement, parameters)
+            self._pending_writes += 1
+            if self._pending_writes >= COMMIT_EVERY_WRITES or time.monotonic() - self._last_commit >= COMMIT_EVERY_SECONDS:
+                self._commit()
+
+    def _commit(self):
+        self._connection.commit()
+        self._pending_writes = 0
+        self._last_commit = time.monotonic()
+
+    def is_completed(self, item):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT 1 FROM completed_items WHERE job_id = ? AND item = ?', (self.job_id, item)
+            ).fetchone()
+        return row is not None
+
+    def mark_completed(self, item):
+        self._write(
+            'INSERT OR IGNORE INTO completed_items (job_id, item, completed_at) VALUES (?, ?, ?)',
+            (self.job_id, item, time.time())
+        )
+
+    def mark_batch_completed(self, batch_id, item_count):
+        self._write(
+            'INSERT OR IGNORE INTO completed_batches (job_id, batch_id, item_count, completed_at) VALUES (?, ?, ?, ?)',
+            (self.job_id, batch_id, item_count, time.time())
+        )
+
+    def is_batch_completed(self, batch_id):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT 1 FROM completed_batches WHERE job_id = ? AND batch_id = ?', (self.job_id, batch_id)
+            ).fetchone()
+        return row is not None
+
+    def listing_state(self, shard):
+        """
+        Returns:
+            tuple: (key_marker, version_id_marker, finished) for the shard, (None, None, False) if it was never started.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT key_marker, version_id_marker, finished FROM listing_state WHERE job_id = ? AND shard = ?',
+                (self.job_id, shard)
+            ).fetchone()
+        if row is None:
+            return None, None, False
+        return row[0], row[1], bool(row[2])
+
+    def save_listing_state(self, shard, key_marker, version_id_marker, finished=False):
+        self._write(
+            'INSERT OR REPLACE INTO listing_state (job_id, shard, key_marker, version_id_marker, finished, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (self.job_id, shard, key_marker, version_id_marker, int(finished), time.time())
+        )
+
+    def summary(self):
+        with self._lock:
+            items = self._connection.execute(
+                'SELECT COUNT(*) FROM completed_items WHERE job_id = ?', (self.job_id,)
+            ).fetchone()[0]
+            batches = self._connection.execute(
+                'SELECT COUNT(*), COALESCE(SUM(item_count), 0) FROM completed_batches WHERE job_id = ?', (self.job_id,)
+            ).fetchone()
+        return {'completed_items': items, 'completed_batches': batches[0], 'batched_items': batches[1]}
+
+    def watermark(self, shard):
+        return ListingWatermark(self, shard)
+
+    def flush(self):
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self._connection.close()
+
+
+class ListingWatermark:
+    """
+    Moves the listing checkpoint of a shard forward as the work handed out from the listing finishes.
+
+    Every work item is registered with emit() in listing order, along with the (key_marker, version_id_marker)
+    that a resumed listing should start after once the item is done. Passing (key, None) resumes after every
+    version of the key, (key, version_id) resumes after that exact version, and None leaves the checkpoint
+    where the items before it put it.
+    """
+
+    def __init__(self, journal, shard):
+        self.journal = journal
+        self.shard = shard
+        key_marker, version_id_marker, finished = journal.listing_state(shard)
+        self.resume_from = (key_marker, version_id_marker)
+        self.finished = finished
+        self._outstanding = deque()
+        self._done = set()
+        self._next_ticket = 0
+        self._listing_finished = False
+        self._lock = threading.Lock()
+
+    def emit(self, marker):
+        """
+        Register a work item. Returns the ticket to pass to done() once the item is finished.
+        """
+        with self._lock:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            self._outstanding.append((ticket, marker))
+            return ticket
+
+    def done(self, ticket):
+        with self._lock:
+            self._done.add(ticket)
+            self._advance()
+
+    def finish_listing(self):
+        """
+        Call once the listing is exhausted. The shard is marked finished when all its work is done.
+        """
+        with self._lock:
+            self._listing_finished = True
+            self._advance()
+
+    def _advance(self):
+        marker = None
+        while self._outstanding and self._outstanding[0][0] in self._done:
+            ticket, item_marker = self._outstanding.popleft()
+            self._done.discard(ticket)
+            if item_marker is not None:
+                marker = item_marker
+        if marker is not None:
+            self.resume_from = marker
+        if self._listing_finished and not self._outstanding:
+            if not self.finished:
+                self.finished = True
+                self.journal.save_listing_state(self.shard, *self.resume_from, finished=True)
+        elif marker is not None:
+            self.journal.save_listing_state(self.shard, *marker)
@@ -17,26 +17,34 @@ KEEP_PARTITIONS_GLOBAL=(
 )
 
 DRY_RUN=false
-
-EXCLUDE_ARGS=()
-for p in "${KEEP_PARTITIONS_GLOBAL[@]}"; do
-        EXCLUDE_ARGS+=( --exclude "${p}*" )
-done
-
-for table in "${TABLES[@]}"; do
-        SRC="s3://${SRC_BUCKET}/${SRC_PREFIX}/${table}/"
-        DST="s3://${DST_BUCKET}/${DST_PREFIX}/${table}/"
-
+WORKERS=32
+# A dry run writes the plan here, set APPLY_PLAN to that file to apply exactly what was reviewed
+PLAN_OUT="sync_plan.json"
+APPLY_PLAN=""
+
+# The sync itself is done by table_sync.py: every table is listed and diffed up front (key, size, ETag)
+# and all copies and deletes run on one shared worker pool instead of one `aws s3 sync` per table.
+SYNC_ARGS=( --workers "${WORKERS}" )
+
+if [[ -n "${APPLY_PLAN}" ]]; then
+        echo "Applying plan: ${APPLY_PLAN}"
+        SYNC_ARGS+=( --apply-plan "${APPLY_PLAN}" )
+else
         echo "------------------------------------------------------"
-        echo "Syncing:  $SRC  -->  $DST"
+        echo "Syncing:  s3://${SRC_BUCKET}/${SRC_PREFIX}/{${TABLES[*]}}/  -->  s3://${DST_BUCKET}/${DST_PREFIX}/"
         echo "Protecting partitions: ${KEEP_PARTITIONS_GLOBAL[*]:-"<none>"}"
         echo "------------------------------------------------------"
 
+        SYNC_ARGS+=(
+                --src-bucket "${SRC_BUCKET}" --src-prefix "${SRC_PREFIX}"
+                --dst-bucket "${DST_BUCKET}" --dst-prefix "${DST_PREFIX}"
+                --tables "${TABLES[@]}"
+                --keep-partitions "${KEEP_PARTITIONS_GLOBAL[@]}"
+                --plan-out "${PLAN_OUT}"
+        )
         if [[ "${DRY_RUN}" == "true" ]]; then
-                aws s3 sync "$SRC" "$DST" --delete --dryrun "${EXCLUDE_ARGS[@]}"
-        else
-                aws s3 sync "$SRC" "$DST" --delete "${EXCLUDE_ARGS[@]}"
+                SYNC_ARGS+=( --dry-run )
         fi
-done
+fi
 
-echo "All table syncs complete."
+python3 "$(dirname "$0")/table_sync.py" "${SYNC_ARGS[@]}"
@@ -1,67 +1,408 @@
+# The purpose of the following code is to restore the .parquet objects under source_prefix which were
+# hidden by delete markers, by copying an older version back over the key.
+#
+# Listing and copying run at the same time: the listing thread pushes work for every page onto a bounded
+# queue which the copy workers drain. When the workers fall behind the queue fills up and the listing
+# waits, so memory stays constant no matter how many versions the bucket holds.
+#
+# Exactly one source version is chosen per key while listing (see VersionSelector) so every key is copied
+# once and the result does not depend on which copy finishes last:
+#   default        -> the newest live version below the delete marker, only for keys whose latest version is a delete marker
+#   --as-of <ts>   -> the newest version at or before the timestamp, unless that is a delete marker or already the latest
+#
+# Two restore modes are available:
+#   copy            -> server side copy_object of the selected version over the target key (default)
+#   remove-markers  -> only when source_prefix == target_prefix: delete the delete markers sitting above the
+#                      selected version with batched delete_objects calls. No data is copied and no new
+#                      versions are written, the selected version simply becomes the latest again.
+# --dry-run writes a CSV report of what would be done (see --report) instead of changing anything.
+#
+# With --journal the run records its progress in a local journal (see progress_journal.py). Running the
+# same command again with the same journal skips the keys already restored and resumes the listing from
+# the last checkpoint, so a restore can be spread over several sessions.
+#
+# With --inventory-manifest the versions come from an S3 Inventory report (all versions) instead of
+# list_object_versions, see s3_inventory.py. The filtered rows are sorted into listing order so they go
+# through the same version selection as a listing.
+#
+# Example usage:
+#   python restore_delete_markers.py --dry-run
+#   python restore_delete_markers.py --mode remove-markers --journal restore.journal
+#   python restore_delete_markers.py --as-of 2025-09-29T00:00:00+02:00
+
+import argparse
+import csv
+import queue
+import threading
+from datetime import datetime, timezone
+
 import boto3
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
-s3 = boto3.client('s3')
+from progress_journal import ProgressJournal
+from s3_inventory import as_version_pages, iter_version_ordered_records
+from s3_batch_ops import (
+    BULK_CLIENT_CONFIG, MAX_DELETE_BATCH, AdaptiveBackoff, ProgressCounters, chunked, delete_version_batch,
+    iter_version_pages
+)
+
+s3 = boto3.client('s3', config=BULK_CLIENT_CONFIG)
 
 bucket_name = "ct-ire-edp-prod-africa-everest"
 source_prefix = "changeaudit"
 target_prefix = "changeaudit"
 excluded_country = "everest_kenya"
 
-print("Starting scan for versioned Parquet files...")
+NUM_WORKERS = 20
+# Number of selected keys allowed to wait for a copy worker before the listing pauses
+QUEUE_SIZE = 5000
 
-paginator = s3.get_paginator('list_object_versions')
-page_iterator = paginator.paginate(Bucket=bucket_name, Prefix=source_prefix)
+COPY_MODE = 'copy'
+REMOVE_MARKERS_MODE = 'remove-markers'
 
-restore_tasks = []
+_END_OF_LISTING = None
 
-def restore_object(version):
-    key = version['Key']
-    version_id = version['VersionId']
+# Set by main() when --journal is given
+journal = None
+watermark = None
 
-    # Restore only .parquet, non-latest, non-delete-marker
-    if not key.endswith(".parquet"):
-        return None
-    if version.get('IsDeleteMarker', False):
-        return None
-    if version.get('IsLatest', False):
-        return None
-    if f"{source_prefix}/{excluded_country}" in key:
-        print(f"Skipping key (excluded): {key}")
-        return None
 
-    new_key = key.replace(source_prefix, target_prefix, 1)
+def is_restorable_key(key):
+    """
+    Restore only .parquet keys which are not under the excluded country.
+    """
+    return key.endswith(".parquet") and f"{source_prefix}/{excluded_country}" not in key
+
+
+class VersionSelector:
+    """
+    Chooses one source version per key from the listing pages.
 
-    print("\n--------------------------------------------")
-    print(f"Original key     : {key}")
-    print(f"Version ID       : {version_id}")
-    print(f"New target key   : {new_key}")
-    print(f"Copying to s3://{bucket_name}/{new_key} ...")
+    list_object_versions returns keys in order and the versions of a key newest first, with the versions
+    and delete markers in separate lists. Each page is merged back into that order and walked once; a key
+    is only decided when the next key starts, so keys whose versions span two pages are handled correctly
+    and only the state of the current key is kept in memory.
+    """
 
+    def __init__(self, as_of=None, counters=None):
+        self.as_of = as_of
+        self.counters = counters or ProgressCounters('selection')
+        self._key = None
+        self._latest = None
+        self._chosen = None
+        self._decided = False
+        self._delete_markers = []
+
+    def _start_key(self, key):
+        self._key = key
+        self._latest = None
+        self._chosen = None
+        self._decided = False
+        self._delete_markers = []
+
+    def _finish_key(self):
+        """
+        Returns the (key, version, delete_markers) selection for the key that has just been completed, if any.
+        delete_markers are the markers newer than the selected version, only collected in the default mode.
+        """
+        if self._key is None:
+            return None
+        self.counters.increment('keys')
+        if self._chosen is None:
+            self.counters.increment('nothing_to_restore')
+            return None
+        self.counters.increment('selected')
+        return self._key, self._chosen, self._delete_markers
+
+    def _consider(self, entry):
+        if self._decided:
+            return
+        if self._latest is None:
+            self._latest = entry
+
+        if self.as_of is None:
+            # Only keys hidden by a delete marker need restoring, and then from the newest live version
+            if not self._latest['IsDeleteMarker']:
+                self._decided = True
+            elif not entry['IsDeleteMarker']:
+                self._chosen = entry
+                self._decided = True
+            else:
+                self._delete_markers.append(entry)
+        elif entry['LastModified'] <= self.as_of:
+            # The newest version at the as-of time, nothing to do if the key didn't exist then or is unchanged since
+            self._decided = True
+            if not entry['IsDeleteMarker'] and entry is not self._latest:
+                self._chosen = entry
+
+    def add_page(self, page):
+        """
+        Feed a list_object_versions page.
+        Returns:
+            list: (key, version, delete_markers) selections for the keys completed by this page.
+        """
+        entries = [dict(version, IsDeleteMarker=False) for version in page.get('Versions', [])]
+        entries.extend(dict(marker, IsDeleteMarker=True) for marker in page.get('DeleteMarkers', []))
+        # On a LastModified tie delete markers go first, so a marker is never missed when its markers are
+        # removed; the sort is stable so versions sharing a LastModified keep the order S3 listed them in
+        entries.sort(key=lambda entry: (
+            entry['Key'], not entry['IsLatest'], -entry['LastModified'].timestamp(), not entry['IsDeleteMarker']
+        ))
+
+        selections = []
+        for entry in entries:
+            if entry['Key'] != self._key:
+                selection = self._finish_key()
+                if selection:
+                    selections.append(selection)
+                self._start_key(entry['Key'])
+            if is_restorable_key(entry['Key']):
+                self._consider(entry)
+            else:
+                self._decided = True
+        return selections
+
+    def finish(self):
+        """
+        Returns the selection for the last key once the listing is complete.
+        """
+        selection = self._finish_key()
+        self._key = None
+        return [selection] if selection else []
+
+
+def restore_object(key, version):
+    """
+    Copy the selected version back over the key (or under target_prefix).
+    Returns:
+        str: The restored key, None if the copy failed.
+    """
+    version_id = version['VersionId']
+    new_key = key.replace(source_prefix, target_prefix, 1)
     try:
         s3.copy_object(
             Bucket=bucket_name,
             CopySource={'Bucket': bucket_name, 'Key': key, 'VersionId': version_id},
             Key=new_key
         )
-        print("Copy successful.")
+        print(f"Restored s3://{bucket_name}/{new_key} from version {version_id} ({version['LastModified'].isoformat()})")
         return key
     except Exception as e:
-        print(f"Failed to copy {key}: {e}")
+        print(f"Failed to copy {key} (version: {version_id}): {e}")
         return None
 
-for page in page_iterator:
-    versions = page.get('Versions', [])
-    for version in versions:
-        restore_tasks.append(version)
-
-restored_count = 0
-with ThreadPoolExecutor(max_workers=20) as executor:
-    futures = [executor.submit(restore_object, v) for v in restore_tasks]
-    for future in as_completed(futures):
-        result = future.result()
-        if result:
-            restored_count += 1
-
-print("\n Restore complete.")
-print(f"Total files restored: {restored_count}")
+def queue_selection(work_queue, selection, counters):
+    """
+    Hand a selection to the workers, unless the journal says a previous run already restored the key.
+    """
+    key = selection[0]
+    if journal and journal.is_completed(key):
+        counters.increment('already_restored')
+        return
+    ticket = watermark.emit((key, None)) if watermark else None
+    work_queue.put((ticket, selection))
+
+def mark_restored(ticket, key):
+    """
+    Record a restored key in the journal and let the listing checkpoint move past it.
+    """
+    if journal:
+        journal.mark_completed(key)
+        watermark.done(ticket)
+
+def inventory_version_pages(manifest_location, key_marker=None):
+    """
+    Pages of versions under source_prefix taken from an S3 Inventory report, in list_object_versions order.
+    The report is sorted file by file and merged (see s3_inventory), so memory stays flat here as well.
+    """
+    yield from as_version_pages(iter_version_ordered_records(
+        manifest_location, key_after=key_marker,
+        prefix=source_prefix, suffix=".parquet", exclude_substring=f"{source_prefix}/{excluded_country}"
+    ))
+
+def list_versions(work_queue, selector, counters, inventory_manifest=None):
+    """
+    Producer: list the versions under source_prefix page by page, select one version per key and queue
+    the selections for the copy workers. The put blocks while the queue is full, which is what keeps the
+    memory use flat.
+    """
+    try:
+        key_marker = watermark.resume_from[0] if watermark else None
+        if key_marker:
+            print(f"Resuming the listing after {key_marker}")
+        if inventory_manifest:
+            pages = inventory_version_pages(inventory_manifest, key_marker)
+        else:
+            pages = (page for _, page in iter_version_pages(s3, bucket_name, prefix=source_prefix, key_marker=key_marker))
+        for page in pages:
+            for selection in selector.add_page(page):
+                queue_selection(work_queue, selection, counters)
+            counters.increment('listed', len(page.get('Versions', [])) + len(page.get('DeleteMarkers', [])))
+        for selection in selector.finish():
+            queue_selection(work_queue, selection, counters)
+        if watermark:
+            watermark.finish_listing()
+    finally:
+        # One end marker per worker so every worker stops once the queue is drained
+        for _ in range(NUM_WORKERS):
+            work_queue.put(_END_OF_LISTING)
+
+class DryRunReport:
+    """
+    Thread safe CSV report of the actions a restore would take.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'w', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(['key', 'action', 'source_version_id', 'source_last_modified', 'delete_marker_version_ids'])
+        self._lock = threading.Lock()
+
+    def add(self, key, action, version, delete_markers):
+        with self._lock:
+            self._writer.writerow([
+                key, action, version['VersionId'], version['LastModified'].isoformat(),
+                ' '.join(marker['VersionId'] for marker in delete_markers)
+            ])
+
+    def close(self):
+        self._file.close()
+
+def copy_worker(work_queue, counters, report=None):
+    """
+    Consumer: restore the queued selections until the end of the listing is reached.
+    """
+    while True:
+        item = work_queue.get()
+        if item is _END_OF_LISTING:
+            break
+        ticket, (key, version, delete_markers) = item
+        if report:
+            report.add(key, COPY_MODE, version, delete_markers)
+            counters.increment('would_restore')
+        elif restore_object(key, version):
+            counters.increment('restored')
+            mark_restored(ticket, key)
+        else:
+            counters.increment('failed')
+
+def remove_delete_markers(batch, batch_keys, counters, backoff):
+    """
+    Delete the collected delete markers and record the keys whose markers were all removed.
+    """
+    failed_keys = set()
+    for to_delete in chunked(batch, MAX_DELETE_BATCH):
+        try:
+            errors = delete_version_batch(s3, bucket_name, to_delete, backoff, counters)
+            failed_keys.update(error['Key'] for error in errors)
+        except Exception as e:
+            counters.increment('errors', len(to_delete))
+            failed_keys.update(marker['Key'] for marker in to_delete)
+            print(f"Failed to remove delete markers starting at {to_delete[0]['Key']}: {e}")
+    for ticket, key in batch_keys:
+        if key in failed_keys:
+            counters.increment('failed')
+        else:
+            counters.increment('restored')
+            mark_restored(ticket, key)
+
+def remove_markers_worker(work_queue, counters, backoff, report=None):
+    """
+    Consumer for the remove-markers mode: collect the delete markers of the queued selections and delete
+    them in batches of at most 1000 versions.
+    """
+    batch = []
+    batch_keys = []
+    while True:
+        item = work_queue.get()
+        if item is _END_OF_LISTING:
+            break
+        ticket, (key, version, delete_markers) = item
+        if report:
+            report.add(key, REMOVE_MARKERS_MODE, version, delete_markers)
+            counters.increment('would_restore')
+            continue
+        # Keep the markers of a key in one batch so a key is only recorded once all of them are gone
+        if batch and len(batch) + len(delete_markers) > MAX_DELETE_BATCH:
+            remove_delete_markers(batch, batch_keys, counters, backoff)
+            batch, batch_keys = [], []
+        batch.extend({'Key': key, 'VersionId': marker['VersionId']} for marker in delete_markers)
+        batch_keys.append((ticket, key))
+    if batch:
+        remove_delete_markers(batch, batch_keys, counters, backoff)
+
+def parse_as_of(value):
+    """
+    Parse the --as-of timestamp, naive timestamps are taken as UTC.
+    """
+    as_of = datetime.fromisoformat(value)
+    return as_of if as_of.tzinfo else as_of.replace(tzinfo=timezone.utc)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Restore .parquet objects hidden by delete markers.')
+    parser.add_argument('--as-of', type=parse_as_of, help='Restore every key to its newest version at or before this ISO timestamp.')
+    parser.add_argument('--mode', choices=[COPY_MODE, REMOVE_MARKERS_MODE], default=COPY_MODE,
+                        help='copy the selected version, or remove the delete markers above it (source_prefix must equal target_prefix).')
+    parser.add_argument('--dry-run', action='store_true', help='Only write the report, nothing is restored.')
+    parser.add_argument('--report', default='restore_dry_run.csv', help='Where --dry-run writes its CSV report.')
+    parser.add_argument('--journal', help='Progress journal file, re-use it to resume an interrupted restore.')
+    parser.add_argument('--inventory-manifest', help='S3 Inventory manifest.json (s3:// or local path) to take the versions from.')
+    args = parser.parse_args(argv)
+
+    if args.mode == REMOVE_MARKERS_MODE:
+        if source_prefix != target_prefix:
+            parser.error("remove-markers only restores in place, source_prefix and target_prefix must be the same.")
+        if args.as_of:
+            parser.error("remove-markers can only bring back the newest live version, use --mode copy with --as-of.")
+
+    global journal, watermark
+    if args.journal and not args.dry_run:
+        job_id = f"restore:{bucket_name}/{source_prefix}->{target_prefix}:{args.mode}:{args.as_of.isoformat() if args.as_of else 'latest'}"
+        journal = ProgressJournal(args.journal, job_id)
+        watermark = journal.watermark(source_prefix)
+        if watermark.finished:
+            print(f"The journal {args.journal} shows this restore already completed: {journal.summary()}")
+            journal.close()
+            return
+        print(f"Using progress journal {args.journal}: {journal.summary()}")
+
+    print(f"Starting scan for versioned Parquet files ({args.mode} mode{', dry run' if args.dry_run else ''})...")
+    counters = ProgressCounters(f"restore s3://{bucket_name}/{source_prefix}")
+    selector = VersionSelector(args.as_of, counters)
+    work_queue = queue.Queue(maxsize=QUEUE_SIZE)
+    report = DryRunReport(args.report) if args.dry_run else None
+
+    if args.mode == REMOVE_MARKERS_MODE:
+        backoff = AdaptiveBackoff()
+        worker_args = [(work_queue, counters, backoff, report) for _ in range(NUM_WORKERS)]
+        target = remove_markers_worker
+    else:
+        worker_args = [(work_queue, counters, report) for _ in range(NUM_WORKERS)]
+        target = copy_worker
+    workers = [threading.Thread(target=target, args=arguments, daemon=True) for arguments in worker_args]
+    # Whatever the listing raises, the workers get their end markers (list_versions) and finish what was
+    # queued, then the journal commits their progress and the report is closed
+    try:
+        for worker in workers:
+            worker.start()
+        try:
+            list_versions(work_queue, selector, counters, args.inventory_manifest)
+        finally:
+            for worker in workers:
+                worker.join()
+    finally:
+        counters.report(force=True)
+        if journal:
+            journal.close()
+        if report:
+            report.close()
+
+    if report:
+        print(f"\n Dry run complete, {counters.get('would_restore')} key(s) would be restored. Report written to {args.report}")
+    else:
+        print("\n Restore complete.")
+        print(f"Total files restored: {counters.get('restored')}")
+
+
+if __name__ == '__main__':
+    main()
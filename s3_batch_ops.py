@@ -0,0 +1,180 @@
+# Shared helpers for the bulk S3 maintenance scripts (delete_all_objects_s3, restore_delete_markers, ...).
+# Covers the version listing loop, correctly chunked delete_objects batches with adaptive backoff on
+# SlowDown, and thread safe progress counters so the scripts report aggregated progress instead of
+# printing a line per object.
+
+import random
+import threading
+import time
+
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+# delete_objects accepts at most 1000 keys per request
+MAX_DELETE_BATCH = 1000
+
+THROTTLE_ERROR_CODES = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'ServiceUnavailable', '503'}
+RETRYABLE_ERROR_CODES = THROTTLE_ERROR_CODES | {'InternalError', '500'}
+
+# Client configuration for the bulk scripts: enough connections for the worker pools and a few standard
+# retries for dropped connections. Sustained SlowDown is left to AdaptiveBackoff and delete_version_batch, which
+# slow every worker down together, instead of every call retrying on its own up to ten times.
+BULK_CLIENT_CONFIG = Config(max_pool_connections=64, retries={'mode': 'standard', 'max_attempts': 3})
+
+
+def chunked(items, size=MAX_DELETE_BATCH):
+    """
+    Split a list into consecutive chunks of at most size items.
+    """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class ProgressCounters:
+    """
+    Thread safe named counters which print one aggregated progress line at most every interval seconds.
+    """
+
+    def __init__(self, label, interval=10):
+        self.label = label
+        self.interval = interval
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._last_report = self._started
+
+    def increment(self, name, amount=1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + amount
+        self.report()
+
+    def get(self, name):
+        with self._lock:
+            return self._counts.get(name, 0)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def report(self, force=False):
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._last_report < self.interval:
+                return
+            self._last_report = now
+            counts = ', '.join(f"{name}={value:,}" for name, value in sorted(self._counts.items()))
+        print(f"[{self.label}] {now - self._started:,.0f}s elapsed: {counts or 'nothing yet'}")
+
+
+class AdaptiveBackoff:
+    """
+    Delay shared by all workers. Every throttling response doubles it, every success shrinks it again,
+    so the workers slow down together when S3 returns SlowDown and speed back up once it recovers.
+    """
+
+    def __init__(self, base_delay=0.05, max_delay=20.0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._delay = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def delay(self):
+        return self._delay
+
+    def on_throttle(self):
+        with self._lock:
+            self._delay = min(max(self._delay * 2, self.base_delay), self.max_delay)
+
+    def on_success(self):
+        with self._lock:
+            self._delay = self._delay * 0.8 if self._delay > self.base_delay else 0.0
+
+    def wait(self):
+        delay = self._delay
+        if delay:
+            time.sleep(delay + random.uniform(0, delay / 2))
+
+
+def iter_version_pages(s3, bucket, prefix='', delimiter=None, key_marker=None, version_id_marker=None):
+    """
+    List object versions one page at a time.
+    Args:
+        s3: S3 client.
+        bucket (str): Bucket to list.
+        prefix (str): Only list keys under this prefix.
+        delimiter (str): Optional delimiter, keys below it are returned as CommonPrefixes.
+        key_marker (str): Optional KeyMarker to start listing from.
+        version_id_marker (str): Optional VersionIdMarker to start listing from.
+    Yields:
+        tuple: ((key_marker, version_id_marker), page) where the markers are the ones used to request the page.
+    """
+    while True:
+        kwargs = {'Bucket': bucket, 'Prefix': prefix}
+        if delimiter:
+            kwargs['Delimiter'] = delimiter
+        if key_marker:
+            kwargs['KeyMarker'] = key_marker
+        if version_id_marker:
+            kwargs['VersionIdMarker'] = version_id_marker
+        page = s3.list_object_versions(**kwargs)
+        yield (key_marker, version_id_marker), page
+        if not page.get('IsTruncated'):
+            break
+        key_marker = page.get('NextKeyMarker')
+        version_id_marker = page.get('NextVersionIdMarker')
+
+
+def delete_version_batch(s3, bucket, objects, backoff, counters, max_attempts=5):
+    """
+    Delete up to 1000 object versions with one delete_objects call, retrying throttled requests and
+    keys which failed with a retryable error. A request that fails for good doesn't raise, the keys it
+    still had to delete are returned as failed so only those are counted as errors.
+    Args:
+        s3: S3 client.
+        bucket (str): Bucket the objects live in.
+        objects (list): [{'Key': ..., 'VersionId': ...}] entries, at most MAX_DELETE_BATCH.
+        backoff (AdaptiveBackoff): Backoff shared between the workers.
+        counters (ProgressCounters): Counters to record deleted/errors/throttled against.
+    Returns:
+        list: The delete_objects Errors entries for keys which could not be deleted.
+    """
+    if len(objects) > MAX_DELETE_BATCH:
+        raise ValueError(f"delete_objects accepts at most {MAX_DELETE_BATCH} keys, got {len(objects)}.")
+
+    pending = objects
+    failed = []
+    for attempt in range(1, max_attempts + 1):
+        backoff.wait()
+        try:
+            response = s3.delete_objects(Bucket=bucket, Delete={'Objects': pending, 'Quiet': True})
+        except (ClientError, BotoCoreError) as error:
+            code = error.response['Error']['Code'] if isinstance(error, ClientError) else type(error).__name__
+            if code in RETRYABLE_ERROR_CODES and attempt < max_attempts:
+                counters.increment('throttled')
+                backoff.on_throttle()
+                continue
+            # Keys deleted by earlier attempts stay deleted, only the ones still pending failed
+            failed.extend(dict(obj, Code=code, Message=str(error)) for obj in pending)
+            break
+
+        errors = response.get('Errors', [])
+        counters.increment('deleted', len(pending) - len(errors))
+        retryable = [error for error in errors if error.get('Code') in RETRYABLE_ERROR_CODES]
+        failed.extend(error for error in errors if error.get('Code') not in RETRYABLE_ERROR_CODES)
+        if not retryable:
+            backoff.on_success()
+            break
+        # Only send the keys which were throttled again
+        counters.increment('throttled')
+        backoff.on_throttle()
+        retry_keys = {(error['Key'], error.get('VersionId')) for error in retryable}
+        pending = [obj for obj in pending if (obj['Key'], obj.get('VersionId')) in retry_keys]
+    else:
+        failed.extend(retryable)
+
+    if failed:
+        counters.increment('errors', len(failed))
+        for error in failed:
+            print(f"Failed to delete {error['Key']} (version: {error.get('VersionId', 'N/A')}): {error.get('Message')}")
+    return failed
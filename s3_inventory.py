@@ -0,0 +1,299 @@
+# The purpose of the following code is to let the bulk S3 scripts take their keys from an S3 Inventory
+# report instead of LIST calls. For buckets with hundreds of millions of versions reading the inventory
+# is far quicker and cheaper than paginating list_object_versions.
+#
+# The manifest.json of an inventory report can be read from S3 (s3://bucket/.../manifest.json) or from
+# local disk for testing. Data files in CSV (optionally gzipped), ORC or Parquet format are read with
+# pyarrow and filtered with vectorised column operations before anything is turned into Python objects.
+# The records handed back look like list_object_versions entries (Key, VersionId, IsLatest, ...) so they
+# can be fed straight into the existing copy, delete and restore workers.
+#
+# Consumers that need the versions in list_object_versions order across the whole report (the version
+# selection of restore_delete_markers) use iter_version_ordered_records: every data file is sorted on its own
+# and spilled to a temporary Parquet file, and the sorted runs are merged while they are streamed back, so only
+# one data file and one batch per run are in memory however large the report is.
+#
+# Bear in mind an inventory is a daily (or weekly) snapshot: objects written after it was taken are not
+# in it, and objects changed since may have a different state.
+#
+# Example usage:
+#   for records in iter_inventory_records('s3://inventory-bucket/.../manifest.json', prefix='changeaudit/'):
+#       ...
+
+import gzip
+import heapq
+import io
+import json
+import os
+import re
+import tempfile
+from datetime import datetime, timezone
+from urllib.parse import unquote_plus
+
+import boto3
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+
+# Inventory columns we use, in the snake_case naming the ORC/Parquet schemas use
+_COLUMN_TO_FIELD = {
+    'key': 'Key',
+    'version_id': 'VersionId',
+    'is_latest': 'IsLatest',
+    'is_delete_marker': 'IsDeleteMarker',
+    'size': 'Size',
+    'last_modified_date': 'LastModified',
+    'e_tag': 'ETag'
+}
+
+_s3_client = None
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("Reading S3 Inventory reports needs pyarrow, install it with: pip install pyarrow")
+
+def _get_s3_client():
+    global _s3_client
+    if _s3_client is None:
+        _s3_client = boto3.client('s3')
+    return _s3_client
+
+def _split_s3_uri(uri):
+    bucket, _, key = uri[len('s3://'):].partition('/')
+    return bucket, key
+
+def _snake_case(name):
+    """
+    'LastModifiedDate' -> 'last_modified_date', 'ETag' -> 'e_tag', 'version_id' stays as it is.
+    """
+    name = name.strip()
+    name = re.sub(r'(?<=[a-z0-9])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])', '_', name)
+    return name.lower()
+
+def _read_bytes(location):
+    if location.startswith('s3://'):
+        bucket, key = _split_s3_uri(location)
+        return _get_s3_client().get_object(Bucket=bucket, Key=key)['Body'].read()
+    with open(location, 'rb') as local_file:
+        return local_file.read()
+
+def load_manifest(manifest_location):
+    """
+    Read an inventory manifest.json from S3 or local disk.
+    Returns:
+        dict: The manifest with a 'data_files' list of locations added.
+    """
+    manifest = json.loads(_read_bytes(manifest_location))
+    if manifest_location.startswith('s3://'):
+        destination_bucket = manifest['destinationBucket'].split(':::')[-1]
+        manifest['data_files'] = [f"s3://{destination_bucket}/{entry['key']}" for entry in manifest['files']]
+    else:
+        # Local copies keep the data files next to the manifest, either under the full key or just the file name
+        base_dir = os.path.dirname(os.path.abspath(manifest_location))
+        manifest['data_files'] = []
+        for entry in manifest['files']:
+            candidates = [os.path.join(base_dir, entry['key']), os.path.join(base_dir, 'data', os.path.basename(entry['key'])),
+                          os.path.join(base_dir, os.path.basename(entry['key']))]
+            manifest['data_files'].append(next((path for path in candidates if os.path.exists(path)), candidates[0]))
+    return manifest
+
+def _read_data_file(location, file_format, file_schema):
+    data = _read_bytes(location)
+    if file_format == 'CSV':
+        if location.endswith('.gz'):
+            data = gzip.decompress(data)
+        column_names = [_snake_case(name) for name in file_schema.split(',')]
+        table = pa_csv.read_csv(
+            io.BytesIO(data),
+            read_options=pa_csv.ReadOptions(column_names=column_names),
+            convert_options=pa_csv.ConvertOptions(column_types={name: pa.string() for name in column_names})
+        )
+        return _normalise_csv_table(table)
+    if file_format == 'ORC':
+        import pyarrow.orc as pa_orc
+        table = pa_orc.ORCFile(io.BytesIO(data)).read()
+    elif file_format == 'Parquet':
+        import pyarrow.parquet as pa_parquet
+        table = pa_parquet.read_table(io.BytesIO(data))
+    else:
+        raise ValueError(f"Unsupported inventory format: {file_format}")
+    return table.rename_columns([_snake_case(name) for name in table.column_names])
+
+def _normalise_csv_table(table):
+    """
+    CSV inventories hold every value as text: turn the flags into booleans, size into an integer and the
+    timestamps into timestamps so the table matches the ORC/Parquet ones.
+    """
+    columns = {name: table.column(name) for name in table.column_names}
+    for flag in ('is_latest', 'is_delete_marker'):
+        if flag in columns:
+            columns[flag] = pc.equal(pc.utf8_lower(columns[flag]), 'true')
+    if 'size' in columns:
+        columns['size'] = pc.cast(pc.if_else(pc.equal(columns['size'], ''), None, columns['size']), pa.int64())
+    if 'last_modified_date' in columns:
+        columns['last_modified_date'] = pc.strptime(
+            pc.replace_substring_regex(columns['last_modified_date'], r'\.\d+Z$|Z$', ''),
+            format='%Y-%m-%dT%H:%M:%S', unit='ms'
+        )
+    return pa.table(columns)
+
+def _decode_keys(table):
+    """
+    Keys in CSV inventories are URL encoded. Only the keys which contain an encoded character are decoded.
+    """
+    keys = table.column('key')
+    needs_decoding = pc.or_(pc.match_substring(keys, '%'), pc.match_substring(keys, '+'))
+    if not pc.any(needs_decoding).as_py():
+        return table
+    decoded = [unquote_plus(key) if flag else key for key, flag in zip(keys.to_pylist(), needs_decoding.to_pylist())]
+    return table.set_column(table.column_names.index('key'), 'key', pa.array(decoded, pa.string()))
+
+def filter_inventory(table, prefix=None, suffix=None, exclude_substring=None, latest_only=False,
+                     exclude_delete_markers=False, delete_markers_only=False):
+    """
+    Filter an inventory table with vectorised column operations.
+    Returns:
+        pyarrow.Table: The rows which match every given condition.
+    """
+    mask = None
+
+    def combine(condition):
+        return condition if mask is None else pc.and_(mask, condition)
+
+    keys = table.column('key')
+    if prefix:
+        mask = combine(pc.starts_with(keys, prefix))
+    if suffix:
+        mask = combine(pc.ends_with(keys, suffix))
+    if exclude_substring:
+        mask = combine(pc.invert(pc.match_substring(keys, exclude_substring)))
+    if latest_only and 'is_latest' in table.column_names:
+        mask = combine(pc.fill_null(table.column('is_latest'), True))
+    if 'is_delete_marker' in table.column_names:
+        is_delete_marker = pc.fill_null(table.column('is_delete_marker'), False)
+        if exclude_delete_markers:
+            mask = combine(pc.invert(is_delete_marker))
+        if delete_markers_only:
+            mask = combine(is_delete_marker)
+    return table if mask is None else table.filter(mask)
+
+def read_inventory(manifest_location, **filters):
+    """
+    Read and filter the data files of an inventory report one at a time.
+    Args:
+        manifest_location (str): s3:// URI or local path of the manifest.json.
+        **filters: Keyword arguments for filter_inventory.
+    Yields:
+        pyarrow.Table: The filtered rows of each data file.
+    """
+    _require_pyarrow()
+    manifest = load_manifest(manifest_location)
+    file_format = manifest.get('fileFormat', 'CSV')
+    for location in manifest['data_files']:
+        table = _read_data_file(location, file_format, manifest.get('fileSchema', ''))
+        if file_format == 'CSV':
+            table = _decode_keys(table)
+        yield filter_inventory(table, **filters)
+
+def sort_for_version_listing(table):
+    """
+    Sort inventory rows into list_object_versions order: by key, latest version first, then newest first.
+    """
+    sort_keys = [('key', 'ascending')]
+    for column, order in (('is_latest', 'descending'), ('last_modified_date', 'descending'), ('is_delete_marker', 'descending')):
+        if column in table.column_names:
+            sort_keys.append((column, order))
+    return table.sort_by(sort_keys)
+
+def to_records(table, batch_size=1000):
+    """
+    Turn inventory rows into list_object_versions style records, batch_size at a time.
+    Yields:
+        list: Dictionaries with Key, VersionId, IsLatest, IsDeleteMarker, Size, LastModified and ETag.
+    """
+    columns = [name for name in _COLUMN_TO_FIELD if name in table.column_names]
+    table = table.select(columns).rename_columns([_COLUMN_TO_FIELD[name] for name in columns])
+    for batch in table.to_batches(max_chunksize=batch_size):
+        records = batch.to_pylist()
+        for record in records:
+            # Objects written before versioning was enabled have no version id in the inventory
+            if not record.get('VersionId'):
+                record['VersionId'] = 'null'
+            last_modified = record.get('LastModified')
+            if isinstance(last_modified, datetime) and last_modified.tzinfo is None:
+                record['LastModified'] = last_modified.replace(tzinfo=timezone.utc)
+        yield records
+
+def iter_inventory_records(manifest_location, batch_size=1000, **filters):
+    """
+    Read, filter and convert an inventory report file by file.
+    Yields:
+        list: Batches of list_object_versions style records.
+    """
+    for table in read_inventory(manifest_location, **filters):
+        yield from to_records(table, batch_size)
+
+def _version_listing_order(record):
+    """
+    Sort key of a record matching sort_for_version_listing: key, latest version first, then newest first.
+    """
+    last_modified = record.get('LastModified')
+    return (
+        record['Key'],
+        not record.get('IsLatest'),
+        -last_modified.timestamp() if last_modified else 0,
+        not record.get('IsDeleteMarker')
+    )
+
+def _iter_run(path, batch_size):
+    import pyarrow.parquet as pa_parquet
+    for record_batch in pa_parquet.ParquetFile(path).iter_batches(batch_size=batch_size):
+        for records in to_records(pa.Table.from_batches([record_batch]), batch_size):
+            yield from records
+
+def iter_version_ordered_records(manifest_location, batch_size=1000, key_after=None, **filters):
+    """
+    Read an inventory report in list_object_versions order without holding all of it in memory: each
+    filtered data file is sorted and written to a temporary Parquet file, then the sorted runs are merged.
+    Args:
+        manifest_location (str): s3:// URI or local path of the manifest.json.
+        batch_size (int): Records per yielded batch.
+        key_after (str): Only return keys after this one, to resume an interrupted run.
+        **filters: Keyword arguments for filter_inventory.
+    Yields:
+        list: Batches of list_object_versions style records.
+    """
+    _require_pyarrow()
+    import pyarrow.parquet as pa_parquet
+    with tempfile.TemporaryDirectory(prefix='inventory-runs-') as run_dir:
+        runs = []
+        for index, table in enumerate(read_inventory(manifest_location, **filters)):
+            if key_after:
+                table = table.filter(pc.greater(table.column('key'), key_after))
+            if table.num_rows:
+                path = os.path.join(run_dir, f"run-{index}.parquet")
+                pa_parquet.write_table(sort_for_version_listing(table), path)
+                runs.append(path)
+        batch = []
+        for record in heapq.merge(*(_iter_run(path, batch_size) for path in runs), key=_version_listing_order):
+            batch.append(record)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+def as_version_pages(records_batches):
+    """
+    Wrap record batches as list_object_versions pages so they can go through the same code as a listing.
+    """
+    for records in records_batches:
+        yield {
+            'Versions': [record for record in records if not record.get('IsDeleteMarker')],
+            'DeleteMarkers': [record for record in records if record.get('IsDeleteMarker')]
+        }
@@ -0,0 +1,108 @@
+# The purpose of the following code is to run the SQL config_table_populator generates without Athena, so
+# statement generation and the apply can be tested and benchmarked offline.
+#
+# SQLiteQueryExecutor holds the data_control tables in an attached SQLite database (in memory by default)
+# and accepts the dialect the populator writes:
+#   DELETE FROM data_control.<table> WHERE <column> = '<value>';
+#   INSERT INTO data_control.<table> SELECT '<value>' AS <column>, <number> AS <column>, NULL AS <column> UNION ALL SELECT ...;
+# Anything else (DDL, MERGE, CTAS) is rejected so a change in the generated dialect shows up as an error here
+# before it reaches Athena. SQLite caps a compound SELECT at 500 terms (SQLITE_MAX_COMPOUND_SELECT), Athena
+# doesn't, so longer INSERT ... UNION ALL queries are split here, inside one transaction, and the populator
+# keeps sending exactly what Athena gets.
+#
+# Example usage:
+#   from config_table_populator import CONTROL_TABLE_COLUMNS, set_query_executor
+#   executor = SQLiteQueryExecutor(CONTROL_TABLE_COLUMNS)
+#   set_query_executor(executor)
+#   ... invoke the populator ...
+#   executor.rows('edp_generic_file_loads', source_system_name='grandcentral')
+
+import sqlite3
+import time
+from collections import Counter
+
+ACCEPTED_STATEMENTS = ('DELETE', 'INSERT', 'SELECT')
+# SQLite's default SQLITE_MAX_COMPOUND_SELECT
+MAX_COMPOUND_SELECT = 500
+_UNION_ALL = ' UNION ALL '
+_COLUMN_TYPES = {'text': 'TEXT', 'number': 'INTEGER', 'optional': 'TEXT'}
+
+
+class SQLiteQueryExecutor:
+    """
+    In-process stand-in for Athena with the data_control tables, see config_table_populator.set_query_executor().
+    """
+
+    def __init__(self, table_columns, path=':memory:', database='data_control'):
+        """
+        Args:
+            table_columns (dict): Table name -> [(column name, kind)] as in config_table_populator.CONTROL_TABLE_COLUMNS.
+            path (str): SQLite file to keep the tables in, in memory by default.
+            database (str): Schema name the statements use for the tables.
+        """
+        self.database = database
+        self.connection = sqlite3.connect(':memory:')
+        self.connection.execute(f"ATTACH DATABASE ? AS {database}", (path,))
+        for table, columns in table_columns.items():
+            definitions = ', '.join(f"{column} {_COLUMN_TYPES[kind]}" for column, kind in columns)
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS {database}.{table} ({definitions})")
+        self.connection.commit()
+        # Statement kind -> number executed and seconds spent
+        self.statements = Counter()
+        self.seconds = Counter()
+
+    def execute(self, query):
+        statement = query.strip().rstrip(';').strip()
+        kind = statement.split(None, 1)[0].upper() if statement else ''
+        if kind not in ACCEPTED_STATEMENTS:
+            raise ValueError(f"Statement not supported by the SQLite stand-in: {statement[:80]}")
+        started = time.perf_counter()
+        with self.connection:
+            for part in self._split_compound(statement) if kind == 'INSERT' else [statement]:
+                self.connection.execute(part)
+        self.statements[kind] += 1
+        self.seconds[kind] += time.perf_counter() - started
+
+    @staticmethod
+    def _split_compound(statement, max_terms=MAX_COMPOUND_SELECT):
+        """
+        Split an INSERT ... SELECT ... UNION ALL SELECT ... into INSERTs of at most max_terms SELECTs each.
+        Only separators outside quoted literals count, so values containing ' UNION ALL ' are left alone.
+        """
+        separators = []
+        quoted = False
+        index = 0
+        while index < len(statement):
+            if statement[index] == "'":
+                quoted = not quoted
+            elif not quoted and statement.startswith(_UNION_ALL, index):
+                separators.append(index)
+                index += len(_UNION_ALL)
+                continue
+            index += 1
+        if len(separators) < max_terms:
+            return [statement]
+        select_start = statement.upper().index('SELECT')
+        prefix = statement[:select_start]
+        bounds = [select_start] + [separator + len(_UNION_ALL) for separator in separators]
+        ends = separators + [len(statement)]
+        terms = [statement[start:end] for start, end in zip(bounds, ends)]
+        return [prefix + _UNION_ALL.join(terms[i:i + max_terms]) for i in range(0, len(terms), max_terms)]
+
+    def rows(self, table, **filters):
+        """
+        The rows of a table as dictionaries, optionally only those whose columns equal the given values.
+        """
+        where = ' AND '.join(f"{column} = ?" for column in filters)
+        cursor = self.connection.execute(
+            f"SELECT * FROM {self.database}.{table}" + (f" WHERE {where}" if where else ''),
+            tuple(filters.values())
+        )
+        names = [description[0] for description in cursor.description]
+        return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def count(self, table, **filters):
+        return len(self.rows(table, **filters))
+
+    def close(self):
+        self.connection.close()
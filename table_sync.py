@@ -0,0 +1,246 @@
+# The purpose of the following code is to sync a set of table folders from one S3 location to another,
+# replacing the serial `aws s3 sync --delete` loop in replace_delete_files_s3.sh.
+#
+# Source and destination of every table are listed once, in parallel, and diffed like `aws s3 sync`:
+#   copy   -> key missing in the destination, present with a different size, or present with a different
+#             ETag and older than the source
+#   delete -> key only present in the destination
+# Keys under a protected partition (KEEP_PARTITIONS_GLOBAL, matched like the old --exclude "<partition>*"
+# globs against the key relative to the table folder) are left alone by both. The copies and deletes of
+# all tables then run on one shared worker pool.
+#
+# --dry-run only writes the plan file. A plan can be applied later with --apply-plan, which runs exactly
+# the actions in the file; copies are made with CopySourceIfMatch on the planned ETag so a source that
+# changed after planning is reported instead of silently copied.
+#
+# The ETags of a copy don't always match the source: copy_object gives a multipart upload a single part
+# ETag and the managed copy of objects over 5 GB uses its own part size. A destination object of the same size
+# that is at least as new as the source is therefore treated as in sync, so those objects are copied once
+# and not again on every run.
+#
+# Example usage:
+#   python table_sync.py --tables compass_case_bills compass_organization --dry-run --plan-out sync_plan.json
+#   python table_sync.py --apply-plan sync_plan.json
+
+import argparse
+import fnmatch
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import boto3
+from botocore.exceptions import ClientError
+
+from s3_batch_ops import BULK_CLIENT_CONFIG, MAX_DELETE_BATCH, AdaptiveBackoff, ProgressCounters, chunked, delete_version_batch
+
+SRC_BUCKET = "ct-ire-edp-prd-datastaging-op"
+SRC_PREFIX = "compass-backup/replace-this-with-current-compass"
+DST_BUCKET = "ct-ire-edp-prd-datastaging-op"
+DST_PREFIX = "changeaudit/compass"
+
+TABLES = [
+    "compass_case_bills",
+    "compass_case_seq_rules",
+    "compass_organization",
+    "compass_dd_rjct_hist"
+]
+
+KEEP_PARTITIONS_GLOBAL = [
+    "cdc_date=2025-09-29"
+]
+
+# copy_object only handles objects up to 5 GB, larger ones go through the managed multipart copy
+MAX_COPY_OBJECT_SIZE = 5 * 1024 ** 3
+
+s3 = boto3.client('s3', config=BULK_CLIENT_CONFIG)
+
+
+def table_prefix(prefix, table):
+    return f"{prefix.rstrip('/')}/{table}/"
+
+def list_table(bucket, prefix):
+    """
+    List every object under the prefix.
+    Returns:
+        dict: Key relative to the prefix -> (size, etag, last_modified).
+    """
+    objects = {}
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get('Contents', []):
+            objects[item['Key'][len(prefix):]] = (item['Size'], item['ETag'], item['LastModified'])
+    return objects
+
+def in_sync(source, destination):
+    """
+    Whether the destination object already holds the source object, see the note on ETags at the top.
+    """
+    if destination is None:
+        return False
+    source_size, source_etag, source_modified = source
+    destination_size, destination_etag, destination_modified = destination
+    return source_size == destination_size and (source_etag == destination_etag or destination_modified >= source_modified)
+
+def is_protected(relative_key, keep_partitions):
+    return any(fnmatch.fnmatchcase(relative_key, f"{partition}*") for partition in keep_partitions)
+
+def diff_table(table, source_objects, destination_objects, src_prefix, dst_prefix, keep_partitions):
+    """
+    Work out the copies and deletes that make the destination table match the source.
+    Returns:
+        tuple: (actions, protected_count)
+    """
+    source_root = table_prefix(src_prefix, table)
+    destination_root = table_prefix(dst_prefix, table)
+    actions = []
+    protected = 0
+    for relative_key, source in sorted(source_objects.items()):
+        if is_protected(relative_key, keep_partitions):
+            protected += 1
+            continue
+        if not in_sync(source, destination_objects.get(relative_key)):
+            size, etag, _ = source
+            actions.append({
+                'op': 'copy', 'table': table, 'src_key': source_root + relative_key,
+                'dst_key': destination_root + relative_key, 'size': size, 'etag': etag
+            })
+    for relative_key in sorted(destination_objects.keys() - source_objects.keys()):
+        if is_protected(relative_key, keep_partitions):
+            protected += 1
+            continue
+        actions.append({'op': 'delete', 'table': table, 'dst_key': destination_root + relative_key})
+    return actions, protected
+
+def build_plan(src_bucket, src_prefix, dst_bucket, dst_prefix, tables, keep_partitions, list_workers=16):
+    """
+    List the source and destination of every table in parallel and diff them into a plan.
+    Returns:
+        dict: The plan, ready to be written to a file or applied.
+    """
+    with ThreadPoolExecutor(max_workers=list_workers) as executor:
+        listings = {
+            table: (
+                executor.submit(list_table, src_bucket, table_prefix(src_prefix, table)),
+                executor.submit(list_table, dst_bucket, table_prefix(dst_prefix, table))
+            )
+            for table in tables
+        }
+
+    actions = []
+    summary = {}
+    for table, (source_future, destination_future) in listings.items():
+        table_actions, protected = diff_table(
+            table, source_future.result(), destination_future.result(), src_prefix, dst_prefix, keep_partitions
+        )
+        actions.extend(table_actions)
+        summary[table] = {
+            'copy': sum(1 for action in table_actions if action['op'] == 'copy'),
+            'copy_bytes': sum(action['size'] for action in table_actions if action['op'] == 'copy'),
+            'delete': sum(1 for action in table_actions if action['op'] == 'delete'),
+            'protected': protected
+        }
+        print(f"{table}: {summary[table]['copy']} to copy, {summary[table]['delete']} to delete, {protected} protected")
+
+    return {
+        'created_at': datetime.now().isoformat(),
+        'src_bucket': src_bucket,
+        'src_prefix': src_prefix,
+        'dst_bucket': dst_bucket,
+        'dst_prefix': dst_prefix,
+        'keep_partitions': keep_partitions,
+        'summary': summary,
+        'actions': actions
+    }
+
+def copy_action(plan, action, counters):
+    copy_source = {'Bucket': plan['src_bucket'], 'Key': action['src_key']}
+    try:
+        if action['size'] > MAX_COPY_OBJECT_SIZE:
+            s3.copy(copy_source, plan['dst_bucket'], action['dst_key'], ExtraArgs={'CopySourceIfMatch': action['etag']})
+        else:
+            s3.copy_object(CopySource=copy_source, Bucket=plan['dst_bucket'], Key=action['dst_key'], CopySourceIfMatch=action['etag'])
+        counters.increment('copied')
+        counters.increment('copied_bytes', action['size'])
+    except ClientError as error:
+        code = error.response['Error']['Code']
+        if code in ('PreconditionFailed', '412'):
+            counters.increment('changed_since_plan')
+            print(f"Source changed since the plan was made, not copied: {action['src_key']}")
+        else:
+            counters.increment('errors')
+            print(f"Failed to copy {action['src_key']}: {error}")
+
+def delete_actions(plan, actions, backoff, counters):
+    try:
+        delete_version_batch(s3, plan['dst_bucket'], [{'Key': action['dst_key']} for action in actions], backoff, counters)
+    except Exception as error:
+        counters.increment('errors', len(actions))
+        print(f"Failed to delete the batch starting at {actions[0]['dst_key']}: {error}")
+
+def apply_plan(plan, workers=32):
+    """
+    Run every copy and delete in the plan on one shared worker pool.
+    """
+    counters = ProgressCounters(f"sync s3://{plan['src_bucket']}/{plan['src_prefix']} -> s3://{plan['dst_bucket']}/{plan['dst_prefix']}")
+    backoff = AdaptiveBackoff()
+    copies = [action for action in plan['actions'] if action['op'] == 'copy']
+    deletes = [action for action in plan['actions'] if action['op'] == 'delete']
+    print(f"Applying plan from {plan['created_at']}: {len(copies)} copies, {len(deletes)} deletes")
+
+    # Caps the number of queued tasks so a plan with millions of actions doesn't build millions of futures
+    in_flight = threading.BoundedSemaphore(workers * 4)
+
+    def run(function, *args):
+        try:
+            function(*args)
+        finally:
+            in_flight.release()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch in chunked(deletes, MAX_DELETE_BATCH):
+            in_flight.acquire()
+            executor.submit(run, delete_actions, plan, batch, backoff, counters)
+        for action in copies:
+            in_flight.acquire()
+            executor.submit(run, copy_action, plan, action, counters)
+
+    counters.report(force=True)
+    return counters.snapshot()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Sync table folders between S3 locations from a diff of both listings.')
+    parser.add_argument('--src-bucket', default=SRC_BUCKET)
+    parser.add_argument('--src-prefix', default=SRC_PREFIX)
+    parser.add_argument('--dst-bucket', default=DST_BUCKET)
+    parser.add_argument('--dst-prefix', default=DST_PREFIX)
+    parser.add_argument('--tables', nargs='+', default=TABLES)
+    parser.add_argument('--keep-partitions', nargs='*', default=KEEP_PARTITIONS_GLOBAL,
+                        help='Partitions (relative to the table folder) which are never copied over or deleted.')
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--dry-run', action='store_true', help='Only build the plan and write it to --plan-out.')
+    parser.add_argument('--plan-out', default='sync_plan.json', help='Where the plan is written.')
+    parser.add_argument('--apply-plan', help='Apply a plan file written by an earlier --dry-run, exactly as written.')
+    args = parser.parse_args(argv)
+
+    if args.apply_plan:
+        with open(args.apply_plan) as plan_file:
+            plan = json.load(plan_file)
+        apply_plan(plan, args.workers)
+        print("All table syncs complete.")
+        return
+
+    print(f"Protecting partitions: {' '.join(args.keep_partitions) or '<none>'}")
+    plan = build_plan(args.src_bucket, args.src_prefix, args.dst_bucket, args.dst_prefix, args.tables, args.keep_partitions)
+    with open(args.plan_out, 'w') as plan_file:
+        json.dump(plan, plan_file, indent=2)
+    print(f"Plan written to {args.plan_out}")
+
+    if args.dry_run:
+        return
+    apply_plan(plan, args.workers)
+    print("All table syncs complete.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+# The purpose of the following code is to take Microsoft Teams webhook delivery out of the pipeline Lambdas.
+# Instead of blocking on a POST to the webhook, the Lambdas call enqueue_notification() which drops the
+# message onto the notifications SQS queue and returns straight away. The teams_notification_sender Lambda
+# drains that queue, applies the timeout/retry rules and moves messages that keep failing to the DLQ.
+#
+# The queue messages name the webhook ('lambda-failures', ...) instead of carrying its URL: the URL is a
+# credential and would otherwise be copied into the queue, the DLQ and any redrive tooling. The sender
+# resolves the name with webhook_url(), from the Secrets Manager secret TEAMS_WEBHOOKS_SECRET_ID or the
+# TEAMS_WEBHOOK_URLS environment variable (both a JSON object of name -> URL) over the defaults below.
+#
+# Local runs can set NOTIFICATION_LOCAL_QUEUE=true to keep the messages in an in-memory stand-in queue
+# (LOCAL_QUEUE) which teams_notification_sender.drain_local_queue() delivers. Without either setting the
+# notification is posted to the webhook directly, once, so a Lambda missing its queue configuration still
+# notifies instead of losing the message.
+
+import json
+import os
+from collections import deque
+from datetime import datetime
+
+import boto3
+
+NOTIFICATION_QUEUE_URL = os.environ.get('NOTIFICATION_QUEUE_URL', '')
+USE_LOCAL_QUEUE = os.environ.get('NOTIFICATION_LOCAL_QUEUE', '').lower() in ('1', 'true', 'yes')
+TEAMS_WEBHOOKS_SECRET_ID = os.environ.get('TEAMS_WEBHOOKS_SECRET_ID', '')
+
+LAMBDA_FAILURES_WEBHOOK = 'lambda-failures'
+MOVE_TO_PROCESSED_WEBHOOK = 'move-to-processed'
+PIPELINE_FAILURES_WEBHOOK = 'pipeline-failures'
+_DEFAULT_WEBHOOK_URLS = {
+    LAMBDA_FAILURES_WEBHOOK: "https://libertyholdings.webhook.office.com/webhookb2/84ae269b-3328-4244-9c58-87c0541029c0@66b8ffa6-81c0-4ea6-93fb-06f390dc67f6/IncomingWebhook/1c7314d5bffd4561aa4d694641deb2f3/540ec8e7-b8ad-4612-9c4a-140cef8ece9c/V2D2XxrsBWC76nparKmE63SCKVqIts7TmneUOC8PDMJOk1",
+    MOVE_TO_PROCESSED_WEBHOOK: "https://libertyholdings.webhook.office.com/webhookb2/107ab5b7-2181-48b6-a08d-867a3b9b1be6@66b8ffa6-81c0-4ea6-93fb-06f390dc67f6/IncomingWebhook/f48a60e53c244883aec8f818ec712481/540ec8e7-b8ad-4612-9c4a-140cef8ece9c/V2D48F_4WdLacduICMppdTvVOKYoYTTQHBvNM6RTzgpEY1",
+    PIPELINE_FAILURES_WEBHOOK: "https://libertyholdings.webhook.office.com/webhookb2/84ae269b-3328-4244-9c58-87c0541029c0@66b8ffa6-81c0-4ea6-93fb-06f390dc67f6/IncomingWebhook/c138a082ecc74b4994660b794fa65c9e/540ec8e7-b8ad-4612-9c4a-140cef8ece9c/V2si77KzgXjjzLFo4ensxNcctUBKFqTLyxrbWaTTx0wps1"
+}
+
+# Local stand-in for the SQS queue. Holds the same message bodies that would be sent to SQS.
+LOCAL_QUEUE = deque()
+
+_sqs_client = None
+_webhook_urls = None
+
+def get_sqs_client():
+    """
+    Create the SQS client on first use so that Lambdas which never notify don't pay for it on cold start.
+    Returns the SQS client.
+    """
+    global _sqs_client
+    if _sqs_client is None:
+        _sqs_client = boto3.client('sqs', region_name=os.environ.get('AWS_REGION', 'eu-west-1'))
+    return _sqs_client
+
+def webhook_url(webhook):
+    """
+    Resolve a webhook name to its URL, loading the configured URLs on first use.
+    Returns:
+        str: The URL, None if the name is unknown.
+    """
+    global _webhook_urls
+    if _webhook_urls is None:
+        urls = dict(_DEFAULT_WEBHOOK_URLS)
+        urls.update(json.loads(os.environ.get('TEAMS_WEBHOOK_URLS') or '{}'))
+        if TEAMS_WEBHOOKS_SECRET_ID:
+            secrets_client = boto3.client('secretsmanager', region_name=os.environ.get('AWS_REGION', 'eu-west-1'))
+            urls.update(json.loads(secrets_client.get_secret_value(SecretId=TEAMS_WEBHOOKS_SECRET_ID)['SecretString']))
+        _webhook_urls = urls
+    return _webhook_urls.get(webhook)
+
+def build_message(webhook, payload, source):
+    """
+    Build the queue message body for a webhook notification.
+    Args:
+        webhook (str): Name of the Teams webhook the payload should be posted to, e.g. LAMBDA_FAILURES_WEBHOOK.
+        payload (dict): JSON payload to post to the webhook.
+        source (str): Name of the Lambda that raised the notification.
+    Returns:
+        dict: The queue message body.
+    """
+    return {
+        'webhook': webhook,
+        'payload': payload,
+        'source': source,
+        'enqueued_at': f"{datetime.utcnow().isoformat()}Z"
+    }
+
+def post_directly(message):
+    """
+    Post a notification straight to its webhook, used when no queue is configured.
+    Returns:
+        bool: True if the webhook accepted it.
+    """
+    import urllib3
+    url = webhook_url(message['webhook'])
+    if not url:
+        print(f"Unknown webhook {message['webhook']!r}, the notification from {message['source']} is dropped.")
+        return False
+    http = urllib3.PoolManager(timeout=urllib3.Timeout(connect=2.0, read=5.0), retries=False)
+    response = http.request(
+        'POST', url, body=json.dumps(message['payload']).encode('utf-8'),
+        headers={'Content-Type': 'application/json'}
+    )
+    if 200 <= response.status < 300:
+        return True
+    print(f"Direct webhook post from {message['source']} failed with HTTP {response.status}.")
+    return False
+
+def enqueue_notification(webhook, payload, source, queue_url=None):
+    """
+    Queue a webhook notification for the sender Lambda and return without waiting for delivery.
+    Args:
+        webhook (str): Name of the Teams webhook the payload should be posted to, e.g. LAMBDA_FAILURES_WEBHOOK.
+        payload (dict): JSON payload to post to the webhook.
+        source (str): Name of the Lambda that raised the notification.
+        queue_url (str): Optional queue URL, defaults to NOTIFICATION_QUEUE_URL.
+    Returns:
+        bool: True if the notification was queued, False otherwise.
+    """
+    message = build_message(webhook, payload, source)
+    queue_url = queue_url or NOTIFICATION_QUEUE_URL
+    try:
+        if not queue_url:
+            if USE_LOCAL_QUEUE:
+                LOCAL_QUEUE.append(message)
+                print(f"Notification from {source} queued on the local stand-in queue.")
+                return True
+            print(f"NOTIFICATION_QUEUE_URL is not set, posting the notification from {source} to the webhook directly.")
+            return post_directly(message)
+        get_sqs_client().send_message(QueueUrl=queue_url, MessageBody=json.dumps(message))
+        print(f"Notification from {source} queued for delivery.")
+        return True
+    except Exception as queue_error:
+        print(f"Failed to queue notification from {source}: {queue_error}")
+        return False
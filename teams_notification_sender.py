@@ -0,0 +1,276 @@
+# The purpose of the following code is to deliver the Teams webhook notifications queued by the pipeline
+# Lambdas (see teams_notification_queue.py). The Lambda is triggered by the notifications SQS queue and
+# receives the messages in batches. Every message gets one delivery attempt per receive with a connect/read
+# timeout. On a 429 or 5xx it is handed back to SQS as a batch item failure, with its visibility timeout set
+# to the exponential backoff (or Retry-After), so the Lambda never sleeps between attempts. Messages which
+# fail for good, or have been received NOTIFICATION_MAX_ATTEMPTS times, are sent to the dead-letter queue
+# so they can be inspected and redriven later.
+#
+# The webhook URL is resolved from the webhook name in the message, see teams_notification_queue.webhook_url().
+#
+# Example test event you can use to test this function:
+# {
+#   "Records": [
+#     {
+#       "messageId": "1",
+#       "body": "{\"webhook\": \"lambda-failures\", \"payload\": {\"text\": \"test\"}, \"source\": \"test\"}",
+#       "attributes": {"ApproximateReceiveCount": "1"}
+#     }
+#   ]
+# }
+
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import urllib3
+
+import teams_notification_queue
+from pipeline_metrics import PipelineMetrics
+
+NOTIFICATION_DLQ_URL = os.environ.get('NOTIFICATION_DLQ_URL', '')
+# Optional override used by the offline harness to point every delivery at a local HTTP sink.
+WEBHOOK_URL_OVERRIDE = os.environ.get('TEAMS_WEBHOOK_URL_OVERRIDE', '')
+MAX_ATTEMPTS = int(os.environ.get('NOTIFICATION_MAX_ATTEMPTS', '5'))
+# Retries wait in SQS (visibility timeout) rather than in the Lambda, so the delays can be generous
+BASE_BACKOFF_SECONDS = 10
+MAX_BACKOFF_SECONDS = 900
+MAX_DELIVERY_WORKERS = 4
+# Keep this much of the Lambda time free for handing the failed messages back to SQS or the DLQ.
+SAFETY_MARGIN_MILLIS = 5000
+
+# Outcomes of a delivery attempt
+DELIVERED = 'delivered'
+RETRY = 'retry'
+FAILED = 'failed'
+
+metrics = PipelineMetrics('teams_notification_sender')
+
+http = urllib3.PoolManager(timeout=urllib3.Timeout(connect=2.0, read=5.0), retries=False)
+
+def is_retryable(status):
+    """
+    Only throttling and server side errors are worth retrying, anything else will fail again.
+    """
+    return status == 429 or status >= 500
+
+def backoff_seconds(attempt, retry_after=None):
+    """
+    Work out how long to wait before the next attempt.
+    Args:
+        attempt (int): Number of attempts made so far.
+        retry_after (str): Value of the Retry-After header if the webhook returned one.
+    Returns:
+        float: Seconds to wait.
+    """
+    if retry_after:
+        try:
+            return min(float(retry_after), MAX_BACKOFF_SECONDS)
+        except ValueError:
+            pass
+    delay = min(BASE_BACKOFF_SECONDS * (2 ** (attempt - 1)), MAX_BACKOFF_SECONDS)
+    return delay + random.uniform(0, delay / 2)
+
+def deliver(message):
+    """
+    Post a single notification to its webhook, once.
+    Args:
+        message (dict): Queue message body built by teams_notification_queue.build_message.
+    Returns:
+        tuple: (outcome, last_error, retry_after) where outcome is DELIVERED, RETRY or FAILED.
+    """
+    url = WEBHOOK_URL_OVERRIDE or teams_notification_queue.webhook_url(message['webhook'])
+    if not url:
+        return FAILED, f"Unknown webhook {message['webhook']!r}", None
+    encoded_payload = json.dumps(message['payload']).encode('utf-8')
+    metrics.count('WebhookAttempts')
+    metrics.count('WebhookBytesSent', len(encoded_payload), 'Bytes')
+    try:
+        response = http.request('POST', url, body=encoded_payload, headers={'Content-Type': 'application/json'})
+    except urllib3.exceptions.HTTPError as http_error:
+        return RETRY, str(http_error), None
+    if 200 <= response.status < 300:
+        print(f"Webhook notification from {message.get('source')} delivered.")
+        return DELIVERED, None, None
+    last_error = f"HTTP {response.status}: {response.data.decode('utf-8', errors='replace')[:200]}"
+    if is_retryable(response.status):
+        return RETRY, last_error, response.headers.get('Retry-After')
+    return FAILED, last_error, None
+
+def send_to_dead_letter_queue(failed):
+    """
+    Send the messages which could not be delivered to the DLQ in batches of 10.
+    Args:
+        failed (list): List of (message_id, message, last_error) tuples.
+    Returns:
+        list: The message ids which could not be sent to the DLQ either, SQS redelivers those.
+    """
+    if not NOTIFICATION_DLQ_URL:
+        for message_id, message, last_error in failed:
+            print(f"No DLQ configured, handing notification {message_id} back to SQS: {last_error}")
+        return [message_id for message_id, _, _ in failed]
+
+    sqs_client = teams_notification_queue.get_sqs_client()
+    not_sent = []
+    for i in range(0, len(failed), 10):
+        batch = failed[i:i + 10]
+        entries = []
+        for index, (message_id, message, last_error) in enumerate(batch):
+            message['last_error'] = last_error
+            entries.append({'Id': str(index), 'MessageBody': json.dumps(message)})
+        try:
+            response = sqs_client.send_message_batch(QueueUrl=NOTIFICATION_DLQ_URL, Entries=entries)
+            not_sent.extend(batch[int(entry['Id'])][0] for entry in response.get('Failed', []))
+        except Exception as dlq_error:
+            print(f"Failed to send notifications to the DLQ: {dlq_error}")
+            not_sent.extend(message_id for message_id, _, _ in batch)
+    return not_sent
+
+def delay_retries(retries):
+    """
+    Set the visibility timeout of the messages handed back to SQS to their backoff, best effort: SQS falls
+    back to the queue's visibility timeout if this fails.
+    Args:
+        retries (list): List of (queue_url, receipt_handle, seconds) tuples.
+    """
+    for queue_url, receipt_handle, seconds in retries:
+        if not queue_url or not receipt_handle:
+            continue
+        try:
+            teams_notification_queue.get_sqs_client().change_message_visibility(
+                QueueUrl=queue_url, ReceiptHandle=receipt_handle, VisibilityTimeout=int(seconds)
+            )
+        except Exception as visibility_error:
+            print(f"Failed to delay the retry of a notification: {visibility_error}")
+
+def parse_message(body):
+    """
+    Parse and check a queue message body.
+    Returns:
+        dict: The message.
+    Raises:
+        ValueError: If the body isn't a notification built by teams_notification_queue.build_message.
+    """
+    message = json.loads(body)
+    if not isinstance(message, dict):
+        raise ValueError("the body is not a JSON object")
+    if not isinstance(message.get('webhook'), str) or not message['webhook']:
+        raise ValueError("webhook is missing")
+    if 'payload' not in message:
+        raise ValueError("payload is missing")
+    return message
+
+def queue_url_of(event_source_arn):
+    """
+    The queue URL of an SQS queue ARN (arn:aws:sqs:<region>:<account>:<name>).
+    """
+    if not event_source_arn:
+        return None
+    _, _, _, region, account, name = event_source_arn.split(':', 5)
+    return f"https://sqs.{region}.amazonaws.com/{account}/{name}"
+
+def deliver_batch(messages, deadline=None):
+    """
+    Deliver a batch of notifications concurrently, hand the retryable failures back to SQS and dead-letter
+    the ones that failed for good.
+    Args:
+        messages (list): List of (message_id, message, receive_count, queue_url, receipt_handle) tuples.
+        deadline (float): Optional time.monotonic() value after which no further deliveries are started.
+    Returns:
+        list: The message ids which should be handed back to SQS for redelivery.
+    """
+    if not messages:
+        return []
+
+    def attempt(item):
+        if deadline is not None and time.monotonic() >= deadline:
+            return RETRY, 'Not enough Lambda time left to deliver', None
+        return deliver(item[1])
+
+    with metrics.stage('deliver', messages=len(messages)):
+        with ThreadPoolExecutor(max_workers=min(MAX_DELIVERY_WORKERS, len(messages))) as executor:
+            results = list(executor.map(attempt, messages))
+
+        retries = []
+        failed = []
+        for (message_id, message, receive_count, queue_url, receipt_handle), (outcome, last_error, retry_after) in zip(messages, results):
+            if outcome == DELIVERED:
+                continue
+            if outcome == RETRY and receive_count < MAX_ATTEMPTS:
+                wait_time = backoff_seconds(receive_count, retry_after)
+                print(f"Delivery from {message.get('source')} failed ({last_error}), SQS retries it in {wait_time:.0f} seconds.")
+                retries.append((message_id, queue_url, receipt_handle, wait_time))
+            else:
+                print(f"Giving up on notification from {message.get('source')} after {receive_count} attempt(s): {last_error}")
+                message['attempts'] = receive_count
+                failed.append((message_id, message, last_error))
+        delivered = len(messages) - len(retries) - len(failed)
+        metrics.count('Delivered', delivered)
+        metrics.count('DeliveryRetried', len(retries))
+        metrics.count('DeliveryFailed', len(failed))
+    print(f"Delivered {delivered} of {len(messages)} notification(s).")
+    delay_retries([(queue_url, receipt_handle, wait_time) for _, queue_url, receipt_handle, wait_time in retries])
+    handed_back = [message_id for message_id, _, _, _ in retries]
+    if failed:
+        with metrics.stage('dead_letter', messages=len(failed)):
+            handed_back.extend(send_to_dead_letter_queue(failed))
+    return handed_back
+
+def drain_local_queue():
+    """
+    Deliver everything sitting on the local stand-in queue, retrying straight away instead of through SQS.
+    Used for local runs and the offline harness.
+    Returns:
+        list: The ids of messages which could not be delivered or dead-lettered.
+    """
+    not_delivered = []
+    receive_count = 0
+    while teams_notification_queue.LOCAL_QUEUE and receive_count < MAX_ATTEMPTS:
+        receive_count += 1
+        messages = []
+        while teams_notification_queue.LOCAL_QUEUE:
+            messages.append((f"local-{receive_count}-{len(messages)}", teams_notification_queue.LOCAL_QUEUE.popleft(), receive_count, None, None))
+        handed_back = set(deliver_batch(messages))
+        for message_id, message, _, _, _ in messages:
+            if message_id not in handed_back:
+                continue
+            if receive_count < MAX_ATTEMPTS:
+                teams_notification_queue.LOCAL_QUEUE.append(message)
+            else:
+                not_delivered.append(message_id)
+    return not_delivered
+
+@metrics.timed('handler')
+def lambda_handler(event, context):
+    """
+    Lambda function entry point, triggered by the notifications SQS queue.
+    Args:
+        event (dict): SQS event containing a batch of notification messages.
+        context (object): LambdaContext object.
+    Returns:
+        dict: Partial batch response so that only the messages we could not handle are redelivered.
+    """
+    deadline = time.monotonic() + (context.get_remaining_time_in_millis() - SAFETY_MARGIN_MILLIS) / 1000
+    messages = []
+    malformed = []
+    for record in event['Records']:
+        try:
+            receive_count = int(record.get('attributes', {}).get('ApproximateReceiveCount', 1))
+            messages.append((
+                record['messageId'], parse_message(record['body']), receive_count,
+                queue_url_of(record.get('eventSourceARN')), record.get('receiptHandle')
+            ))
+        except (KeyError, ValueError) as parse_error:
+            # json.JSONDecodeError is a ValueError too
+            print(f"Unable to parse notification {record.get('messageId')}: {parse_error}")
+            malformed.append((record.get('messageId'), {'raw_body': record.get('body')}, f"Malformed message: {parse_error}"))
+
+    # Malformed messages can never be delivered, they go straight to the DLQ (or back to SQS without one)
+    batch_item_failures = send_to_dead_letter_queue(malformed) if malformed else []
+    batch_item_failures.extend(deliver_batch(messages, deadline))
+    return {
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in batch_item_failures]
+    }